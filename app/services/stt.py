@@ -4,10 +4,8 @@ from time import time
 from typing import AsyncGenerator, Callable
 
 import httpx
-import librosa
 import numpy as np
 import sounddevice as sd
-import soundfile as sf
 from amazon_transcribe.client import TranscribeStreamingClient
 from amazon_transcribe.handlers import TranscriptResultStreamHandler
 from amazon_transcribe.model import TranscriptEvent
@@ -15,8 +13,16 @@ from core.config import settings
 from deepgram import (DeepgramClient, DeepgramClientOptions, FileSource,
                       PrerecordedOptions)
 from deepgram.utils import verboselogs
-from services.whisper_streaming_repo.whisper_online import (FasterWhisperASR,
-                                                       VACOnlineASRProcessor)
+from services.whisper_streaming_repo.whisper_online import (AdaptiveChunkController,
+                                                       Endpointer,
+                                                       FasterWhisperASR,
+                                                       IngestQueue,
+                                                       LatencyStatsHook,
+                                                       VACOnlineASRProcessor,
+                                                       load_vad_model,
+                                                       model_pool,
+                                                       pcm16_to_float32,
+                                                       warmup)
 
 from utils.logger import get_logger
 
@@ -98,16 +104,63 @@ class WhisperStreamingTranscriber:
         self.transcription_started = False
         self.model_lock = asyncio.Lock()
         self.silence_timeout = config["silence_timeout"]
+        # End the utterance by the VAD's end of speech and an adaptive trailing silence, silence_timeout is then only the hard cap
+        self.endpointing = config.get("endpointing", False)
+        self.endpoint_min_silence = config.get("endpoint_min_silence", 0.4)
+        self.endpoint_max_silence = config.get("endpoint_max_silence", 2.0)
+        self.online_chunk_size = config.get("online_chunk_size", 1)
+        self.target_latency = config.get("target_latency")
+        # What to do with the audio that arrives while the ASR is slower than real time, see IngestQueue
+        self.backpressure = config.get("backpressure", "coalesce")
+        self.max_lag = config.get("max_lag", 2)
+        # Real-time factor and emission latency histograms of the ASR, if enabled
+        self.latency_stats = LatencyStatsHook() if config.get("latency_stats") else None
+        # Uncommitted words shown in the partial transcripts must have survived this many ASR updates (0 = commits only)
+        self.partial_min_stability = config.get("partial_min_stability", 1)
+        # Silero VAD of the voice activity controller: "torch" (by torch.hub unless vad_model_path is set) or "onnx" (local file, no torch)
+        self.vad_backend = config.get("vad_backend", "torch")
+        self.vad_model_path = config.get("vad_model_path")
+        # Skip the VAD model on clearly silent audio, most of a call is silence or the other party talking
+        self.vad_gate = config.get("vad_gate", False)
         self.buffer = []  # For buffering recognized text
+        self.last_partial = None  # Last text sent to on_partial
         self.last_update_time = None  # Last time a word was added to the buffer
-
-        # Initialize the Whisper ASR model
+        self.endpointer = None  # Endpointer of the utterance in the buffer, if endpointing
+
+        # Initialize the Whisper ASR model. The loaded model is shared by all the sessions through the model pool.
+        if config.get("model_pool_max_mb"):
+            model_pool.max_bytes = config["model_pool_max_mb"] * 2**20
+        self.compute_type = config.get("compute_type", "int8")
+        self.use_vad = config.get("use_vad", False)
+        self.warmup = config.get("warmup", True)
+        self.streaming = False  # transcribe_stream is running and uses the model
+        self.model = None
+        self._load_model()
+
+    def _load_model(self):
+        """
+        Get the Whisper ASR model from the model pool, loading and warming it up if it is not there.
+        """
         self.model = FasterWhisperASR(
             lan=self.language_code,
             modelsize=self.model_size,
+            device=self.device,
+            compute_type=self.compute_type,
         )
-        if config.get("use_vad"):
+        if self.use_vad:
             self.model.use_vad()
+        if self.warmup and self.model.new_model:
+            # the first transcribe is much slower than the others, so it is not left to the first utterance.
+            # A model from the pool was warmed up when it was loaded.
+            logger.info(f"Whisper warmup took {warmup(self.model):.2f} seconds")
+
+    def _release_model(self):
+        """
+        Return the model to the model pool, which may drop it. A next transcription gets it again.
+        """
+        if self.model is not None:
+            self.model.release()
+            self.model = None
 
     async def transcribe_stream(
         self, on_partial: Callable[[str], None], on_final: Callable[[str], None]
@@ -118,40 +171,77 @@ class WhisperStreamingTranscriber:
         This function:
           - Captures audio chunks asynchronously from the mic.
           - Processes each chunk with FasterWhisperASR.
-          - Buffers the text until a silence timeout or natural sentence break occurs.
+          - Buffers the text until the end of the utterance: the end of speech detected by the VAD followed by
+            an adaptive trailing silence (if endpointing is enabled), or a silence timeout.
 
         Args:
             on_partial: Callback function for partial transcripts.
             on_final: Callback function for final transcripts.
         """
         self.transcription_started = True
+        self.streaming = True
+        try:
+            await self._transcribe_stream(on_partial, on_final)
+        finally:
+            # the processor of the session is discarded, nothing uses the model until the next transcription
+            self.streaming = False
+            self._release_model()
+
+    async def _transcribe_stream(
+        self, on_partial: Callable[[str], None], on_final: Callable[[str], None]
+    ) -> None:
+        """
+        The transcription session of transcribe_stream, with its own ASR processor.
+        """
+        if self.model is None:
+            self._load_model()
 
         # Create an ASR processor for this transcription session
+        # with a target latency, the chunk size follows the measured transcribe time instead of being fixed
+        chunk_controller = None
+        if self.target_latency:
+            chunk_controller = AdaptiveChunkController(self.target_latency, initial=self.online_chunk_size)
         online_asr_processor = VACOnlineASRProcessor(
-            online_chunk_size=1,
+            online_chunk_size=self.online_chunk_size,
             asr=self.model,
             tokenizer=None,
             buffer_trimming=("segment", 15),
             logfile=None,
+            chunk_controller=chunk_controller,
+            hook=self.latency_stats,
+            vad_model=load_vad_model(self.vad_backend, self.vad_model_path),
+            vad_gate=self.vad_gate,
+            max_lag=self.max_lag,
         )
+        if self.endpointing:
+            self.endpointer = Endpointer(min_silence=self.endpoint_min_silence, max_silence=self.endpoint_max_silence)
 
-        async for audio_chunk in self._get_audio_chunk_from_stream():
+        async for audio in self._get_audio_chunk_from_stream(online_asr_processor):
             if not self.transcription_started:
                 break
-            await self._process_audio_chunk(audio_chunk, online_asr_processor, on_partial)
+            await self._process_audio_chunk(audio, online_asr_processor, on_partial)
 
-            # Check for silence timeout
-            if self.last_update_time and time() - self.last_update_time > self.silence_timeout:
+            # End of the utterance: after the end of speech detected by the VAD and the adaptive silence window,
+            # or at the latest after the silence timeout
+            if self.endpointer is not None and self.endpointer.complete(online_asr_processor.trailing_silence()):
+                await self._finalize_buffer(on_final)
+            elif self.last_update_time and time() - self.last_update_time > self.silence_timeout:
                 await self._finalize_buffer(on_final)
 
         await self._finalize_buffer(on_final)
+        if self.latency_stats is not None:
+            logger.info(f"Whisper latency stats: {self.latency_stats.summary()}")
         final_text = online_asr_processor.flush().strip()
         if final_text:
             logger.info(f"Finalized sentence: {final_text}")
             on_final(final_text)
 
-    async def _get_audio_chunk_from_stream(self) -> AsyncGenerator[bytes, None]:
-        audio_queue = asyncio.Queue()
+    async def _get_audio_chunk_from_stream(self, processor: VACOnlineASRProcessor) -> AsyncGenerator[np.ndarray, None]:
+        """
+        Yields the microphone audio as float32 arrays. All the audio captured while the previous chunk was being processed
+        comes at once, so that the ASR doesn't fall more and more behind the speaker.
+        """
+        audio_queue = IngestQueue(self.backpressure, max_lag=self.max_lag, skip=processor.skip)
         loop = asyncio.get_running_loop()
 
         def callback(indata: np.ndarray, frames: int, time_info: dict, status: sd.CallbackFlags) -> None:
@@ -160,7 +250,8 @@ class WhisperStreamingTranscriber:
             """
             if status:
                 logger.warning(f"Sounddevice status: {status}")
-            asyncio.run_coroutine_threadsafe(audio_queue.put(indata.copy()), loop)
+            # Convert raw 16-bit PCM to the float32 audio needed for Whisper
+            loop.call_soon_threadsafe(audio_queue.put, pcm16_to_float32(indata))
 
         stream = sd.InputStream(
             samplerate=self.sample_rate,
@@ -171,26 +262,31 @@ class WhisperStreamingTranscriber:
         )
 
         with stream:
-            while self.transcription_started:
-                yield await audio_queue.get()
+            try:
+                while self.transcription_started:
+                    # copied, because the queue reuses its memory for the audio captured meanwhile
+                    yield (await audio_queue.get()).copy()
+            finally:
+                if audio_queue.falling_behind_events:
+                    logger.warning(
+                        f"Whisper fell behind real time {audio_queue.falling_behind_events} times, "
+                        f"max lag {audio_queue.max_lag_seen:.2f} s, skipped {audio_queue.skipped:.2f} s of non-speech"
+                    )
 
     async def _process_audio_chunk(
-        self, audio_chunk: bytes, processor: VACOnlineASRProcessor, on_partial: Callable[[str], None]
+        self, audio: np.ndarray, processor: VACOnlineASRProcessor, on_partial: Callable[[str], None]
     ) -> None:
         """
         Process a single audio chunk using FasterWhisperASR.
         Buffers the recognized text until a silence timeout or natural sentence break occurs.
+        The partial transcript is the buffered text followed by the speculative (not yet committed) words,
+        so it updates at every ASR iteration rather than only when words are committed.
 
         Args:
-            audio_chunk: The audio chunk to process.
+            audio: The float32 audio chunk to process.
             processor: The ASR processor.
             on_partial: Callback function for partial transcripts.
         """
-            # Convert raw audio to the format needed for Whisper
-        file_like = io.BytesIO(audio_chunk)
-        with sf.SoundFile(file_like, channels=1, samplerate=self.sample_rate, format="RAW", subtype="PCM_16") as sfile:
-            audio, _ = librosa.load(sfile, sr=self.sample_rate, mono=True, dtype=np.float32)
-
         async with self.model_lock:
             # Insert chunk, run the ASR
             processor.insert_audio_chunk(audio)
@@ -198,11 +294,27 @@ class WhisperStreamingTranscriber:
 
             # output is typically (start_time, end_time, text)
             # e.g.: (0.316, 1.196, "Hello world")
+            speculative = processor.partial() if self.partial_min_stability or self.endpointer is not None else []
+
         if output and output[0] is not None and output[2]:
             recognized_text = output[2].strip()
-            on_partial(recognized_text)
             self.last_update_time = time()  # Update the time of last recognition
             self.buffer.append(recognized_text)  # Add the text to the buffer
+            if self.endpointer is not None:
+                self.endpointer.commit(output[0], output[1], recognized_text)
+        if self.endpointer is not None:
+            self.endpointer.hypothesis(speculative)
+
+        # The tail of the hypothesis stops at the first word that is not stable enough yet
+        tail = []
+        for _, _, word, stability in (speculative if self.partial_min_stability else []):
+            if stability < self.partial_min_stability:
+                break
+            tail.append(word)
+        partial_text = " ".join(self.buffer + ["".join(tail).strip()]).strip()
+        if partial_text and partial_text != self.last_partial:
+            self.last_partial = partial_text
+            on_partial(partial_text)
 
     async def _finalize_buffer(self, on_final: Callable[[str], None]) -> None:
         """
@@ -210,16 +322,22 @@ class WhisperStreamingTranscriber:
         """
         if self.buffer:
             final_sentence = " ".join(self.buffer).strip()
+            self.last_partial = None
             if final_sentence:
                 print(f"[Whisper] Finalized sentence: {final_sentence}")
                 on_final(final_sentence)
             self.buffer = []
+        if self.endpointer is not None:
+            self.endpointer.reset()
 
     def stop_transcription(self):
         """
         Stop the transcription process.
         """
         self.transcription_started = False
+        if not self.streaming:
+            # otherwise transcribe_stream releases it after its last flush
+            self._release_model()
 
 
 class AWSStreamingTranscriber:
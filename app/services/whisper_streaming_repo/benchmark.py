@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""Offline benchmark of streaming ASR latency and accuracy.
+
+It runs the whisper_online simulation on every WAV file of a directory, in the offline, comp_unaware and simultaneous modes,
+and reports WER, first-word latency, commit latency percentiles and real-time factor (RTF) of each configuration.
+First-word latency is the emission time of the first output minus its beginning timestamp, commit latency is the emission time
+of each output minus its end timestamp; they are not reported for the offline mode. RTF is the time spent in process_iter divided by the audio duration.
+
+The directory contains pairs of files: name.wav (16kHz mono) and name.txt with the reference transcript.
+Optional name.words contains the reference word alignment, one "beg end word" line per word, in seconds. It is used only by the fake backend.
+
+A configuration is a string of the shared whisper_online options, e.g. --config="" --config="--tail-decoding" compares the default
+with tail decoding. With --fake-asr, the deterministic FakeASR backend is used instead of Whisper, so it runs on CPU without a model.
+"""
+from whisper_online import *
+
+import sys
+import os
+import re
+import json
+import shlex
+import argparse
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class FakeASR(ASRBase):
+    """Deterministic ASR backend for benchmarking the streaming logic without a model.
+
+    It "recognizes" the reference words that lie in the transcribed audio, given the position of the audio in the stream
+    (audio_end, set by the benchmark before each iteration). A word is recognized if it ends at least lookahead seconds before
+    the end of the audio, like Whisper that needs some right context. A word that is still being spoken is returned truncated,
+    so that LocalAgreement has unstable hypotheses to deal with. Words are grouped into segments split at pauses.
+    rtf: the transcribe call sleeps rtf * audio duration, to simulate the computation time.
+    """
+
+    sep = " "
+
+    def __init__(self, words, lan="en", lookahead=0.3, rtf=0.0, logfile=sys.stderr):
+        self.words = words  # [(beg, end, "word"), ...]
+        self.lookahead = lookahead
+        self.rtf = rtf
+        self.audio_end = 0.0
+        super().__init__(lan, logfile=logfile)
+
+    def load_model(self, modelsize=None, cache_dir=None, model_dir=None):
+        return None
+
+    def transcribe(self, audio, init_prompt="", **kw):
+        duration = len(audio)/16000
+        if self.rtf:
+            time.sleep(self.rtf*duration)
+        beg = self.audio_end - duration
+        segments = []
+        last_end = None
+        for b, e, w in self.words:
+            if b < beg or b >= self.audio_end:
+                continue
+            if e > self.audio_end - self.lookahead:
+                w = w[:max(1, len(w)//2)]  # not yet complete
+                e = self.audio_end - beg
+                b = b - beg
+            else:
+                b, e = b - beg, e - beg
+            if last_end is None or b - last_end > 0.5:
+                segments.append([])
+            segments[-1].append((b, e, " "+w if self.sep == "" else w))
+            last_end = e
+            if e >= self.audio_end - beg:
+                break
+        return segments
+
+    def ts_words(self, segments):
+        return [w for s in segments for w in s]
+
+    def segments_end_ts(self, segments):
+        return [s[-1][1] for s in segments]
+
+    def use_vad(self):
+        pass
+
+    def set_translate_task(self):
+        pass
+
+
+def load_dataset(path):
+    """returns [(name, wav path, reference text, reference words or None), ...]"""
+    items = []
+    for f in sorted(os.listdir(path)):
+        if not f.endswith(".wav"):
+            continue
+        name = f[:-4]
+        txt = os.path.join(path, name+".txt")
+        if not os.path.isfile(txt):
+            logger.warning(f"{name}: no reference transcript, skipping")
+            continue
+        with open(txt) as fh:
+            ref = fh.read()
+        words = None
+        wf = os.path.join(path, name+".words")
+        if os.path.isfile(wf):
+            words = []
+            with open(wf) as fh:
+                for line in fh:
+                    b, e, w = line.split(maxsplit=2)
+                    words.append((float(b), float(e), w.strip()))
+        items.append((name, os.path.join(path, f), ref, words))
+    return items
+
+
+def spread_words(text, duration):
+    """a uniform alignment of the reference words over the audio, when no .words file is available"""
+    words = text.split()
+    if not words:
+        return []
+    step = duration/len(words)
+    return [(i*step, (i+0.8)*step, w) for i, w in enumerate(words)]
+
+
+def normalize(text):
+    return re.sub(r"[^\w\s']", " ", text.lower()).split()
+
+
+def word_errors(ref, hyp):
+    """returns (edit distance between the word sequences, number of reference words)"""
+    r, h = normalize(ref), normalize(hyp)
+    d = list(range(len(h)+1))
+    for i in range(1, len(r)+1):
+        prev, d[0] = d[0], i
+        for j in range(1, len(h)+1):
+            cur = min(d[j]+1, d[j-1]+1, prev+(r[i-1] != h[j-1]))
+            prev, d[j] = d[j], cur
+    return d[len(h)], len(r)
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+# the processors' own log (e.g. VAC status) is not part of the benchmark output
+logfile = open(os.devnull, "w")
+
+def run_file(args, cfg_args, item, mode, asr_cache):
+    name, wav, ref, words = item
+    duration = audio_duration(wav)
+    if args.fake_asr:
+        asr = FakeASR(words if words is not None else spread_words(ref, duration), lan=cfg_args.lan, rtf=args.fake_rtf)
+        asr, online = online_factory(cfg_args, asr, logfile=logfile)
+        on_audio = lambda end: setattr(asr, "audio_end", end)
+    else:
+        key = (cfg_args.backend, cfg_args.model, cfg_args.lan, cfg_args.task, cfg_args.vad, cfg_args.model_dir, cfg_args.batch_size)
+        if key not in asr_cache:
+            asr, _ = asr_factory(cfg_args, logfile=logfile)
+            asr.transcribe(load_audio_chunk(wav, 0, 1))  # warm up
+            asr_cache[key] = asr
+        asr, online = online_factory(cfg_args, asr_cache[key], logfile=logfile)
+        on_audio = None
+    min_chunk = cfg_args.vac_chunk_size if cfg_args.vac else cfg_args.min_chunk_size
+
+    outputs, processing_time = simulate(online, wav, min_chunk, mode=mode, on_audio=on_audio)
+
+    hyp = online.asr.sep.join(o[3] for o in outputs)
+    errors, n_ref = word_errors(ref, hyp)
+    if mode == "offline":
+        outputs = []  # the whole file is available at once, latency is not defined
+    return {
+        "file": name,
+        "duration": duration,
+        "errors": errors,
+        "ref_words": n_ref,
+        "first_word_latency": outputs[0][0] - outputs[0][1] if outputs else None,
+        "commit_latencies": [now - end for now, beg, end, text in outputs],
+        "processing_time": processing_time,
+    }
+
+
+def summarize(results):
+    errors = sum(r["errors"] for r in results)
+    n_ref = sum(r["ref_words"] for r in results)
+    latencies = [l for r in results for l in r["commit_latencies"]]
+    first = [r["first_word_latency"] for r in results if r["first_word_latency"] is not None]
+    duration = sum(r["duration"] for r in results)
+    return {
+        "files": len(results),
+        "wer": errors/n_ref if n_ref else None,
+        "first_word_latency": float(np.mean(first)) if first else None,
+        "commit_latency_p50": percentile(latencies, 50),
+        "commit_latency_p90": percentile(latencies, 90),
+        "commit_latency_p99": percentile(latencies, 99),
+        "rtf": sum(r["processing_time"] for r in results)/duration if duration else None,
+    }
+
+
+def format_row(cfg, mode, s):
+    def f(x, fmt="%.3f"):
+        return "-" if x is None else fmt % x
+    return "\t".join([cfg or "(default)", mode, str(s["files"]), f(s["wer"]), f(s["first_word_latency"]),
+        f(s["commit_latency_p50"]), f(s["commit_latency_p90"]), f(s["commit_latency_p99"]), f(s["rtf"])])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('data_dir', type=str, help="Directory with name.wav and name.txt reference transcript files.")
+    parser.add_argument('--modes', type=str, default="offline,comp_unaware,simultaneous", help="Comma-separated simulation modes to run.")
+    parser.add_argument('--config', type=str, action="append", default=None, help="Additional whisper_online options of one configuration, as one string. Can be repeated. Default is one configuration with no additional options.")
+    parser.add_argument('--fake-asr', action="store_true", default=False, help="Use the deterministic fake ASR backend instead of Whisper.")
+    parser.add_argument('--fake-rtf', type=float, default=0.0, help="Simulated computation time of the fake backend, as real-time factor.")
+    parser.add_argument('--json', type=str, default=None, help="Save the per-file and summary results to this JSON file.")
+    add_shared_args(parser)
+    args = parser.parse_args()
+    set_logging(args, logger, other="")
+    audio_cache.configure(args.audio_cache_mb, args.audio_sidecar_dir)
+
+    items = load_dataset(args.data_dir)
+    if not items:
+        logger.error(f"No wav files with reference transcripts in {args.data_dir}. Exiting.")
+        sys.exit(1)
+
+    base_argv = sys.argv[1:]
+    report = []
+    asr_cache = {}
+    print("\t".join(["config", "mode", "files", "WER", "first_word_latency", "commit_p50", "commit_p90", "commit_p99", "RTF"]), flush=True)
+    for cfg in (args.config or [""]):
+        cfg_args = parser.parse_args(base_argv + shlex.split(cfg))
+        for mode in args.modes.split(","):
+            results = [run_file(args, cfg_args, item, mode, asr_cache) for item in items]
+            s = summarize(results)
+            print(format_row(cfg, mode, s), flush=True)
+            report.append({"config": cfg, "mode": mode, "summary": s, "files": results})
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
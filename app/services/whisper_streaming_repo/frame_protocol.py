@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+"""Length-prefixed binary framing of the streaming server protocol.
+
+A client selects this protocol by sending MAGIC as the very first bytes of
+the connection; a client that starts sending audio directly uses the line
+protocol of line_packet. The server answers MAGIC with a HELLO frame.
+
+Every message is a frame:
+
+  - 1 byte message type, 4 bytes big-endian payload length (HEADER)
+
+  - the payload
+
+Messages:
+
+  - HELLO (server): JSON {"version": 1, "sample_rate": 16000, "session": token}.
+    The session token is there if the server keeps the state of dropped sessions.
+
+  - AUDIO (client): raw 16-bit little-endian mono PCM at the sample rate
+
+  - END (client): no more audio, the server sends the rest of the transcript and closes
+
+  - RESULT (server): JSON {"beg": ms, "end": ms, "text": str, "committed": bool}.
+    A committed result is final. A non-committed one is the speculative transcript
+    of the uncommitted audio, and it is replaced by the next result.
+
+  - ERROR (server): JSON {"error": str}
+
+  - EVENT (server): JSON {"event": str, ...}, e.g. {"event": "falling_behind", "lag": seconds}
+    when the processing of the session is slower than real time
+
+  - RESUME (client): JSON {"session": token, "last_end": ms}, the first frame after HELLO.
+    It continues a session whose connection was closed without END, within the server's
+    resume timeout. The server answers {"event": "resumed", "session": token, "position": ms}
+    and sends again the committed results that end after last_end. The client sends the
+    audio from the position on, i.e. the audio that the server has not received.
+    An unknown or expired session is answered by ERROR.
+
+The receiver reads the header and then exactly the payload, no scanning for
+delimiters is needed. The payload length is limited, MAX_AUDIO_FRAME for AUDIO
+and MAX_CONTROL_FRAME for the other messages. The server answers a larger frame
+by ERROR and closes the connection, without reading its payload.
+"""
+
+import json
+import struct
+
+MAGIC = b"WSF\x01"
+VERSION = 1
+
+HEADER = struct.Struct("!BI")
+
+HELLO = 0
+AUDIO = 1
+END = 2
+RESULT = 3
+ERROR = 4
+EVENT = 5
+RESUME = 6
+
+MAX_AUDIO_FRAME = 4*2**20  # bytes, 2 minutes of audio
+MAX_CONTROL_FRAME = 64*2**10
+
+
+class FrameTooLarge(ValueError):
+    """the header of a frame declares a payload over the size limit of its message type"""
+
+
+def max_payload(msg_type):
+    return MAX_AUDIO_FRAME if msg_type == AUDIO else MAX_CONTROL_FRAME
+
+
+def _check_length(msg_type, length):
+    if length > max_payload(msg_type):
+        raise FrameTooLarge(f"frame of type {msg_type} with {length} bytes exceeds the limit of {max_payload(msg_type)} bytes")
+
+
+def encode_frame(msg_type, payload=b""):
+    return HEADER.pack(msg_type, len(payload)) + payload
+
+
+def encode_json(msg_type, obj):
+    return encode_frame(msg_type, json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def encode_result(beg, end, text, committed=True):
+    return encode_json(RESULT, {"beg": round(beg), "end": round(end), "text": text, "committed": committed})
+
+
+def decode_json(payload):
+    return json.loads(payload.decode("utf-8"))
+
+
+async def read_frame(reader):
+    """Reads one frame from an asyncio StreamReader.
+
+    Returns:
+        (message type, payload bytes), or None if the connection has been closed.
+    Raises:
+        FrameTooLarge if the payload length is over the limit, the payload is not read then.
+    """
+    try:
+        msg_type, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+        _check_length(msg_type, length)
+        payload = await reader.readexactly(length) if length else b""
+    except (EOFError, ConnectionError):  # IncompleteReadError is an EOFError
+        return None
+    return msg_type, payload
+
+
+def send_frame(socket, msg_type, payload=b""):
+    """Sends one frame over a blocking socket."""
+    socket.sendall(encode_frame(msg_type, payload))
+
+
+def _recv_exactly(socket, n):
+    data = bytearray(n)
+    view = memoryview(data)
+    pos = 0
+    while pos < n:
+        r = socket.recv_into(view[pos:])
+        if not r:
+            return None
+        pos += r
+    return data
+
+
+def recv_frame(socket):
+    """Receives one frame from a blocking socket.
+
+    Returns:
+        (message type, payload bytes), or None if the connection has been closed.
+    Raises:
+        FrameTooLarge if the payload length is over the limit.
+    """
+    header = _recv_exactly(socket, HEADER.size)
+    if header is None:
+        return None
+    msg_type, length = HEADER.unpack(header)
+    _check_length(msg_type, length)
+    payload = _recv_exactly(socket, length) if length else b""
+    if payload is None:
+        return None
+    return msg_type, bytes(payload)
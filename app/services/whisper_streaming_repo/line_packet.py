@@ -31,19 +31,21 @@ def send_one_line(socket, text, pad_zeros=False):
         socket: a socket object.
         text: string containing a line of text for transmission.
     """
+    socket.sendall(encode_one_line(text, pad_zeros=pad_zeros))
+
+
+def encode_one_line(text, pad_zeros=False):
+    """Returns the bytes that send_one_line sends for the given text, e.g.
+    for writing them to an asyncio stream.
+    """
     text.replace('\0', '\n')
     lines = text.splitlines()
     first_line = '' if len(lines) == 0 else lines[0]
     # TODO Is there a better way of handling bad input than 'replace'?
     data = first_line.encode('utf-8', errors='replace') + b'\n' + (b'\0' if pad_zeros else b'')
-    for offset in range(0, len(data), PACKET_SIZE):
-        bytes_remaining = len(data) - offset
-        if bytes_remaining < PACKET_SIZE:
-            padding_length = PACKET_SIZE - bytes_remaining
-            packet = data[offset:] + (b'\0' * padding_length if pad_zeros else b'')
-        else:
-            packet = data[offset:offset+PACKET_SIZE]
-        socket.sendall(packet)
+    if pad_zeros and len(data) % PACKET_SIZE:
+        data += b'\0' * (PACKET_SIZE - len(data) % PACKET_SIZE)
+    return data
 
 
 def receive_one_line(socket):
@@ -64,7 +66,7 @@ def receive_one_line(socket):
         A string representing a single line with a terminating newline or
         None if the connection has been closed.
     """
-    data = b''
+    data = bytearray()  # appending is amortized linear, unlike bytes
     while True:
         packet = socket.recv(PACKET_SIZE)
         if not packet:  # Connection has been closed.
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""Load generator for whisper_online_server.
+
+It replays N sessions at once, each one streams a WAV file at real-time pace (or at --speed times real time) and timestamps
+every result that it receives. The files are assigned to the sessions in a round robin. As from a live source, a chunk is
+sent when all its audio exists, i.e. at the end of its interval.
+
+Reported per session and aggregated:
+  - first-result latency: arrival of the first committed result minus the time when the audio at its end timestamp was
+    spoken, so it includes the wait for the rest of its chunk,
+  - commit latency percentiles, the same for every committed result,
+  - time to the first result from the connection,
+  - dropped sessions: refused or closed by the server before it sent the whole transcript, or failed with a connection error,
+  - server-side real-time factor, if --metrics-url of the server's metrics endpoint is given.
+
+Example:
+  python3 load_generator.py --sessions 8 --speed 1 samples/*.wav
+"""
+from whisper_online import load_audio
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import logging
+import urllib.request
+import numpy as np
+
+import frame_protocol
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def pcm16(audio):
+    return (np.clip(audio, -1.0, 32767/32768)*32768).astype('<i2').tobytes()
+
+
+async def run_session(args, index, name, pcm):
+    """Streams one file and collects the results. Returns a dict of the session's measurements."""
+    r = {"session": index, "file": name, "audio_seconds": len(pcm)/32000, "results": 0, "partials": 0,
+         "dropped": False, "error": None, "first_result_latency": None, "time_to_first_result": None, "commit_latencies": []}
+    try:
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+    except OSError as e:
+        r["dropped"], r["error"] = True, repr(e)
+        return r
+    start = time.time()
+    sent = False  # all the audio was sent
+
+    def on_result(beg_ms, end_ms, committed):
+        now = time.time()
+        if not committed:
+            r["partials"] += 1
+            return
+        # when the audio at the end of the result was spoken
+        latency = now - (start + end_ms/1000/args.speed if args.speed else start)
+        if r["results"] == 0:
+            r["first_result_latency"] = latency
+            r["time_to_first_result"] = now - start
+        r["results"] += 1
+        r["commit_latencies"].append(latency)
+
+    async def send():
+        nonlocal sent
+        chunk = int(args.chunk*16000)*2
+        if args.protocol == "framed":
+            writer.write(frame_protocol.MAGIC)
+        for pos in range(0, len(pcm), chunk):
+            if args.speed:
+                # paced by the absolute time, so that the delays don't accumulate. The chunk is sent at its end.
+                delay = start + min(pos+chunk, len(pcm))/32000/args.speed - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            data = pcm[pos:pos+chunk]
+            writer.write(frame_protocol.encode_frame(frame_protocol.AUDIO, data) if args.protocol == "framed" else data)
+            await writer.drain()
+        if args.protocol == "framed":
+            writer.write(frame_protocol.encode_frame(frame_protocol.END))
+        else:
+            writer.write_eof()
+        await writer.drain()
+        sent = True
+
+    async def receive():
+        if args.protocol == "framed":
+            while True:
+                f = await frame_protocol.read_frame(reader)
+                if f is None:
+                    break
+                if f[0] == frame_protocol.RESULT:
+                    m = frame_protocol.decode_json(f[1])
+                    on_result(m["beg"], m["end"], m["committed"])
+                elif f[0] == frame_protocol.ERROR:
+                    r["error"] = frame_protocol.decode_json(f[1])["error"]
+        else:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                beg, end, _ = line.decode("utf-8", errors="replace").split(" ", 2)
+                on_result(float(beg), float(end), True)
+
+    sender = asyncio.create_task(send())
+    try:
+        await receive()
+    except (ConnectionError, asyncio.IncompleteReadError) as e:
+        r["error"] = repr(e)
+    if not sent:
+        # the server closed the connection before the end of the audio
+        r["dropped"] = True
+        sender.cancel()
+    try:
+        await sender
+    except (ConnectionError, asyncio.CancelledError) as e:
+        r["dropped"] = True
+        r["error"] = r["error"] or repr(e)
+    writer.close()
+    r["duration"] = time.time() - start
+    return r
+
+
+def server_totals(url):
+    """processing and audio seconds totals from the server's metrics endpoint"""
+    totals = {}
+    with urllib.request.urlopen(url, timeout=5) as f:
+        for line in f.read().decode("utf-8").splitlines():
+            for name in ("whisper_processing_seconds_total", "whisper_audio_seconds_total"):
+                if line.startswith(name+" "):
+                    totals[name] = float(line.split()[1])
+    return totals
+
+
+async def run(args, files):
+    async def delayed(i):
+        await asyncio.sleep(i*args.ramp)
+        name, pcm = files[i % len(files)]
+        return await run_session(args, i, name, pcm)
+    return await asyncio.gather(*(delayed(i) for i in range(args.sessions)))
+
+
+def summarize(results, server_rtf=None):
+    ok = [r for r in results if not r["dropped"]]
+    latencies = [l for r in ok for l in r["commit_latencies"]]
+    first = [r["first_result_latency"] for r in ok if r["first_result_latency"] is not None]
+    ttfr = [r["time_to_first_result"] for r in ok if r["time_to_first_result"] is not None]
+    return {
+        "sessions": len(results),
+        "dropped": len(results) - len(ok),
+        "results": sum(r["results"] for r in ok),
+        "first_result_latency_mean": float(np.mean(first)) if first else None,
+        "first_result_latency_p90": percentile(first, 90),
+        "time_to_first_result_mean": float(np.mean(ttfr)) if ttfr else None,
+        "commit_latency_p50": percentile(latencies, 50),
+        "commit_latency_p90": percentile(latencies, 90),
+        "commit_latency_p99": percentile(latencies, 99),
+        "server_rtf": server_rtf,
+    }
+
+
+def f(x, fmt="%.3f"):
+    return "-" if x is None else fmt % x
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', type=str, nargs="+", help="WAV files or directories with WAV files to stream.")
+    parser.add_argument("--host", type=str, default='localhost')
+    parser.add_argument("--port", type=int, default=43007)
+    parser.add_argument("--sessions", type=int, default=1, help="Number of concurrent sessions.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Streaming speed as a multiple of real time. 0: as fast as possible.")
+    parser.add_argument("--chunk", type=float, default=0.1, help="Seconds of audio sent at once.")
+    parser.add_argument("--ramp", type=float, default=0.0, help="Seconds between the starts of the sessions.")
+    parser.add_argument("--protocol", type=str, default="line", choices=["line", "framed"], help="The server protocol, see frame_protocol.py.")
+    parser.add_argument("--metrics-url", type=str, default=None, help="The server's metrics endpoint, e.g. http://localhost:9100/metrics, for the server-side real-time factor.")
+    parser.add_argument("--json", type=str, default=None, help="Save the per-session and aggregate results to this JSON file.")
+    parser.add_argument("-l", "--log-level", dest="log_level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help="Set the log level", default='INFO')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s\t%(message)s', level=args.log_level)
+
+    paths = []
+    for p in args.files:
+        if os.path.isdir(p):
+            paths += sorted(os.path.join(p, x) for x in os.listdir(p) if x.endswith(".wav"))
+        else:
+            paths.append(p)
+    if not paths:
+        logger.error("No WAV files. Exiting.")
+        sys.exit(1)
+    files = [(os.path.basename(p), pcm16(load_audio(p))) for p in paths]
+
+    before = server_totals(args.metrics_url) if args.metrics_url else None
+    results = asyncio.run(run(args, files))
+    server_rtf = None
+    if before is not None:
+        after = server_totals(args.metrics_url)
+        audio = after["whisper_audio_seconds_total"] - before["whisper_audio_seconds_total"]
+        if audio > 0:
+            server_rtf = (after["whisper_processing_seconds_total"] - before["whisper_processing_seconds_total"])/audio
+
+    print("\t".join(["session", "file", "audio", "results", "first_result_latency", "commit_p50", "commit_p90", "dropped"]))
+    for r in results:
+        print("\t".join([str(r["session"]), r["file"], f(r["audio_seconds"], "%.1f"), str(r["results"]), f(r["first_result_latency"]),
+                         f(percentile(r["commit_latencies"], 50)), f(percentile(r["commit_latencies"], 90)), "yes" if r["dropped"] else "no"]))
+    s = summarize(results, server_rtf)
+    print()
+    for k, v in s.items():
+        print(f"{k}\t{v if isinstance(v, int) else f(v)}")
+
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump({"summary": s, "sessions": results}, fh, indent=2)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Metrics of whisper_online_server in the Prometheus text format, served over HTTP on a separate port.
+
+The processing iterations of all sessions are aggregated by one LatencyStatsHook (RTF, emission latency, span histograms),
+the server counts the sessions, bytes in, results out, the inference queue depth and the ingest lag.
+"""
+from whisper_online import Histogram, LatencyStatsHook
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ServerMetrics:
+    """Counters and gauges of the server. They are updated in the event loop, the stats hook also in the inference threads."""
+
+    LAG_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+
+    def __init__(self, stats=None):
+        self.stats = stats if stats is not None else LatencyStatsHook()
+        self.sessions_active = 0
+        self.sessions_total = 0
+        self.sessions_refused = 0
+        self.sessions_suspended = 0  # dropped sessions kept for their resume
+        self.sessions_resumed = 0
+        self.bytes_in = 0
+        self.results_out = 0
+        self.partials_out = 0
+        self.inference_queue_depth = 0  # iterations submitted to the inference threads and not finished
+        self.falling_behind = 0
+        self.lag = Histogram(self.LAG_BUCKETS)  # the ingest lag when an iteration starts
+        self.model_load_seconds = 0.0
+        self.warmup_seconds = 0.0
+        self.startup = {}  # phase: seconds
+
+    def exposition(self):
+        lines = []
+        def metric(name, kind, help, value):
+            lines.extend([f"# HELP whisper_{name} {help}", f"# TYPE whisper_{name} {kind}", f"whisper_{name} {value}"])
+        metric("sessions_active", "gauge", "Connected clients.", self.sessions_active)
+        metric("sessions_total", "counter", "Accepted clients.", self.sessions_total)
+        metric("sessions_refused_total", "counter", "Clients refused over the session limit.", self.sessions_refused)
+        metric("sessions_suspended", "gauge", "Dropped sessions kept for their resume.", self.sessions_suspended)
+        metric("sessions_resumed_total", "counter", "Sessions resumed by reconnected clients.", self.sessions_resumed)
+        metric("received_bytes_total", "counter", "Bytes of audio received.", self.bytes_in)
+        metric("results_total", "counter", "Committed results sent.", self.results_out)
+        metric("partial_results_total", "counter", "Speculative partial results sent.", self.partials_out)
+        metric("inference_queue_depth", "gauge", "Iterations waiting for or running on the model.", self.inference_queue_depth)
+        metric("falling_behind_total", "counter", "Times a session started falling behind real time.", self.falling_behind)
+        lines.extend(["# HELP whisper_ingest_lag_seconds Audio waiting for processing when an iteration starts.",
+                      "# TYPE whisper_ingest_lag_seconds histogram"])
+        lines.extend(self.lag.exposition("whisper_ingest_lag_seconds"))
+        metric("model_load_seconds", "gauge", "Time of loading the model at the start.", self.model_load_seconds)
+        metric("warmup_seconds", "gauge", "Time of the warmup at the start.", self.warmup_seconds)
+        lines.extend(["# HELP whisper_startup_phase_seconds Duration of the startup phases, the VAD is loaded in parallel with the ASR.",
+                      "# TYPE whisper_startup_phase_seconds gauge"])
+        lines.extend(f'whisper_startup_phase_seconds{{phase="{k}"}} {v}' for k, v in self.startup.items())
+        lines.extend(self.stats.exposition("whisper"))
+        return "\n".join(lines) + "\n"
+
+    async def handle_http(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # the headers are ignored
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] in (b"/", b"/metrics"):
+                body = self.exposition().encode("utf-8")
+                status = b"200 OK"
+            else:
+                body = b"not found\n"
+                status = b"404 Not Found"
+            writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         + b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        """starts the HTTP server, returns the asyncio server"""
+        server = await asyncio.start_server(self.handle_http, host, port)
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
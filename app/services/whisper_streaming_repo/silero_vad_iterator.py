@@ -1,4 +1,4 @@
-import torch
+import copy
 
 # This is copied from silero-vad's vad_utils.py:
 # https://github.com/snakers4/silero-vad/blob/f6b1294cb27590fb2452899df98fb234dfef1134/utils_vad.py#L340
@@ -54,6 +54,21 @@ class VADIterator:
         self.temp_end = 0
         self.current_sample = 0
 
+    # the recurrent state of the Silero model: _state, _context etc. of v5, _h and _c of v4
+    MODEL_STATE = ("_state", "_context", "_last_sr", "_last_batch_size", "_h", "_c")
+
+    def snapshot(self):
+        """the state of the stream as a picklable dict, including the model's recurrent state"""
+        model = {k: copy.deepcopy(getattr(self.model, k)) for k in self.MODEL_STATE if hasattr(self.model, k)}
+        return {"triggered": self.triggered, "temp_end": self.temp_end, "current_sample": self.current_sample, "model": model}
+
+    def restore(self, state):
+        self.triggered = state["triggered"]
+        self.temp_end = state["temp_end"]
+        self.current_sample = state["current_sample"]
+        for k, v in state["model"].items():
+            setattr(self.model, k, copy.deepcopy(v))
+
     def __call__(self, x, return_seconds=False):
         """
         x: torch.Tensor
@@ -62,6 +77,7 @@ class VADIterator:
         return_seconds: bool (default - False)
             whether return timestamps in seconds (default - samples)
         """
+        import torch  # only here, a model with window_probs (e.g. OnnxSileroVAD) is used without torch
 
         if not torch.is_tensor(x):
             try:
@@ -70,9 +86,12 @@ class VADIterator:
                 raise TypeError("Audio cannot be casted to tensor. Cast it manually")
 
         window_size_samples = len(x[0]) if x.dim() == 2 else len(x)
-        self.current_sample += window_size_samples
-
         speech_prob = self.model(x, self.sampling_rate).item()
+        return self.step(speech_prob, window_size_samples, return_seconds)
+
+    def step(self, speech_prob, window_size_samples, return_seconds=False):
+        """advances the stream by one window with the given speech probability"""
+        self.current_sample += window_size_samples
 
         if (speech_prob >= self.threshold) and self.temp_end:
             self.temp_end = 0
@@ -99,30 +118,181 @@ class VADIterator:
 # because Silero now requires exactly 512-sized audio chunks 
 
 import numpy as np
+
+class EnergyGate:
+    '''A cheap pre-gate of the VAD model: it marks the windows that are clearly silent by their RMS energy and zero-crossing
+    rate, computed for all windows at once. The thresholds follow the noise of the stream, learned from the windows that
+    the model found non-speech: a window is silent if its RMS is under margin times the noise floor and its zero-crossing
+    rate is not above the noise's (mean + 2 std), because that can be an unvoiced onset like "s". Until min_noise_windows
+    noise windows are seen, only digital silence (RMS under min_rms) is silent.
+    The noise floor follows a quieter window at once and a louder one slowly, up to max_floor, so it errs towards running the model.
+    '''
+
+    def __init__(self, margin=2.0, min_rms=1e-4, max_floor=0.02, adapt=0.05, min_noise_windows=16):
+        self.margin = margin
+        self.min_rms = min_rms
+        self.max_floor = max_floor
+        self.adapt = adapt
+        self.min_noise_windows = min_noise_windows
+        self.reset()
+
+    def reset(self):
+        self.floor = self.min_rms
+        self.zcr_mean = 0.0
+        self.zcr_var = 0.0
+        self.noise_windows = 0
+
+    @staticmethod
+    def features(windows):
+        """RMS and zero-crossing rate of every window, of an array of shape (n, window)"""
+        rms = np.sqrt(np.mean(np.square(windows), axis=1))
+        zcr = np.count_nonzero(np.diff(np.signbit(windows), axis=1), axis=1)/(windows.shape[1]-1)
+        return rms, zcr
+
+    def silent(self, rms, zcr):
+        silent = rms < self.min_rms
+        if self.noise_windows >= self.min_noise_windows:
+            silent |= (rms < self.margin*self.floor) & (zcr <= self.zcr_mean + 2*np.sqrt(self.zcr_var))
+        return silent
+
+    def update(self, rms, zcr):
+        """learns the noise from the features of non-speech windows"""
+        a = self.adapt
+        for r, z in zip(rms, zcr):
+            self.floor = min(max(r if r < self.floor else self.floor + a*(r - self.floor), self.min_rms), self.max_floor)
+            d = z - self.zcr_mean
+            self.zcr_mean += a*d
+            self.zcr_var = (1 - a)*(self.zcr_var + a*d*d)
+            self.noise_windows += 1
+
+
 class FixedVADIterator(VADIterator):
     '''It fixes VADIterator by allowing to process any audio length, not only exactly 512 frames at once.
     If audio to be processed at once is long and multiple voiced segments detected, 
     then __call__ returns the start of the first segment, and end (or middle, which means no end) of the last segment. 
+
+    The windows are converted to a tensor at once. If the model has window_probs(windows), e.g. a stream of BatchedVAD
+    in whisper_online, it gets all the windows in one call.
+
+    gate: an EnergyGate, or None. The model is not run on the windows that the gate finds silent, out of speech and after
+    HANGOVER silent windows, except the ONSET_CONTEXT windows before a non-silent one. They count as non-speech.
+    After skipped windows the model continues from a reset state, as at the beginning of a stream, which starts in silence too.
+    The skippable windows among the last ONSET_CONTEXT ones of a call are kept in the buffer until the next call shows
+    whether an onset follows them, so that the model gets the context of an onset also when it starts a call.
     '''
 
+    HANGOVER = 8  # windows, 256 ms
+    ONSET_CONTEXT = 2  # windows
+
+    def __init__(self, model, *a, gate=None, **kw):
+        self.gate = gate
+        super().__init__(model, *a, **kw)
+
     def reset_states(self):
         super().reset_states()
         self.buffer = np.array([],dtype=np.float32)
+        if self.gate is not None:
+            self.gate.reset()
+        self.silent_run = 0  # consecutive silent windows by the gate
+        self.skipped = False  # the last window was skipped
+        self.model_windows = 0
+        self.skipped_windows = 0
+
+    def snapshot(self):
+        state = super().snapshot()
+        state["buffer"] = self.buffer.copy()
+        state["silent_run"] = self.silent_run
+        state["skipped"] = self.skipped
+        if self.gate is not None:
+            state["gate"] = dict(vars(self.gate))
+        return state
+
+    def restore(self, state):
+        super().restore(state)
+        self.buffer = state["buffer"].copy()
+        self.silent_run = state.get("silent_run", 0)
+        self.skipped = state.get("skipped", False)
+        if self.gate is not None and "gate" in state:
+            vars(self.gate).update(state["gate"])
+
+    def _skippable(self, rms, zcr):
+        """the mask of the windows that the model may skip, if it is out of speech"""
+        silent = self.gate.silent(rms, zcr)
+        loud = ~silent
+        n = len(silent)
+        near_onset = np.zeros(n, dtype=bool)
+        for k in range(1, self.ONSET_CONTEXT+1):
+            near_onset[:n-k] |= loud[k:]
+        # the lengths of the runs of silent windows, continuing the run of the previous call
+        count = np.cumsum(silent)
+        last_loud = np.maximum.accumulate(np.where(loud, np.arange(n), -1))
+        run = np.where(last_loud >= 0, count - count[np.maximum(last_loud, 0)], count + self.silent_run)
+        return silent & ~near_onset & (run > self.HANGOVER), run
+
+    def _probs(self, windows):
+        if hasattr(self.model, "window_probs"):
+            return self.model.window_probs(windows)
+        import torch
+        return [self.model(w, self.sampling_rate).item() for w in torch.from_numpy(windows)]
 
     def __call__(self, x, return_seconds=False):
         self.buffer = np.append(self.buffer, x) 
+        n = len(self.buffer)//512
+        if n == 0:
+            return None
+        windows = np.ascontiguousarray(self.buffer[:512*n], dtype=np.float32).reshape(n, 512)
+        self.buffer = self.buffer[512*n:]
+        # the windows from held on are decided in the next call, if the stream is out of speech by then
+        held = n
+        if self.gate is not None:
+            rms, zcr = self.gate.features(windows)
+            skippable, run = self._skippable(rms, zcr)
+            while held > max(n - self.ONSET_CONTEXT, 0) and skippable[held-1]:
+                held -= 1
+        else:
+            skippable = np.zeros(n, dtype=bool)
+        heard = False
         ret = None
-        while len(self.buffer) >= 512:
-            r = super().__call__(self.buffer[:512], return_seconds=return_seconds)
-            self.buffer = self.buffer[512:]
-            if ret is None:
-                ret = r
-            elif r is not None:
-                if 'end' in r:
-                    ret['end'] = r['end']  # the latter end
-                if 'start' in r and 'end' in ret:  # there is an earlier start.
-                    # Remove end, merging this segment with the previous one.
-                    del ret['end']
+        i = 0
+        while i < n and (i < held or self.triggered):
+            # a run of skipped windows, or of the windows that the model evaluates in one call
+            j = i + 1
+            if skippable[i] and not self.triggered:
+                while j < held and skippable[j]:
+                    j += 1
+                self.current_sample += 512*(j-i)
+                self.skipped_windows += j-i
+                self.skipped = True
+                i = j
+                continue
+            while j < n and not skippable[j]:
+                j += 1
+            if self.skipped:
+                self.model.reset_states()
+                self.skipped = False
+            probs = self._probs(windows[i:j])
+            self.model_windows += j-i
+            for p in probs:
+                r = self.step(p, 512, return_seconds=return_seconds)
+                if ret is None:
+                    ret = r
+                elif r is not None:
+                    if 'end' in r:
+                        ret['end'] = r['end']  # the latter end
+                    if 'start' in r and 'end' in ret:  # there is an earlier start.
+                        # Remove end, merging this segment with the previous one.
+                        del ret['end']
+            if self.gate is not None:
+                noise = np.asarray(probs) < self.threshold - 0.15
+                self.gate.update(rms[i:j][noise], zcr[i:j][noise])
+                heard |= not noise.all()
+            i = j
+        if self.gate is not None:
+            self.buffer = np.append(windows[i:], self.buffer)
+            if heard:
+                self.silent_run = 0  # the model hears speech, the gate waits for HANGOVER windows again
+            elif i > 0:
+                self.silent_run = int(run[i-1])
         return ret if ret != {} else None
 
 if __name__ == "__main__":
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Silero VAD on onnxruntime, loaded from a local silero_vad.onnx file: no network access and no torch import.
+
+It is selected by --vac-backend onnx --vac-model-path silero_vad.onnx, see load_vad_model in whisper_online.
+
+parity() compares it with the torch model on a recording: the speech probabilities of all windows and the speech
+segments found by FixedVADIterator must agree. tests/test_silero_vad_onnx.py runs it on the model files given by
+SILERO_VAD_ONNX and SILERO_VAD_JIT.
+"""
+import copy
+import numpy as np
+
+
+class OnnxSileroVAD:
+    """The Silero VAD ONNX model (v5 with "state", or v4 with "h" and "c") with the interface of the torch model that
+    VADIterator uses: reset_states(), model(x, sr) for windows of shape (batch, 512), and window_probs(windows) for
+    FixedVADIterator, which then doesn't need torch.
+
+    The input (the window with the context of the previous one) is a preallocated array that is filled in place,
+    the state returned by a call is the input of the next one. Copies share the onnxruntime session, which is stateless,
+    and have their own state.
+    """
+
+    numpy = True  # the inputs and states are numpy arrays, not tensors
+
+    def __init__(self, path, sampling_rate=16000, session=None):
+        if sampling_rate not in (8000, 16000):
+            raise ValueError('Silero VAD does not support sampling rates other than [8000, 16000]')
+        if session is None:
+            import onnxruntime
+            opts = onnxruntime.SessionOptions()
+            opts.inter_op_num_threads = 1
+            opts.intra_op_num_threads = 1
+            session = onnxruntime.InferenceSession(path, sess_options=opts, providers=["CPUExecutionProvider"])
+        self.session = session
+        self.path = path
+        inputs = [i.name for i in session.get_inputs()]
+        self.v5 = "state" in inputs
+        if not self.v5 and "h" not in inputs:
+            raise ValueError(f"{path} is not a Silero VAD model, its inputs are {inputs}")
+        self.sampling_rate = sampling_rate
+        self.window = 512 if sampling_rate == 16000 else 256
+        self.context_size = (64 if sampling_rate == 16000 else 32) if self.v5 else 0
+        self._sr = np.array(sampling_rate, dtype=np.int64)
+        self.reset_states()
+
+    def reset_states(self, batch_size=1):
+        self._input = np.zeros((batch_size, self.context_size + self.window), dtype=np.float32)
+        if self.v5:
+            self._state = np.zeros((2, batch_size, 128), dtype=np.float32)
+            self._context = np.zeros((batch_size, self.context_size), dtype=np.float32)
+        else:
+            self._h = np.zeros((2, batch_size, 64), dtype=np.float32)
+            self._c = np.zeros((2, batch_size, 64), dtype=np.float32)
+        self._last_batch_size = batch_size
+
+    def __call__(self, x, sr):
+        """speech probabilities of shape (batch, 1) of one window of every stream in the batch"""
+        if sr != self.sampling_rate:
+            raise ValueError(f"the model was loaded for {self.sampling_rate} Hz, not {sr}")
+        x = np.asarray(x, dtype=np.float32)
+        if x.ndim == 1:
+            x = x[None]
+        if x.shape[-1] != self.window:
+            raise ValueError(f"Silero VAD takes windows of {self.window} samples, not {x.shape[-1]}")
+        batch_size = len(x)
+        if batch_size != self._last_batch_size:
+            self.reset_states(batch_size)
+        if len(self._input) != batch_size:
+            # the states of a batch of streams were set from outside, see BatchedVAD
+            self._input = np.zeros((batch_size, self.context_size + self.window), dtype=np.float32)
+        c = self.context_size
+        self._input[:, c:] = x
+        if self.v5:
+            self._input[:, :c] = self._context
+            out, self._state = self.session.run(None, {"input": self._input, "state": self._state, "sr": self._sr})
+            self._context = self._input[:, -c:].copy()
+        else:
+            out, self._h, self._c = self.session.run(None, {"input": self._input, "sr": self._sr, "h": self._h, "c": self._c})
+        return out
+
+    def window_probs(self, windows):
+        """speech probabilities of the consecutive windows of one stream, an array of shape (n, window)"""
+        probs = np.empty(len(windows), dtype=np.float32)
+        for i, w in enumerate(windows):
+            probs[i] = self(w[None], self.sampling_rate)[0, 0]
+        return probs
+
+    def __deepcopy__(self, memo):
+        c = copy.copy(self)
+        for k in ("_input", "_state", "_context", "_h", "_c"):
+            if hasattr(self, k):
+                setattr(c, k, getattr(self, k).copy())
+        return c
+
+
+def parity(onnx_model, torch_model, audio, threshold=0.5):
+    """Runs both models on the audio from a fresh state. Returns the maximal difference of the window probabilities,
+    the fraction of the windows where they disagree about speech, and whether FixedVADIterator finds the same segments."""
+    import torch
+    from silero_vad_iterator import FixedVADIterator
+    n = len(audio)//512
+    windows = np.ascontiguousarray(audio[:512*n], dtype=np.float32).reshape(n, 512)
+    onnx_model.reset_states()
+    p_onnx = onnx_model.window_probs(windows)
+    torch_model.reset_states()
+    with torch.no_grad():
+        p_torch = np.array([torch_model(torch.from_numpy(w), 16000).item() for w in windows], dtype=np.float32)
+
+    def segments(model):
+        vad = FixedVADIterator(model, threshold=threshold)
+        found = []
+        for i in range(0, len(audio), 1600):
+            r = vad(audio[i:i+1600])
+            if r is not None:
+                found.append(r)
+        return found
+
+    return float(np.max(np.abs(p_onnx - p_torch))) if n else 0.0, \
+        float(np.mean((p_onnx >= threshold) != (p_torch >= threshold))) if n else 0.0, \
+        segments(onnx_model) == segments(torch_model)
+
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# the modules of whisper_streaming_repo import each other as top-level modules, as when run from its directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class EnergyVAD:
+    """Stand-in for the Silero model without torch: a window is loud if its RMS is above 0.05, and the speech probability
+    is the mean of its loudness and the previous probability, carried in the recurrent state _state as in the Silero model.
+    Any mix-up of the states of the streams in a batch changes the probabilities."""
+
+    numpy = True
+
+    def __init__(self):
+        self.reset_states()
+
+    def reset_states(self, batch_size=1):
+        self._state = np.zeros((2, batch_size, 1), dtype=np.float32)
+
+    def __call__(self, x, sr):
+        loud = (np.sqrt(np.mean(np.square(x), axis=-1, keepdims=True)) > 0.05).astype(np.float32)
+        p = (loud + self._state[0])/2
+        self._state = np.stack([p, p])
+        return p
+
+    def window_probs(self, windows):
+        return np.array([self(w[None], 16000)[0, 0] for w in windows], dtype=np.float32)
+
+
+@pytest.fixture
+def energy_vad():
+    return EnergyVAD()
+
+
+def speech_and_silence(pattern, seed=0):
+    """16kHz audio of noise bursts ("speech") and silence: pattern is [(seconds, is_speech), ...]"""
+    rng = np.random.default_rng(seed)
+    return np.concatenate([rng.standard_normal(int(d*16000))*(0.2 if speech else 0.001) for d, speech in pattern]).astype(np.float32)
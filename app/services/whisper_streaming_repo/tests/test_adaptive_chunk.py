@@ -0,0 +1,41 @@
+import pytest
+
+from whisper_online import AdaptiveChunkController
+
+
+def test_chunk_follows_the_transcribe_time():
+    c = AdaptiveChunkController(2.0, initial=1.0, smoothing=0.5)
+    # fast transcription: the chunk grows to the target latency minus the transcribe time
+    assert c.update(0.2, 1.0) == pytest.approx(1.8)
+    assert c.rtf == pytest.approx(0.2)
+    # slower: the smoothed transcribe time 0.2 -> 0.6 -> 0.8 shrinks the chunk
+    assert c.update(1.0, 1.8) == pytest.approx(1.4)
+    assert c.update(1.0, 1.4) == pytest.approx(1.2)
+    # faster again, it grows back
+    assert c.update(0.0, 1.2) == pytest.approx(1.6)
+    assert c.decisions == 4
+
+
+def test_headroom_when_the_target_cannot_be_met():
+    c = AdaptiveChunkController(1.0, initial=1.0, headroom=1.2, smoothing=1.0)
+    # the transcribe time exceeds the target, the chunk keeps the processing faster than real time
+    assert c.update(1.5, 1.0) == pytest.approx(1.8)
+
+
+def test_min_and_max_clamping():
+    c = AdaptiveChunkController(10.0, initial=1.0, min_size=0.3, max_size=5.0, smoothing=1.0)
+    assert c.update(0.1, 1.0) == 5.0
+    c = AdaptiveChunkController(0.5, initial=1.0, min_size=0.3, max_size=5.0, headroom=1.2, smoothing=1.0)
+    assert c.update(0.2, 1.0) == 0.3
+    assert c.update(5.0, 0.3) == 5.0  # the headroom is clamped as well
+
+
+def test_small_changes_are_not_counted_as_decisions():
+    c = AdaptiveChunkController(2.0, initial=1.8, smoothing=1.0)
+    c.update(0.21, 1.8)
+    c.update(0.19, 1.8)
+    assert c.decisions == 0
+    assert c.rtf is not None
+    c.update(0.5, 0.0)  # no audio, the RTF of the previous iteration holds
+    assert c.rtf == pytest.approx(0.19/1.8)
+    assert c.decisions == 1
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+import whisper_online
+from whisper_online import AudioCache
+
+
+@pytest.fixture
+def decoded(monkeypatch):
+    """the files are "decoded" without librosa into 1000 samples each, the decoded names are recorded"""
+    names = []
+
+    def _decode_audio(fname):
+        names.append(fname)
+        return np.full(1000, len(names), dtype=np.float32)
+    monkeypatch.setattr(whisper_online, "_decode_audio", _decode_audio)
+    return names
+
+
+def test_cache_hit(decoded):
+    cache = AudioCache()
+    a = cache.get("a.wav")
+    assert cache.get("a.wav") is a
+    assert "a.wav" in cache and "b.wav" not in cache
+    assert decoded == ["a.wav"]
+    assert cache.bytes == 4000
+
+
+def test_least_recently_used_files_are_evicted(decoded):
+    cache = AudioCache(max_bytes=8000)  # two files
+    cache.get("a.wav")
+    cache.get("b.wav")
+    cache.get("a.wav")  # b is now the least recently used
+    cache.get("c.wav")
+    assert "a.wav" in cache and "b.wav" not in cache and "c.wav" in cache
+    assert cache.bytes == 8000
+    cache.get("b.wav")
+    assert decoded == ["a.wav", "b.wav", "c.wav", "b.wav"]
+    assert "a.wav" not in cache
+
+
+def test_a_file_larger_than_the_limit_stays_cached(decoded):
+    cache = AudioCache(max_bytes=1000)
+    a = cache.get("a.wav")
+    assert cache.get("a.wav") is a
+    cache.get("b.wav")
+    assert list(cache.entries) == ["b.wav"] and cache.bytes == 4000
+
+
+def test_sidecar_files_are_decoded_once(decoded, tmp_path):
+    audio = tmp_path/"a.wav"
+    audio.write_bytes(b"RIFF")
+    first = AudioCache(sidecar_dir=str(tmp_path/"sidecar")).get(str(audio))
+    second = AudioCache(sidecar_dir=str(tmp_path/"sidecar")).get(str(audio))
+    assert decoded == [str(audio)]  # the second cache maps the sidecar of the first one
+    assert isinstance(second, np.memmap)
+    np.testing.assert_array_equal(first, second)
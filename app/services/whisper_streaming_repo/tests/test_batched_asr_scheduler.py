@@ -0,0 +1,76 @@
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+
+from whisper_online import BatchedASRScheduler
+
+
+class RecordingASR:
+    """records its transcribe and transcribe_batch calls, the result of an audio is its length"""
+
+    sep = ""
+
+    def __init__(self):
+        self.calls = []
+
+    def transcribe(self, audio, init_prompt="", **kw):
+        self.calls.append(("transcribe", [len(audio)], init_prompt))
+        return len(audio)
+
+    def transcribe_batch(self, audios, init_prompt=""):
+        self.calls.append(("transcribe_batch", [len(a) for a in audios], init_prompt))
+        return [len(a) for a in audios]
+
+
+def request(n, init_prompt=""):
+    return (np.zeros(n, dtype=np.float32), init_prompt, {}, Future())
+
+
+def test_only_the_requests_with_the_same_prompt_are_batched():
+    asr = RecordingASR()
+    scheduler = BatchedASRScheduler(asr)
+    batch = [request(100), request(200, "hello"), request(300), request(400, "world"), request(500, "hello")]
+    scheduler._process(batch)
+    assert sorted(asr.calls) == sorted([
+        ("transcribe_batch", [100, 300], ""),
+        ("transcribe_batch", [200, 500], "hello"),
+        ("transcribe", [400], "world"),
+    ])
+    assert [r[-1].result() for r in batch] == [100, 200, 300, 400, 500]
+    assert (scheduler.batches, scheduler.batched_requests) == (2, 4)
+
+
+def test_too_long_and_empty_audio_is_transcribed_alone():
+    asr = RecordingASR()
+    scheduler = BatchedASRScheduler(asr)
+    long = BatchedASRScheduler.MAX_BATCHED_AUDIO + 1
+    batch = [request(long), request(0), request(100)]
+    scheduler._process(batch)
+    assert sorted(asr.calls) == sorted([("transcribe", [long], ""), ("transcribe", [0], ""), ("transcribe", [100], "")])
+    assert [r[-1].result() for r in batch] == [long, 0, 100]
+
+
+def test_concurrent_callers_get_their_own_results():
+    asr = RecordingASR()
+    scheduler = BatchedASRScheduler(asr, max_batch_size=4, max_wait=1.0)
+    results = {}
+
+    def run(n):
+        results[n] = scheduler.transcribe(np.zeros(n, dtype=np.float32))
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in (100, 200, 300, 400)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=5)
+    assert results == {100: 100, 200: 200, 300: 300, 400: 400}
+    assert [c[0] for c in asr.calls] == ["transcribe_batch"]
+
+
+def test_attributes_of_the_asr_are_delegated():
+    scheduler = BatchedASRScheduler(RecordingASR())
+    assert scheduler.sep == ""
+    # without the wrapped ASR, e.g. in unpickling, the lookup fails instead of recursing
+    bare = BatchedASRScheduler.__new__(BatchedASRScheduler)
+    assert not hasattr(bare, "sep")
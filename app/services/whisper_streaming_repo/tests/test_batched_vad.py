@@ -0,0 +1,75 @@
+import random
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from conftest import EnergyVAD, speech_and_silence
+from silero_vad_iterator import FixedVADIterator
+from whisper_online import BatchedVAD
+
+
+def session_audio(i):
+    """the speech of the sessions starts and ends at different times, the audio of all has the same length"""
+    return speech_and_silence([(1 + 0.3*i, False), (2 - 0.2*i, True), (1 - 0.1*i, False)], seed=i)
+
+
+def run_sessions(vad, sessions, threads):
+    """streams the audio of every session in 0.1 s chunks, each chunk is one task of the inference threads, as in the server"""
+    audio = [session_audio(i) for i in range(sessions)]
+    iterators = [FixedVADIterator(vad.stream()) for _ in range(sessions)]
+    results = [[] for _ in range(sessions)]
+    barrier = threading.Barrier(min(sessions, threads))
+
+    def session(i):
+        # the sessions receive their audio at about the same pace
+        for pos in range(0, len(audio[i]), 1600):
+            if threads >= sessions:
+                barrier.wait()
+            r = iterators[i](audio[i][pos:pos+1600])
+            if r is not None:
+                results[i].append(r)
+
+    with ThreadPoolExecutor(threads) as ex:
+        list(ex.map(session, range(sessions)))
+    return results
+
+
+def test_concurrent_sessions_are_batched():
+    vad = BatchedVAD(EnergyVAD(), max_wait=0.02)
+    results = run_sessions(vad, sessions=4, threads=4)
+    assert vad.windows > vad.calls  # more than one window per model call on average
+    # the same segments as each session alone
+    alone = [FixedVADIterator(EnergyVAD()) for _ in range(4)]
+    for i, r in enumerate(results):
+        expected = []
+        a = session_audio(i)
+        for pos in range(0, len(a), 1600):
+            x = alone[i](a[pos:pos+1600])
+            if x is not None:
+                expected.append(x)
+        assert r == expected
+
+
+def test_one_thread_never_batches():
+    vad = BatchedVAD(EnergyVAD(), max_wait=0.001)
+    run_sessions(vad, sessions=4, threads=1)
+    assert vad.windows == vad.calls
+
+
+def test_interleaved_streams_keep_their_states():
+    rng = random.Random(0)
+    vad = BatchedVAD(EnergyVAD())
+    streams = [vad.stream() for _ in range(3)]
+    alone = [EnergyVAD() for _ in range(3)]
+    audio = [session_audio(i) for i in range(3)]
+    pos = [0, 0, 0]
+    for _ in range(60):
+        # some of the streams send a request of a few windows, in a random order
+        batch = []
+        for i in rng.sample(range(3), rng.randint(1, 3)):
+            n = rng.randint(1, 4)
+            windows = audio[i][pos[i]:pos[i]+512*n].reshape(-1, 512)
+            pos[i] += 512*len(windows)
+            batch.append((streams[i], windows, Future(), alone[i].window_probs(windows)))
+        vad._process([b[:3] for b in batch])
+        for _, _, f, expected in batch:
+            assert f.result().tolist() == expected.tolist()
@@ -0,0 +1,91 @@
+import pytest
+
+from benchmark import FakeASR
+from conftest import EnergyVAD, speech_and_silence
+from whisper_online import Endpointer, VACOnlineASRProcessor
+
+
+def test_no_endpoint_without_speech():
+    e = Endpointer()
+    assert not e.complete(10.0)
+    assert not e.complete(None)
+
+
+def test_trailing_silence_threshold():
+    e = Endpointer()
+    e.commit(1.0, 1.4, "hello")
+    # one word is too short to measure the speech rate, the window is pause_words at the default rate
+    assert e.window() == pytest.approx(2.5/2.5)
+    assert not e.complete(None)  # in speech
+    assert not e.complete(0.99)
+    assert e.complete(1.0)
+
+
+def test_minimum_speech_to_measure_the_rate():
+    e = Endpointer()
+    e.commit(0.0, 0.9, "one two three four")  # less than a second
+    assert e.speech_rate() == e.default_rate
+    e = Endpointer()
+    e.commit(0.0, 2.0, "one two")  # fewer than 3 words
+    assert e.speech_rate() == e.default_rate
+    e.commit(2.0, 4.0, "three")
+    assert e.speech_rate() == pytest.approx(3/4.0)
+
+
+def test_window_is_clamped():
+    slow = Endpointer()
+    slow.commit(0.0, 4.0, "a b c d")  # 1 word per second, 2.5 s window
+    assert slow.window() == slow.max_silence
+    fast = Endpointer()
+    fast.commit(0.0, 1.0, "a b c d e f g h i j")  # 10 words per second, 0.25 s window
+    assert fast.window() == fast.min_silence
+
+
+def test_punctuation_and_stability():
+    e = Endpointer()
+    e.commit(0.0, 0.5, "hello.")
+    assert e.window() == pytest.approx(1.0*e.punct_factor)
+    e = Endpointer()
+    e.commit(0.0, 0.5, "hello")
+    e.hypothesis([(0.6, 0.9, " there", 1)])
+    assert e.window() == pytest.approx(1.0*e.unstable_factor)
+    e.hypothesis([])  # after finish, the previous stability holds
+    assert not e.stable
+    e.hypothesis([(0.6, 0.9, " there", 2)])
+    assert e.window() == pytest.approx(1.0)
+
+
+def test_reset_after_an_endpoint():
+    e = Endpointer()
+    e.commit(0.0, 4.0, "a b c d")
+    e.hypothesis([(4.1, 4.3, " e", 1)])
+    assert e.complete(2.0)
+    e.reset()
+    assert not e.complete(2.0)  # no speech in the new utterance yet
+    e.commit(5.0, 5.3, "next")
+    assert e.stable and e.beg == 5.0
+    assert e.window() == pytest.approx(1.0)  # the rate and stability of the previous utterance are gone
+
+
+def test_endpoint_on_the_trailing_silence_of_vac():
+    audio = speech_and_silence([(1, False), (1.5, True), (3, False)])
+    asr = FakeASR([(1.1, 1.5, "hello"), (1.7, 2.3, "world.")])
+    online = VACOnlineASRProcessor(0.5, asr, vad_model=EnergyVAD(), logfile=None)
+    e = Endpointer()
+    ended = None
+    for pos in range(0, len(audio), 1600):
+        asr.audio_end = (pos + 1600)/16000
+        online.insert_audio_chunk(audio[pos:pos+1600])
+        o = online.process_iter()
+        if o[0] is not None:
+            e.commit(*o)
+        e.hypothesis(online.partial())
+        silence = online.trailing_silence()
+        if pos < 2.5*16000:
+            assert silence is None
+        if ended is None and e.complete(silence):
+            ended = asr.audio_end
+            speech_end, window = online.speech_end, e.window()
+    # the VAD ends the speech after its 0.5 s of silence, the utterance ends when the window has passed from there
+    assert ended is not None and 2.5 < speech_end < 2.8
+    assert speech_end + window <= ended < speech_end + window + 0.1
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from conftest import EnergyVAD, speech_and_silence
+from silero_vad_iterator import EnergyGate, FixedVADIterator
+
+
+class ContextVAD(EnergyVAD):
+    """EnergyVAD that needs context after a reset, as the Silero model does: the probability of the k-th window
+    after a reset is scaled by k/3, so an onset is detected late unless ONSET_CONTEXT windows precede it."""
+
+    def reset_states(self, batch_size=1):
+        super().reset_states(batch_size)
+        self.seen = 0
+
+    def __call__(self, x, sr):
+        self.seen += 1
+        return super().__call__(x, sr)*min(1.0, self.seen/(FixedVADIterator.ONSET_CONTEXT+1))
+
+
+PATTERN = [(2.0, False), (0.5, True), (1.3, False), (0.7, True), (1.13, False), (0.4, True), (2.0, False), (0.6, True), (1.0, False)]
+
+
+def events(chunk, gate):
+    """the speech starts and ends found in the audio sent in chunks of the given number of samples"""
+    audio = speech_and_silence(PATTERN, seed=3)
+    vad = FixedVADIterator(ContextVAD(), gate=EnergyGate() if gate else None)
+    out = []
+    for pos in range(0, len(audio), chunk):
+        r = vad(audio[pos:pos+chunk])
+        if r is not None:
+            out.extend(sorted(r.items(), key=lambda kv: kv[0] != "start"))
+    return out, vad
+
+
+@pytest.mark.parametrize("chunk", [512, 1024, 1600, 3*512, 4000, 8*512+100])
+def test_gated_boundaries_do_not_depend_on_the_chunk_size(chunk):
+    expected, _ = events(512, gate=False)
+    assert [k for k, _ in expected] == ["start", "end"]*4
+    found, vad = events(chunk, gate=True)
+    assert found == expected
+    assert vad.skipped_windows > 100  # the gate does skip the silence
@@ -0,0 +1,48 @@
+import asyncio
+import socket
+
+import pytest
+
+import frame_protocol
+from frame_protocol import AUDIO, END, RESUME, FrameTooLarge
+
+
+def read(data):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await frame_protocol.read_frame(reader)
+    return asyncio.run(run())
+
+
+def test_round_trip():
+    assert read(frame_protocol.encode_frame(AUDIO, b"\x01\x02")) == (AUDIO, b"\x01\x02")
+    assert read(frame_protocol.encode_frame(END)) == (END, b"")
+    assert read(b"") is None
+
+
+def test_audio_frame_up_to_the_limit():
+    payload = bytes(frame_protocol.MAX_AUDIO_FRAME)
+    assert read(frame_protocol.encode_frame(AUDIO, payload)) == (AUDIO, payload)
+
+
+def test_declared_length_over_the_limit_is_refused_without_reading_the_payload():
+    # a header that announces almost 4 GB, followed by nothing: the payload must not be awaited
+    with pytest.raises(FrameTooLarge):
+        read(frame_protocol.HEADER.pack(AUDIO, 2**32 - 1))
+
+
+def test_control_frames_have_a_lower_limit():
+    payload = bytes(frame_protocol.MAX_CONTROL_FRAME + 1)
+    assert len(payload) < frame_protocol.MAX_AUDIO_FRAME
+    with pytest.raises(FrameTooLarge):
+        read(frame_protocol.encode_frame(RESUME, payload))
+
+
+def test_blocking_receive_checks_the_limit():
+    a, b = socket.socketpair()
+    with a, b:
+        a.sendall(frame_protocol.HEADER.pack(AUDIO, frame_protocol.MAX_AUDIO_FRAME + 1))
+        with pytest.raises(FrameTooLarge):
+            frame_protocol.recv_frame(b)
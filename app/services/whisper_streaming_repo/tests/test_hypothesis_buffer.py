@@ -0,0 +1,143 @@
+import random
+
+import pytest
+
+from whisper_online import HypothesisBuffer
+
+
+class ListHypothesisBuffer:
+    """HypothesisBuffer as it was before the deques and the n-gram keys, the reference of the equivalence test."""
+
+    def __init__(self):
+        self.commited_in_buffer = []
+        self.buffer = []
+        self.new = []
+        self.last_commited_time = 0
+        self.last_commited_word = None
+
+    def insert(self, new, offset):
+        new = [(a+offset,b+offset,t) for a,b,t in new]
+        self.new = [(a,b,t) for a,b,t in new if a > self.last_commited_time-0.1]
+        if len(self.new) >= 1:
+            a,b,t = self.new[0]
+            if abs(a - self.last_commited_time) < 1:
+                if self.commited_in_buffer:
+                    cn = len(self.commited_in_buffer)
+                    nn = len(self.new)
+                    for i in range(1,min(min(cn,nn),5)+1):
+                        c = " ".join([self.commited_in_buffer[-j][2] for j in range(1,i+1)][::-1])
+                        tail = " ".join(self.new[j-1][2] for j in range(1,i+1))
+                        if c == tail:
+                            for j in range(i):
+                                self.new.pop(0)
+                            break
+
+    def flush(self):
+        commit = []
+        while self.new:
+            na, nb, nt = self.new[0]
+            if len(self.buffer) == 0:
+                break
+            if nt == self.buffer[0][2]:
+                commit.append((na,nb,nt))
+                self.last_commited_word = nt
+                self.last_commited_time = nb
+                self.buffer.pop(0)
+                self.new.pop(0)
+            else:
+                break
+        self.buffer = self.new
+        self.new = []
+        self.commited_in_buffer.extend(commit)
+        return commit
+
+    def pop_commited(self, time):
+        while self.commited_in_buffer and self.commited_in_buffer[0][1] <= time:
+            self.commited_in_buffer.pop(0)
+
+    def complete(self):
+        return self.buffer
+
+
+# a small vocabulary with repeated and multi-byte words, so that the n-grams often match or almost match
+VOCAB = ["a", "the", "and", "so", "yes", "no", "día", "naïve", "日本", "ok", "ok.", "the,"]
+
+
+def hypothesis(rng, words, start, end):
+    """what an ASR update could return for the audio from start to end: the true words, sometimes wrong or missing,
+    with jittered timestamps, relative to start"""
+    out = []
+    for a, b, t in words:
+        if a < start - 0.3 or a >= end:
+            continue
+        r = rng.random()
+        if r < 0.1:
+            continue
+        if r < 0.25:
+            t = rng.choice(VOCAB)
+        j = rng.uniform(-0.08, 0.08)
+        out.append((max(a - start + j, 0.0), b - start + j, t))
+    return out
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_equivalent_to_the_list_version(seed):
+    rng = random.Random(seed)
+    t, words = 0.0, []
+    while t < 60:
+        d = rng.uniform(0.1, 0.6)
+        words.append((t, t + d, rng.choice(VOCAB)))
+        t += d + rng.choice([0.0, 0.05, 0.2, 1.5])
+    new, old = HypothesisBuffer(logfile=None), ListHypothesisBuffer()
+    offset, end = 0.0, 0.0
+    for _ in range(150):
+        op = rng.random()
+        if op < 0.15:
+            # the audio buffer is trimmed at a random earlier time
+            offset = rng.uniform(offset, max(offset, new.last_commited_time))
+            new.pop_commited(offset)
+            old.pop_commited(offset)
+        else:
+            end += rng.uniform(0.2, 1.5)
+            h = hypothesis(rng, words, offset, end)
+            new.insert(h, offset)
+            old.insert(h, offset)
+            assert list(new.new) == old.new
+            if op < 0.95:
+                assert new.flush() == old.flush()
+        assert list(new.commited_in_buffer) == old.commited_in_buffer
+        assert new.complete() == old.complete()
+        assert (new.last_commited_time, new.last_commited_word) == (old.last_commited_time, old.last_commited_word)
+
+
+def test_stability_counts_the_consecutive_inserts_of_a_word():
+    buf = HypothesisBuffer(logfile=None)
+    # the first word differs in every insert, so nothing is commited and the rest stays in the buffer
+    buf.insert([(0.0, 0.4, "x"), (0.5, 0.9, "b"), (1.0, 1.4, "c")], 0)
+    assert buf.flush() == []
+    assert buf.complete_with_stability() == [(0.0, 0.4, "x", 1), (0.5, 0.9, "b", 1), (1.0, 1.4, "c", 1)]
+    buf.insert([(0.0, 0.4, "y"), (0.55, 0.9, "b"), (1.0, 1.4, "c"), (1.5, 1.8, "d")], 0)
+    assert buf.flush() == []
+    assert [k for _, _, _, k in buf.complete_with_stability()] == [1, 2, 2, 1]
+    # a changed word and a word that moved by more than 0.5 s start again from 1, the others go on
+    buf.insert([(0.0, 0.4, "z"), (0.5, 0.9, "B"), (1.0, 1.4, "c"), (2.1, 2.4, "d")], 0)
+    assert buf.flush() == []
+    assert buf.complete_with_stability() == [(0.0, 0.4, "z", 1), (0.5, 0.9, "B", 1), (1.0, 1.4, "c", 3), (2.1, 2.4, "d", 1)]
+
+
+def test_stability_of_the_words_after_a_commit():
+    buf = HypothesisBuffer(logfile=None)
+    buf.insert([(0.0, 0.4, "a"), (0.5, 0.9, "b")], 0)
+    buf.flush()
+    buf.insert([(0.0, 0.4, "a"), (0.5, 0.9, "b"), (1.0, 1.4, "c")], 0)
+    assert [t for _, _, t in buf.flush()] == ["a", "b"]
+    assert buf.complete_with_stability() == [(1.0, 1.4, "c", 1)]
+    # the commited words are dropped from the new hypothesis, the uncommited tail keeps its count
+    buf.insert([(0.5, 0.9, "b"), (1.0, 1.4, "c"), (1.5, 1.9, "e")], 0)
+    assert buf.flush() == [(1.0, 1.4, "c")]
+    assert buf.complete_with_stability() == [(1.5, 1.9, "e", 1)]
+    buf.insert([(1.0, 1.4, "c"), (1.5, 1.9, "f"), (2.0, 2.4, "g")], 0)
+    buf.flush()
+    buf.insert([(1.0, 1.4, "c"), (1.5, 1.9, "h"), (2.0, 2.4, "g")], 0)
+    assert buf.flush() == []
+    assert buf.complete_with_stability() == [(1.5, 1.9, "h", 1), (2.0, 2.4, "g", 2)]
@@ -0,0 +1,53 @@
+import asyncio
+
+import numpy as np
+
+from whisper_online import IngestQueue
+
+PACKET = 1600  # 0.1 s
+
+
+def run_session(chunk, rtf, seconds=60):
+    """A producer puts a packet of silence per tick, a consumer gets chunks of at least chunk seconds and processes each
+    of them for rtf times its duration, i.e. while that many packets are produced. Returns the queue and the skip calls."""
+    skipped = []
+    queue = IngestQueue("skip", max_lag=2.0, skip=lambda n: skipped.append(n) or True)
+    produced = 0
+
+    async def producer():
+        nonlocal produced
+        for _ in range(int(seconds*10)):
+            queue.put(np.zeros(PACKET, dtype=np.float32))
+            produced += 1
+            await asyncio.sleep(0)
+        queue.close()
+
+    async def consumer():
+        while True:
+            a = await queue.get(int(chunk*16000))
+            if a is None:
+                break
+            target = produced + round(rtf*len(a)/PACKET)
+            while produced < target and not queue.closed:
+                await asyncio.sleep(0)
+
+    async def main():
+        await asyncio.gather(producer(), consumer())
+
+    asyncio.run(main())
+    return queue, skipped
+
+
+def test_consumer_that_keeps_up_with_large_chunks_has_no_backpressure():
+    for chunk in (2.0, 3.0, 5.0):
+        queue, skipped = run_session(chunk, rtf=0.8)
+        assert queue.falling_behind_events == 0
+        assert skipped == []
+        assert queue.max_lag_seen <= 0.1
+
+
+def test_slow_consumer_falls_behind():
+    queue, skipped = run_session(5.0, rtf=1.2)
+    assert queue.falling_behind_events == 1
+    assert queue.max_lag_seen > 2.0
+    assert skipped
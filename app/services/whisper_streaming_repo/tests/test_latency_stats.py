@@ -0,0 +1,38 @@
+import pytest
+
+from benchmark import FakeASR
+from conftest import EnergyVAD, speech_and_silence
+from whisper_online import LatencyStatsHook, OnlineASRProcessor, VACOnlineASRProcessor
+
+
+WORDS = [(1.1, 1.5, "hello"), (1.6, 2.0, "world"), (2.2, 2.8, "again")]
+
+
+def stream(online, asr, audio, chunk=1600):
+    for pos in range(0, len(audio), chunk):
+        asr.audio_end = (pos + chunk)/16000
+        online.insert_audio_chunk(audio[pos:pos+chunk])
+        online.process_iter()
+
+
+def test_vac_counts_all_the_received_audio_and_the_vad_time():
+    hook = LatencyStatsHook()
+    asr = FakeASR(WORDS)
+    online = VACOnlineASRProcessor(0.5, asr, vad_model=EnergyVAD(), hook=hook, logfile=None)
+    audio = speech_and_silence([(1, False), (2, True), (2, False)])
+    stream(online, asr, audio)
+    assert hook.iterations == len(audio)//1600
+    assert hook.audio_seconds == pytest.approx(len(audio)/16000)
+    # the iterations include the VAD, and the spans of the transcription are reported as well
+    assert hook.processing_seconds >= hook.spans["vad"].sum
+    assert hook.spans["transcribe"].count > 0
+
+
+def test_without_vac_all_the_audio_is_transcribed():
+    hook = LatencyStatsHook()
+    asr = FakeASR(WORDS)
+    online = OnlineASRProcessor(asr, hook=hook, logfile=None)
+    audio = speech_and_silence([(1, False), (2, True), (2, False)])
+    stream(online, asr, audio)
+    assert hook.iterations == len(audio)//1600
+    assert hook.audio_seconds == pytest.approx(len(audio)/16000)
@@ -0,0 +1,56 @@
+import argparse
+
+import pytest
+
+import whisper_online
+from benchmark import FakeASR
+from conftest import EnergyVAD
+
+
+@pytest.fixture
+def args():
+    parser = argparse.ArgumentParser()
+    whisper_online.add_shared_args(parser)
+    return parser.parse_args(["--backend", "openai-api", "--vac"])
+
+
+@pytest.fixture
+def no_model(monkeypatch):
+    monkeypatch.setattr(whisper_online, "OpenaiApiASR", lambda lan: FakeASR([], lan=lan))
+    monkeypatch.setattr(whisper_online, "warmup", lambda asr, warmup_file=None: 0.0)
+
+    def online_factory(*a, **kw):
+        raise AssertionError("no online processor is needed at startup")
+    monkeypatch.setattr(whisper_online, "online_factory", online_factory)
+
+
+def test_vad_is_loaded_once_and_no_processor_is_built(args, no_model, monkeypatch):
+    loads = []
+    monkeypatch.setattr(whisper_online, "load_vad_model", lambda *a: loads.append(a))
+    asr, phases = whisper_online.load_models(args)
+    assert isinstance(asr, FakeASR)
+    assert len(loads) == 1
+    assert set(phases) == {"asr", "vad", "warmup"}
+
+
+def test_startup_survives_a_vad_that_fails_to_load(args, no_model, monkeypatch):
+    def load_vad_model(*a):
+        raise OSError("no network")
+    monkeypatch.setattr(whisper_online, "load_vad_model", load_vad_model)
+    asr, phases = whisper_online.load_models(args)
+    assert isinstance(asr, FakeASR)
+    assert "vad" not in phases
+
+
+def test_every_vad_model_is_a_copy(monkeypatch):
+    loads = []
+
+    def _load_vad_model(backend, model_path):
+        loads.append(backend)
+        return EnergyVAD()
+    monkeypatch.setattr(whisper_online, "_vad_models", {})
+    monkeypatch.setattr(whisper_online, "_load_vad_model", _load_vad_model)
+    first, second = whisper_online.load_vad_model(), whisper_online.load_vad_model()
+    template = whisper_online._vad_models[("torch", None)]
+    assert loads == ["torch"]
+    assert first is not template and second is not template and first is not second
@@ -0,0 +1,73 @@
+import numpy as np
+
+from whisper_online import CachingFeatureExtractor, MelFeatureCache
+
+
+class ReferenceExtractor:
+    """the log-mel features of faster-whisper's FeatureExtractor, without faster-whisper: a centered STFT with reflect
+    padding, the last frame dropped, and the same normalization. The mel filters are random, they only have to be fixed."""
+
+    n_fft = 400
+    hop_length = 160
+    sampling_rate = 16000
+
+    def __init__(self):
+        self.mel_filters = np.random.default_rng(0).random((80, self.n_fft//2 + 1)).astype(np.float32)/100
+        self.calls = 0
+
+    def __call__(self, waveform, padding=160, chunk_length=None):
+        self.calls += 1
+        x = np.pad(waveform.astype(np.float32), (0, padding))
+        x = np.pad(x, (self.n_fft//2, self.n_fft//2), mode="reflect")
+        n = 1 + (len(x) - self.n_fft)//self.hop_length
+        frames = np.stack([x[i*self.hop_length:i*self.hop_length+self.n_fft] for i in range(n)])
+        window = np.hanning(self.n_fft + 1)[:-1].astype(np.float32)
+        stft = np.fft.rfft(frames*window, axis=-1).T[:, :-1]
+        mel = self.mel_filters @ (np.abs(stft)**2)
+        log_spec = np.log10(np.clip(mel, 1e-10, None))
+        log_spec = np.maximum(log_spec, log_spec.max() - 8.0)
+        return (log_spec + 4.0)/4.0
+
+
+def signal(n, seed):
+    return (np.random.default_rng(seed).standard_normal(n)*0.1).astype(np.float32)
+
+
+def test_cached_features_match_across_appends_and_trims():
+    extractor = ReferenceExtractor()
+    cache = MelFeatureCache()
+    stream = signal(16000*12, 1)
+    beg, end = 0, 16000
+    # appends of whole and odd sizes, hop aligned and non-aligned trims
+    steps = [("append", 8000), ("append", 12345), ("trim", 3200), ("append", 16000), ("trim", 1234),
+             ("append", 7777), ("append", 16000), ("trim", 16000), ("append", 5000), ("trim", 999), ("append", 20000)]
+    for op, n in steps:
+        if op == "append":
+            end += n
+        else:
+            beg += n
+            cache.trim(n)
+        audio = stream[beg:end]
+        expected = extractor(audio)
+        got = cache.features(audio, extractor)
+        assert got.shape == expected.shape
+        np.testing.assert_allclose(got, expected, rtol=1e-4, atol=1e-4)
+    assert cache.reused_frames > cache.computed_frames  # the cache was used, not only computed again
+
+
+def test_caching_extractor_uses_the_cache_of_the_registered_audio_only():
+    extractor = ReferenceExtractor()
+    caching = CachingFeatureExtractor(extractor)
+    cache = MelFeatureCache()
+    audio = signal(32000, 2)
+    caching.register(audio, cache)
+    np.testing.assert_allclose(caching(audio), extractor(audio), rtol=1e-4, atol=1e-4)
+    assert cache.computed_frames > 0
+    other = audio.copy()
+    calls = extractor.calls
+    caching(other)  # not registered, computed by the original extractor
+    assert extractor.calls == calls + 1
+    caching.unregister(audio)
+    caching(audio)
+    assert extractor.calls == calls + 2
+    assert caching.hop_length == extractor.hop_length  # the attributes of the original extractor
@@ -0,0 +1,81 @@
+import pytest
+
+import whisper_online
+from whisper_online import FasterWhisperASR, ModelPool
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    """FasterWhisperASR loads its models in a new pool without faster-whisper, the loaded keys are recorded"""
+    loaded = []
+
+    def _load_whisper_model(self, model_size_or_path, cache_dir):
+        loaded.append((model_size_or_path, self.device, self.compute_type))
+        return object(), 100
+    monkeypatch.setattr(whisper_online, "model_pool", ModelPool())
+    monkeypatch.setattr(FasterWhisperASR, "_load_whisper_model", _load_whisper_model)
+    return loaded
+
+
+def test_only_the_object_that_loads_the_model_has_a_new_model(loads):
+    first = FasterWhisperASR(lan="en", modelsize="tiny")
+    second = FasterWhisperASR(lan="de", modelsize="tiny")
+    assert first.new_model and not second.new_model
+    assert second.model is first.model
+    assert loads == [("tiny", "cpu", "int8")]
+
+
+def test_models_are_shared_by_model_device_and_compute_type(loads):
+    a = FasterWhisperASR(lan="en", modelsize="tiny")
+    b = FasterWhisperASR(lan="en", modelsize="tiny", compute_type="float16")
+    c = FasterWhisperASR(lan="en", modelsize="tiny", device="cuda")
+    d = FasterWhisperASR(lan="en", modelsize="base")
+    e = FasterWhisperASR(lan="cs", modelsize="tiny", device="cpu", compute_type="int8")
+    assert len({id(x.model) for x in (a, b, c, d)}) == 4
+    assert e.model is a.model
+    assert loads == [("tiny", "cpu", "int8"), ("tiny", "cpu", "float16"), ("tiny", "cuda", "int8"), ("base", "cpu", "int8")]
+    assert whisper_online.model_pool.entries[a.pool_key][1] == 2
+
+
+def test_references_are_counted():
+    pool = ModelPool()
+    loaded = []
+    loader = lambda: (loaded.append(1) or object(), 10)
+    m = pool.acquire("k", loader)
+    assert pool.acquire("k", loader) is m
+    assert pool.entries["k"][1] == 2 and len(loaded) == 1
+    pool.release("k")
+    pool.release("k")
+    pool.release("k")  # more releases than acquires do not go below 0
+    assert pool.entries["k"][1] == 0
+    assert "k" in pool.entries  # without max_bytes, an unreferenced model stays loaded
+    assert pool.acquire("k", loader) is m and len(loaded) == 1
+
+
+def test_unreferenced_models_are_evicted_over_max_bytes():
+    pool = ModelPool(max_bytes=25)
+    pool.acquire("a", lambda: ("A", 10))
+    pool.acquire("b", lambda: ("B", 10))
+    pool.release("a")
+    pool.release("b")
+    pool.acquire("b", lambda: ("B2", 10))  # a is now the least recently used
+    assert list(pool.entries) == ["a", "b"]
+    pool.acquire("c", lambda: ("C", 10))
+    assert list(pool.entries) == ["b", "c"]  # only a is evicted, the total fits again
+    # the referenced models stay, even over the limit
+    pool.acquire("d", lambda: ("D", 20))
+    assert list(pool.entries) == ["b", "c", "d"]
+    pool.release("c")
+    assert list(pool.entries) == ["b", "d"]
+
+
+def test_release_returns_the_model_to_the_pool(loads):
+    whisper_online.model_pool.max_bytes = 100
+    a = FasterWhisperASR(lan="en", modelsize="tiny")
+    key = a.pool_key
+    a.release()
+    a.release()  # only once
+    assert a.pool_key is None
+    assert whisper_online.model_pool.entries[key][1] == 0
+    FasterWhisperASR(lan="en", modelsize="base")  # 200 bytes, the unreferenced tiny one is evicted
+    assert key not in whisper_online.model_pool.entries
@@ -0,0 +1,35 @@
+import numpy as np
+
+from whisper_online import PCMReceiver
+
+
+def pcm(n, seed):
+    return np.random.default_rng(seed).integers(-32768, 32768, n).astype("<i2")
+
+
+def test_odd_bytes_are_carried_over_to_the_next_take():
+    samples = pcm(5000, 0)
+    data = samples.tobytes()
+    r = PCMReceiver(capacity=1000)
+    got, taken = [], 0
+    # packets of odd sizes split the samples, and the chunks grow beyond the capacity
+    cuts = [0, 1, 4, 7, 1000, 1001, 3333, 7001, 9999, 10000]
+    for k, (beg, end) in enumerate(zip(cuts, cuts[1:])):
+        r.add(data[beg:end])
+        assert len(r) == (end - taken)//2
+        if k % 2:
+            got.append(r.take().copy())
+            taken = end - end % 2
+            assert len(r) == 0 and r.n == end % 2
+    got.append(r.take().copy())
+    np.testing.assert_array_equal(np.concatenate(got), samples.astype(np.float32)/32768)
+
+
+def test_take_reuses_its_buffer():
+    r = PCMReceiver(capacity=100)
+    r.add(pcm(50, 1).tobytes())
+    first = r.take()
+    r.add(pcm(50, 2).tobytes() + b"\x01")
+    second = r.take()
+    assert np.shares_memory(first, second)
+    assert len(second) == 50 and len(r) == 0 and r.n == 1
@@ -0,0 +1,41 @@
+"""Parity of the ONNX and torch Silero VAD. It needs onnxruntime, torch and the model files of the same version:
+SILERO_VAD_ONNX=silero_vad.onnx SILERO_VAD_JIT=silero_vad.jit, and optionally a 16kHz recording SILERO_VAD_AUDIO,
+by default synthetic speech with pauses."""
+import os
+
+import numpy as np
+import pytest
+
+from whisper_online import load_audio, synthetic_speech
+
+ONNX = os.environ.get("SILERO_VAD_ONNX")
+JIT = os.environ.get("SILERO_VAD_JIT")
+AUDIO = os.environ.get("SILERO_VAD_AUDIO")
+
+TOLERANCE = 1e-3  # of the speech probabilities
+
+pytestmark = pytest.mark.skipif(not (ONNX and os.path.isfile(ONNX) and JIT and os.path.isfile(JIT)),
+                                reason="SILERO_VAD_ONNX and SILERO_VAD_JIT model files are not given")
+
+
+@pytest.fixture(scope="module")
+def models():
+    pytest.importorskip("onnxruntime")
+    torch = pytest.importorskip("torch")
+    from silero_vad_onnx import OnnxSileroVAD
+    return OnnxSileroVAD(ONNX), torch.jit.load(JIT).eval()
+
+
+@pytest.fixture(scope="module")
+def audio():
+    if AUDIO:
+        return load_audio(AUDIO)
+    silence = np.zeros(16000, dtype=np.float32)
+    return np.concatenate([silence, synthetic_speech(3.0), silence, synthetic_speech(2.0), silence])
+
+
+def test_parity_with_torch(models, audio):
+    from silero_vad_onnx import parity
+    diff, _, same_segments = parity(*models, audio)
+    assert diff <= TOLERANCE
+    assert same_segments
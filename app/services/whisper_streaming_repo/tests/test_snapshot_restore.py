@@ -0,0 +1,51 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from benchmark import FakeASR
+from conftest import EnergyVAD, speech_and_silence
+from test_tail_decoding import reference_words
+from whisper_online import OnlineASRProcessor, VACOnlineASRProcessor
+
+
+def stream(make, words, audio, chunk=8000, moves=()):
+    """the outputs of processing the audio in chunks; at the chunks in moves, the state is pickled and the processing
+    continues in a new processor with a new ASR object"""
+    asr = FakeASR(words)
+    online = make(asr)
+    outputs, partials = [], []
+    for k, pos in enumerate(range(0, len(audio), chunk)):
+        if k in moves:
+            state = pickle.loads(pickle.dumps(online.snapshot()))
+            asr = FakeASR(words)
+            online = make(asr)
+            online.restore(state)
+        asr.audio_end = min(pos + chunk, len(audio))/16000
+        online.insert_audio_chunk(audio[pos:pos+chunk])
+        outputs.append(online.process_iter())
+        partials.append(online.partial())
+    outputs.append(online.finish())
+    return outputs, partials
+
+
+@pytest.mark.parametrize("tail_decoding", [False, True])
+def test_restored_processor_continues_like_an_uninterrupted_one(tail_decoding):
+    words = reference_words(40)
+    audio = np.zeros(int((words[-1][1] + 1.0)*16000), dtype=np.float32)
+    make = lambda asr: OnlineASRProcessor(asr, buffer_trimming=("segment", 4), tail_decoding=tail_decoding, logfile=None)
+    expected = stream(make, words, audio)
+    got = stream(make, words, audio, moves=(5, 17, 30))
+    assert any(beg is not None for beg, _, _ in expected[0])
+    assert got == expected
+
+
+def test_restored_vac_processor_continues_like_an_uninterrupted_one():
+    words = [(1.1, 1.5, "hello"), (1.7, 2.3, "world"), (4.1, 4.6, "and"), (4.7, 5.2, "again")]
+    audio = speech_and_silence([(1, False), (1.5, True), (1.5, False), (1.5, True), (1.5, False)])
+    make = lambda asr: VACOnlineASRProcessor(0.5, asr, vad_model=EnergyVAD(), logfile=None)
+    expected = stream(make, words, audio, chunk=1600)
+    # moves in the speech, in the trailing silence of the VAD and in the silence
+    got = stream(make, words, audio, chunk=1600, moves=(12, 27, 33, 50))
+    assert " ".join(t for _, _, t in expected[0][:-1] if t) == "hello world and again"
+    assert got == expected
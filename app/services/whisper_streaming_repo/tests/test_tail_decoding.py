@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from benchmark import FakeASR
+from whisper_online import OnlineASRProcessor
+
+
+def reference_words(n=60):
+    """words of 0.3 s, with a pause of 0.8 s after every 6th one, so that FakeASR splits them into segments"""
+    words, t = [], 0.2
+    for i in range(n):
+        words.append((round(t, 3), round(t+0.3, 3), f"w{i}"))
+        t += 0.4 + (0.8 if i % 6 == 5 else 0.0)
+    return words
+
+
+def stream(tail_decoding, words, chunk=0.5):
+    asr = FakeASR(words)
+    online = OnlineASRProcessor(asr, buffer_trimming=("segment", 4), tail_decoding=tail_decoding, logfile=None)
+    duration = words[-1][1] + 1.0
+    commited, trims = [], 0
+    for k in range(1, int(duration/chunk)+1):
+        online.insert_audio_chunk(np.zeros(int(chunk*16000), dtype=np.float32))
+        asr.audio_end = k*chunk
+        offset = online.buffer_time_offset
+        online.process_iter()
+        trims += online.buffer_time_offset != offset
+        commited = list(online.commited)
+    return commited, online, trims
+
+
+def test_tail_decoding_commits_the_words_of_the_full_buffer_decode():
+    words = reference_words()
+    full, _, full_trims = stream(False, words)
+    tail, online, trims = stream(True, words)
+    assert online.tail_iters > online.full_iters  # most iterations transcribed only the tail
+    assert trims > 3 and full_trims > 3
+    assert [w for _, _, w in tail] == [w for _, _, w in full]
+    for (b, e, _), (fb, fe, _) in zip(tail, full):
+        assert (b, e) == pytest.approx((fb, fe), abs=1e-3)
+
+
+def test_timestamps_after_trims_are_those_of_the_stream():
+    words = reference_words()
+    tail, online, trims = stream(True, words)
+    assert trims > 3
+    assert len(tail) > len(words) - 3  # all but the last few words are commited
+    for (b, e, w), (rb, re_, rw) in zip(tail, words):
+        assert w == rw
+        assert (b, e) == pytest.approx((rb, re_), abs=1e-3)
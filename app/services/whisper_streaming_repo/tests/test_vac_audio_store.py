@@ -0,0 +1,25 @@
+import logging
+
+import numpy as np
+
+from benchmark import FakeASR
+from conftest import EnergyVAD, speech_and_silence
+from whisper_online import VACOnlineASRProcessor
+
+
+def test_server_sized_chunks_do_not_grow_the_audio_store(caplog):
+    # the server inserts all the audio queued since the last iteration: the chunk size plus a network packet or more
+    online = VACOnlineASRProcessor(1.0, FakeASR([]), vad_model=EnergyVAD(), max_lag=2.0, logfile=open("/dev/null", "w"))
+    capacity = online.audio_store.capacity
+    audio = speech_and_silence([(3, False), (2, True), (4, False), (3, True), (5, False)])
+    chunks = [1.04, 1.3, 1.04, 2.9, 1.0]
+    pos, k = 0, 0
+    with caplog.at_level(logging.WARNING, logger="whisper_online"):
+        while pos < len(audio):
+            n = int(chunks[k % len(chunks)]*16000)
+            online.insert_audio_chunk(audio[pos:pos+n])
+            online.process_iter()
+            pos, k = pos + n, k + 1
+    assert online.audio_store.capacity == capacity
+    assert online.audio_store.high_water_mark > 16000
+    assert "capacity exceeded" not in caplog.text
@@ -0,0 +1,97 @@
+import multiprocessing
+import threading
+
+import numpy as np
+import pytest
+
+from whisper_online import IngestQueue
+from worker_pool import RemoteOnlineProcessor, Worker, WorkerPool
+
+
+class FakeProcess:
+    def __init__(self):
+        self.running = True
+
+    def is_alive(self):
+        return self.running
+
+
+def start_worker(monkeypatch):
+    monkeypatch.setattr(Worker, "POLL", 0.05)
+    server_end, worker_end = multiprocessing.Pipe()
+    w = Worker(0, FakeProcess(), server_end)
+    w.thread.start()
+    return w, worker_end
+
+
+def call_in_thread(w, *a):
+    """runs w.call in a thread, and returns what it raised, failing if it hangs"""
+    result = {}
+
+    def run():
+        try:
+            result["value"] = w.call(*a)
+        except Exception as e:
+            result["error"] = e
+
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    t.join(timeout=5)
+    assert not t.is_alive(), "call hangs"
+    return result
+
+
+def test_result_of_a_running_worker(monkeypatch):
+    w, worker_end = start_worker(monkeypatch)
+    threading.Thread(target=lambda: worker_end.send(("result", worker_end.recv()[1], 42)), daemon=True).start()
+    assert call_in_thread(w, "process", 7) == {"value": (42,)}
+
+
+def test_call_after_the_worker_exited(monkeypatch):
+    w, worker_end = start_worker(monkeypatch)
+    worker_end.close()
+    w.thread.join(timeout=5)
+    assert isinstance(call_in_thread(w, "process", 1)["error"], RuntimeError)
+
+
+def test_worker_exits_while_the_call_waits(monkeypatch):
+    w, worker_end = start_worker(monkeypatch)
+    threading.Thread(target=lambda: (worker_end.recv(), worker_end.close()), daemon=True).start()
+    assert isinstance(call_in_thread(w, "process", 1)["error"], RuntimeError)
+    assert not w.alive
+
+
+def test_dead_process_whose_pipe_stays_open(monkeypatch):
+    # e.g. another forked worker holds the pipe's end, so it never reaches EOF
+    w, worker_end = start_worker(monkeypatch)
+    w.process.running = False
+    assert isinstance(call_in_thread(w, "process", 1)["error"], RuntimeError)
+    assert not w.alive
+    worker_end.close()
+
+
+class OpenWorker:
+    """answers only the "open" call of a session"""
+    index = 0
+    alive = False
+
+    def call(self, cmd, *a):
+        assert cmd == "open"
+        return ("",)
+
+
+def test_unread_audio_must_fit_in_the_ring():
+    remote = RemoteOnlineProcessor(None, OpenWorker(), 0, 1000)
+    try:
+        remote.insert_audio_chunk(np.ones(600, dtype=np.float32))
+        with pytest.raises(ValueError):
+            remote.insert_audio_chunk(np.full(600, 2, dtype=np.float32))
+        # the unread audio is not overwritten
+        assert remote.inserted == (0, 600)
+        assert (remote.ring.read(0, 600) == 1).all()
+    finally:
+        remote.ring.close(unlink=True)
+
+
+def test_the_ring_holds_the_ingest_backlog():
+    assert WorkerPool.RING_SEC > IngestQueue.MAX_SIZE
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""Benchmark of the accuracy and latency of the VAD (VADIterator with Silero) on recordings with speech segment annotations.
+
+The directory contains name.wav (16kHz mono) and name.segments with the reference speech segments, one "beg end" line per
+segment, in seconds. Instead of .segments, the name.words alignment of benchmark.py can be given, its words closer than
+--merge-gap are merged into segments.
+
+The model runs once per file. Its speech probability trace, one value per 512-sample window (32 ms), can be saved to
+--traces as name.npy and loaded again with --from-traces, e.g. to sweep the parameters without the model. The segments are
+found by replaying the trace through VADIterator, the same way as FixedVADIterator in the streaming, so every parameter
+setting costs only the replay. --threshold, --min-silence-ms and --speech-pad-ms take comma-separated values, every
+combination is evaluated.
+
+Reported for each setting:
+  - onset latency: when the VAD detects the start of speech, minus the reference start, percentiles,
+  - offset latency: when the VAD detects the end of speech, minus the reference end, percentiles,
+  - missed: the fraction of the reference segments that no detected segment overlaps,
+  - merged: reference segments whose detected segment continues over the next one (the pause between them was not detected),
+  - false triggers per minute of non-speech: detected segments that overlap no reference segment,
+  - CPU time of the model per audio second (the same for all settings, not available with --from-traces).
+
+Example:
+  python3 vad_benchmark.py --threshold 0.3,0.5,0.7 --min-silence-ms 250,500 --traces traces/ data/
+"""
+from whisper_online import audio_duration, load_audio, load_vad_model, set_logging
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import logging
+import numpy as np
+
+from silero_vad_iterator import VADIterator
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE = 16000
+WINDOW = 512
+
+
+def load_dataset(path, merge_gap=0.3):
+    """returns [(name, wav path, [(beg, end), ...]), ...]"""
+    items = []
+    for f in sorted(os.listdir(path)):
+        if not f.endswith(".wav"):
+            continue
+        name = f[:-4]
+        segments = None
+        sf = os.path.join(path, name+".segments")
+        wf = os.path.join(path, name+".words")
+        if os.path.isfile(sf):
+            with open(sf) as fh:
+                segments = sorted((float(b), float(e)) for b, e in (line.split()[:2] for line in fh if line.strip()))
+        elif os.path.isfile(wf):
+            with open(wf) as fh:
+                words = sorted((float(b), float(e)) for b, e in (line.split()[:2] for line in fh if line.strip()))
+            segments = []
+            for b, e in words:
+                if segments and b - segments[-1][1] < merge_gap:
+                    segments[-1] = (segments[-1][0], max(e, segments[-1][1]))
+                else:
+                    segments.append((b, e))
+        if segments is None:
+            logger.warning(f"{name}: no speech segment annotation, skipping")
+            continue
+        items.append((name, os.path.join(path, f), segments))
+    return items
+
+
+def probability_trace(model, audio):
+    """the speech probabilities of the consecutive windows of the audio from a reset state, and the CPU time it took"""
+    n = len(audio)//WINDOW
+    windows = np.ascontiguousarray(audio[:WINDOW*n], dtype=np.float32).reshape(n, WINDOW)
+    t = time.process_time()
+    model.reset_states()
+    if hasattr(model, "window_probs"):
+        probs = np.asarray(model.window_probs(windows), dtype=np.float32)
+    else:
+        import torch
+        with torch.no_grad():
+            probs = np.array([model(w, SAMPLING_RATE).item() for w in torch.from_numpy(windows)], dtype=np.float32)
+    return probs, time.process_time() - t
+
+
+class _Trace:
+    """in place of the model in VADIterator, the probabilities are given to step()"""
+
+    def reset_states(self):
+        pass
+
+
+def replay(trace, threshold, min_silence_ms, speech_pad_ms):
+    """Detected segments of the trace as [(start, end, start detected at, end detected at), ...] in seconds.
+    The end of a segment that lasts until the end of the audio is not detected, its detection time is None."""
+    vad = VADIterator(_Trace(), threshold=threshold, sampling_rate=SAMPLING_RATE,
+                      min_silence_duration_ms=min_silence_ms, speech_pad_ms=speech_pad_ms)
+    segments = []
+    start = None
+    for p in trace:
+        r = vad.step(float(p), WINDOW)
+        if r is None:
+            continue
+        now = vad.current_sample/SAMPLING_RATE
+        if "start" in r:
+            start = (max(r["start"], 0)/SAMPLING_RATE, now)
+        else:
+            segments.append((start[0], r["end"]/SAMPLING_RATE, start[1], now))
+            start = None
+    if start is not None:
+        segments.append((start[0], len(trace)*WINDOW/SAMPLING_RATE, start[1], None))
+    return segments
+
+
+def evaluate(reference, detected, duration):
+    """compares the detected segments of one file with the reference ones"""
+    onset, offset = [], []
+    missed = merged = 0
+    for k, (b, e) in enumerate(reference):
+        over = [d for d in detected if d[0] < e and d[1] > b]
+        if not over:
+            missed += 1
+            continue
+        first, last = over[0], over[-1]
+        if k == 0 or first[0] >= reference[k-1][1]:  # not a continuation of the previous segment
+            onset.append(first[2] - b)
+        if k+1 < len(reference) and last[1] > reference[k+1][0]:
+            merged += 1
+        elif last[3] is not None:
+            offset.append(last[3] - e)
+    false = sum(1 for d in detected if not any(d[0] < e and d[1] > b for b, e in reference))
+    speech = sum(min(e, duration) - b for b, e in reference)
+    return {"segments": len(reference), "detected": len(detected), "missed": missed, "merged": merged,
+            "false_triggers": false, "nonspeech_seconds": max(duration - speech, 0.0),
+            "onset_latencies": onset, "offset_latencies": offset}
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def summarize(results, cpu_time, duration):
+    onset = [l for r in results for l in r["onset_latencies"]]
+    offset = [l for r in results for l in r["offset_latencies"]]
+    segments = sum(r["segments"] for r in results)
+    nonspeech = sum(r["nonspeech_seconds"] for r in results)
+    return {
+        "segments": segments,
+        "missed": sum(r["missed"] for r in results)/segments if segments else None,
+        "merged": sum(r["merged"] for r in results),
+        "onset_latency_p50": percentile(onset, 50),
+        "onset_latency_p90": percentile(onset, 90),
+        "offset_latency_p50": percentile(offset, 50),
+        "offset_latency_p90": percentile(offset, 90),
+        "false_triggers_per_minute": 60*sum(r["false_triggers"] for r in results)/nonspeech if nonspeech else None,
+        "cpu_per_audio_second": cpu_time/duration if cpu_time is not None and duration else None,
+    }
+
+
+def f(x, fmt="%.3f"):
+    return "-" if x is None else fmt % x
+
+
+def values(s, t):
+    return [t(v) for v in s.split(",")]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('data_dir', type=str, help="Directory with name.wav and name.segments (or name.words) files.")
+    parser.add_argument('--threshold', type=str, default="0.5", help="Speech probability thresholds, comma-separated.")
+    parser.add_argument('--min-silence-ms', type=str, default="500", help="Silence durations that end a segment, comma-separated.")
+    parser.add_argument('--speech-pad-ms', type=str, default="100", help="Paddings of the segments, comma-separated.")
+    parser.add_argument('--merge-gap', type=float, default=0.3, help="Words of a .words file closer than this many seconds are one speech segment.")
+    parser.add_argument('--vac-backend', type=str, default="torch", choices=["torch", "onnx"], help="Silero VAD runtime, see whisper_online.")
+    parser.add_argument('--vac-model-path', type=str, default=None, help="Local silero_vad.onnx or silero_vad.jit file.")
+    parser.add_argument('--traces', type=str, default=None, help="Directory where the probability traces are saved as name.npy.")
+    parser.add_argument('--from-traces', action="store_true", default=False, help="Load the traces from --traces instead of running the model.")
+    parser.add_argument('--json', type=str, default=None, help="Save the per-file and summary results to this JSON file.")
+    parser.add_argument("-l", "--log-level", dest="log_level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help="Set the log level", default='INFO')
+    args = parser.parse_args()
+    set_logging(args, logger, other="")
+
+    items = load_dataset(args.data_dir, args.merge_gap)
+    if not items:
+        logger.error(f"No wav files with speech segment annotations in {args.data_dir}. Exiting.")
+        sys.exit(1)
+    if args.from_traces and args.traces is None:
+        logger.error("--from-traces needs the --traces directory. Exiting.")
+        sys.exit(1)
+
+    model = None if args.from_traces else load_vad_model(args.vac_backend, args.vac_model_path)
+    if args.traces is not None:
+        os.makedirs(args.traces, exist_ok=True)
+    traces = {}
+    durations = {}
+    cpu_time = None if args.from_traces else 0.0
+    for name, wav, _ in items:
+        path = os.path.join(args.traces, name+".npy") if args.traces is not None else None
+        if args.from_traces:
+            # the duration is read from the file header, the audio is not decoded
+            durations[name] = audio_duration(wav)
+            traces[name] = np.load(path)
+            continue
+        audio = load_audio(wav)
+        durations[name] = len(audio)/SAMPLING_RATE
+        traces[name], t = probability_trace(model, audio)
+        cpu_time += t
+        logger.debug(f"{name}: {durations[name]:.1f} s of audio, model CPU time {t:.3f} s")
+        if path is not None:
+            np.save(path, traces[name])
+    duration = sum(durations.values())
+
+    report = []
+    print("\t".join(["threshold", "min_silence_ms", "speech_pad_ms", "segments", "missed", "merged", "onset_p50", "onset_p90",
+                     "offset_p50", "offset_p90", "false_triggers_per_min", "cpu_per_audio_s"]), flush=True)
+    for threshold, min_silence, pad in itertools.product(values(args.threshold, float), values(args.min_silence_ms, int),
+                                                          values(args.speech_pad_ms, int)):
+        results = []
+        for name, _, reference in items:
+            r = evaluate(reference, replay(traces[name], threshold, min_silence, pad), durations[name])
+            r["file"] = name
+            results.append(r)
+        s = summarize(results, cpu_time, duration)
+        print("\t".join([str(threshold), str(min_silence), str(pad), str(s["segments"]), f(s["missed"]), str(s["merged"]),
+                         f(s["onset_latency_p50"]), f(s["onset_latency_p90"]), f(s["offset_latency_p50"]), f(s["offset_latency_p90"]),
+                         f(s["false_triggers_per_minute"]), f(s["cpu_per_audio_second"], "%.4f")]), flush=True)
+        report.append({"threshold": threshold, "min_silence_ms": min_silence, "speech_pad_ms": pad, "summary": s, "files": results})
+
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(report, fh, indent=2)
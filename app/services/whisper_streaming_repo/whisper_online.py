@@ -1,27 +1,165 @@
 #!/usr/bin/env python3
 import sys
 import numpy as np
-import librosa
 from functools import lru_cache
+from collections import deque, OrderedDict
 import time
 import logging
+import os
+import hashlib
+import threading
+import queue
+import bisect
+import asyncio
+import dataclasses
+import copy
+import contextlib
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import io
-import soundfile as sf
 import math
 
+# librosa, soundfile, torch and the Whisper backends are imported where they are used, so that a server
+# starts without importing what it doesn't need
+
 logger = logging.getLogger(__name__)
 
-@lru_cache(10**6)
-def load_audio(fname):
+class AudioCache:
+    """Decoded 16kHz mono float32 audio of whole files, with LRU eviction when their total size exceeds max_bytes.
+    If sidecar_dir is set, each file is decoded only once into a raw float32 sidecar file in it, which is then memory-mapped,
+    so that the decoded audio is held by the OS page cache, not by the process.
+    """
+
+    def __init__(self, max_bytes=256*2**20, sidecar_dir=None):
+        self.max_bytes = max_bytes
+        self.sidecar_dir = sidecar_dir
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def configure(self, max_mb=None, sidecar_dir=None):
+        if max_mb is not None:
+            self.max_bytes = int(max_mb*2**20)
+        self.sidecar_dir = sidecar_dir
+
+    def __contains__(self, fname):
+        return fname in self.entries
+
+    def get(self, fname):
+        with self.lock:
+            if fname in self.entries:
+                self.entries.move_to_end(fname)
+                return self.entries[fname]
+        a = self._load(fname)
+        with self.lock:
+            if fname not in self.entries:
+                self.entries[fname] = a
+                self.bytes += a.nbytes
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                _, old = self.entries.popitem(last=False)
+                self.bytes -= old.nbytes
+        return a
+
+    def _load(self, fname):
+        if self.sidecar_dir is None:
+            return _decode_audio(fname)
+        st = os.stat(fname)
+        key = hashlib.sha1(f"{os.path.abspath(fname)}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()
+        path = os.path.join(self.sidecar_dir, key+".f32")
+        if not os.path.isfile(path):
+            a = _decode_audio(fname)
+            os.makedirs(self.sidecar_dir, exist_ok=True)
+            a.tofile(path+".tmp")
+            os.replace(path+".tmp", path)
+            logger.debug(f"decoded {fname} into {path}")
+        if os.path.getsize(path) == 0:
+            return np.array([],dtype=np.float32)
+        return np.memmap(path, dtype=np.float32, mode="r")
+
+def _decode_audio(fname):
+    import librosa
     a, _ = librosa.load(fname, sr=16000, dtype=np.float32)
     return a
 
+@lru_cache(1024)
+def _audio_info(fname):
+    import soundfile as sf
+    try:
+        return sf.info(fname)
+    except Exception:  # a format that soundfile can't read, librosa falls back to audioread
+        return None
+
+audio_cache = AudioCache()
+
+def load_audio(fname):
+    return audio_cache.get(fname)
+
+def audio_duration(fname):
+    """duration in seconds of the audio resampled to 16kHz, without decoding it if possible"""
+    info = _audio_info(fname)
+    if info is None:
+        return len(load_audio(fname))/16000
+    return math.ceil(info.frames*16000/info.samplerate)/16000
+
 def load_audio_chunk(fname, beg, end):
-    audio = load_audio(fname)
     beg_s = int(beg*16000)
     end_s = int(end*16000)
-    return audio[beg_s:end_s]
+    info = _audio_info(fname)
+    if info is None or info.samplerate != 16000 or fname in audio_cache:
+        return load_audio(fname)[beg_s:end_s]
+    # no resampling is needed, so only the requested range is read
+    end_s = min(end_s, info.frames)
+    if end_s <= beg_s:
+        return np.array([],dtype=np.float32)
+    import soundfile as sf
+    a, _ = sf.read(fname, start=beg_s, stop=end_s, dtype="float32", always_2d=True)
+    return a.mean(axis=1) if a.shape[1] > 1 else a[:,0]
+
+
+def pcm16_to_float32(data, out=None):
+    """Converts 16-bit little-endian PCM (bytes or any buffer, e.g. an int16 array) to float32 samples in [-1,1),
+    in one vectorized operation, the same values as soundfile/librosa decoding gives.
+    out: optional float32 array of at least the number of samples, it is reused for the result, which is a view of it.
+    """
+    pcm = np.frombuffer(data, dtype='<i2', count=memoryview(data).nbytes//2)
+    if out is None:
+        out = np.empty(len(pcm), dtype=np.float32)
+    out = out[:len(pcm)]
+    np.multiply(pcm, np.float32(1/32768), out=out)
+    return out
+
+
+class PCMReceiver:
+    '''collects the received 16-bit PCM bytes of a chunk in a reused buffer, and converts them to float32 in one operation.
+    An odd trailing byte, i.e. a sample split between two packets, is kept for the next chunk.'''
+
+    def __init__(self, capacity=16000):
+        self.raw = np.empty(2*capacity, dtype=np.uint8)
+        self.n = 0  # bytes in raw
+        self.audio = np.empty(capacity, dtype=np.float32)
+
+    def __len__(self):
+        return self.n//2
+
+    def add(self, data):
+        end = self.n + len(data)
+        if end > len(self.raw):
+            raw = np.empty(max(end, 2*len(self.raw)), dtype=np.uint8)
+            raw[:self.n] = self.raw[:self.n]
+            self.raw = raw
+        self.raw[self.n:end] = np.frombuffer(data, dtype=np.uint8)
+        self.n = end
+
+    def take(self):
+        '''returns the collected samples, as a view that is valid until the next take'''
+        samples = self.n//2
+        if len(self.audio) < samples:
+            self.audio = np.empty(len(self.raw)//2, dtype=np.float32)
+        audio = pcm16_to_float32(self.raw[:2*samples], out=self.audio)
+        if self.n % 2:
+            self.raw[0] = self.raw[self.n-1]
+        self.n %= 2
+        return audio
 
 
 # Whisper backend
@@ -97,14 +235,79 @@ class WhisperTimestampedASR(ASRBase):
 
 
 
+class ModelPool:
+    """Process-wide pool of loaded models, shared by the ASR objects that use the same model.
+
+    A model is loaded on its first acquire, and reference counted. When the estimated size of the loaded models exceeds max_bytes
+    (None = no limit), the least recently used models that are not referenced are dropped from the pool.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> [model, number of references, size in bytes]
+        self.lock = threading.Lock()
+        self.loading = {}  # key -> lock, so that one model is not loaded twice in parallel
+
+    def acquire(self, key, loader):
+        """returns the model for key, calling loader() -> (model, size in bytes) if it's not loaded"""
+        with self.lock:
+            load_lock = self.loading.setdefault(key, threading.Lock())
+        with load_lock:
+            with self.lock:
+                e = self.entries.get(key)
+                if e is not None:
+                    e[1] += 1
+                    self.entries.move_to_end(key)
+                    logger.debug(f"reusing model {key}, {e[1]} references")
+                    return e[0]
+            model, size = loader()
+            with self.lock:
+                self.entries[key] = [model, 1, size]
+                self._evict()
+            return model
+
+    def release(self, key):
+        with self.lock:
+            e = self.entries.get(key)
+            if e is not None:
+                e[1] = max(0, e[1]-1)
+                self._evict()
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        total = sum(e[2] for e in self.entries.values())
+        for key in list(self.entries):
+            if total <= self.max_bytes:
+                break
+            model, refs, size = self.entries[key]
+            if refs == 0:
+                del self.entries[key]
+                total -= size
+                logger.info(f"model {key} evicted from the pool")
+        if total > self.max_bytes:
+            logger.warning(f"loaded models take {total/2**20:.0f} MB, more than {self.max_bytes/2**20:.0f} MB, but they are all in use")
+
+model_pool = ModelPool()
+
+
 class FasterWhisperASR(ASRBase):
     """Uses faster-whisper library as the backend. Works much faster, appx 4-times (in offline mode). For GPU, it requires installation with a specific CUDNN version.
+    The loaded model is shared with the other FasterWhisperASR objects with the same model, device and compute type, through model_pool.
+    The language is not a part of the key because it's only a transcribe option. new_model is True if this object loaded
+    the model, False if it got one that was already in the pool, e.g. already warmed up by another object.
     """
 
     sep = ""
 
+    def __init__(self, *a, device="cpu", compute_type="int8", **kw):
+        self.device = device
+        self.compute_type = compute_type
+        self.pool_key = None
+        self.new_model = False
+        super().__init__(*a, **kw)
+
     def load_model(self, modelsize=None, cache_dir=None, model_dir=None):
-        from faster_whisper import WhisperModel
 #        logging.getLogger("faster_whisper").setLevel(logger.level)
         if model_dir is not None:
             logger.debug(f"Loading whisper model from model_dir {model_dir}. modelsize and cache_dir parameters are not used.")
@@ -114,9 +317,44 @@ class FasterWhisperASR(ASRBase):
         else:
             raise ValueError("modelsize or model_dir parameter must be set")
 
+        self.pool_key = (model_size_or_path, self.device, self.compute_type)
+        def load():
+            self.new_model = True
+            return self._load_whisper_model(model_size_or_path, cache_dir)
+        return model_pool.acquire(self.pool_key, load)
+
+    def release(self):
+        """the model is no longer needed by this object, the pool may drop it"""
+        if self.pool_key is not None:
+            model_pool.release(self.pool_key)
+            self.pool_key = None
+
+    MODEL_FILES = ("model.bin", "config.json", "tokenizer.json")
+
+    @classmethod
+    def check_model_dir(cls, model_dir):
+        """raises FileNotFoundError unless model_dir contains a converted faster-whisper model"""
+        missing = [f for f in cls.MODEL_FILES if not os.path.isfile(os.path.join(model_dir, f))]
+        if missing:
+            raise FileNotFoundError(f"{model_dir} is not a faster-whisper model directory, missing {', '.join(missing)}")
+
+    def _load_whisper_model(self, model_size_or_path, cache_dir):
+        from faster_whisper import WhisperModel
+        from faster_whisper.utils import download_model
+
+        if os.path.isdir(model_size_or_path):
+            self.check_model_dir(model_size_or_path)
+            path = model_size_or_path
+        else:
+            # a model that is already in the cache is loaded without asking the hub for updates
+            try:
+                path = download_model(model_size_or_path, local_files_only=True, cache_dir=cache_dir)
+            except Exception:
+                logger.info(f"{model_size_or_path} is not in the model cache, downloading it")
+                path = download_model(model_size_or_path, cache_dir=cache_dir)
 
         # this worked fast and reliably on NVIDIA L40
-        model = WhisperModel(model_size_or_path, device="cpu", compute_type="int8", download_root=cache_dir)
+        model = WhisperModel(path, device=self.device, compute_type=self.compute_type)
 
         # or run on GPU with INT8
         # tested: the transcripts were different, probably worse than with FP16, and it was slightly (appx 20%) slower
@@ -125,15 +363,25 @@ class FasterWhisperASR(ASRBase):
         # or run on CPU with INT8
         # tested: works, but slow, appx 10-times than cuda FP16
 #        model = WhisperModel(modelsize, device="cpu", compute_type="int8") #, download_root="faster-disk-cache-dir/")
-        return model
 
-    def transcribe(self, audio, init_prompt=""):
+        # the size of model.bin is used as the memory estimate
+        return model, os.path.getsize(os.path.join(path, "model.bin"))
 
-        # tested: beam_size=5 is faster and better than 1 (on one 200 second document from En ESIC, min chunk 0.01)
-        segments, info = self.model.transcribe(audio, language=self.original_language, initial_prompt=init_prompt, beam_size=5, word_timestamps=True, condition_on_previous_text=True, **self.transcribe_kargs)
-        #print(info)  # info contains language detection result
+    def transcribe(self, audio, init_prompt="", feature_cache=None):
+        """feature_cache: optional MelFeatureCache of the calling session. The log-mel features of audio are then computed by it."""
+        if feature_cache is not None:
+            if not isinstance(self.model.feature_extractor, CachingFeatureExtractor):
+                self.model.feature_extractor = CachingFeatureExtractor(self.model.feature_extractor)
+            self.model.feature_extractor.register(audio, feature_cache)
+        try:
+            # tested: beam_size=5 is faster and better than 1 (on one 200 second document from En ESIC, min chunk 0.01)
+            segments, info = self.model.transcribe(audio, language=self.original_language, initial_prompt=init_prompt, beam_size=5, word_timestamps=True, condition_on_previous_text=True, **self.transcribe_kargs)
+            #print(info)  # info contains language detection result
 
-        return list(segments)
+            return list(segments)
+        finally:
+            if feature_cache is not None:
+                self.model.feature_extractor.unregister(audio)
 
     def ts_words(self, segments):
         o = []
@@ -150,6 +398,37 @@ class FasterWhisperASR(ASRBase):
     def segments_end_ts(self, res):
         return [s.end for s in res]
 
+    def transcribe_batch(self, audios, init_prompt=""):
+        """Transcribes several independent audios (e.g. buffers of different sessions) in one batched model call.
+        Each audio must be at most 30 seconds long. init_prompt is used for all of them, there is no conditioning on previous text.
+        Returns: a list of segment lists, one for each audio, with timestamps relative to the beginning of that audio.
+        """
+        from faster_whisper import BatchedInferencePipeline
+        if getattr(self, "batched_model", None) is None:
+            self.batched_model = BatchedInferencePipeline(model=self.model)
+
+        # the audios are laid out one after another, separated by 1 second gaps that are not transcribed,
+        # and passed as clip_timestamps, so that each one is a separate item in the batch
+        clips = []
+        pos = 0
+        for a in audios:
+            clips.append({"start": pos, "end": pos+len(a)})
+            pos += len(a) + 16000
+            pos += -pos % 160  # align to the feature frames
+        audio = np.zeros(pos, dtype=np.float32)
+        for a, c in zip(audios, clips):
+            audio[c["start"]:c["end"]] = a
+        starts = [c["start"]/16000 for c in clips]
+
+        segments, info = self.batched_model.transcribe(audio, language=self.original_language, beam_size=5, word_timestamps=True, without_timestamps=False, clip_timestamps=clips, batch_size=len(audios), initial_prompt=init_prompt or None, **self.transcribe_kargs)
+        out = [[] for _ in audios]
+        for s in segments:
+            i = bisect.bisect_right(starts, s.start+0.01)-1
+            off = starts[i]
+            words = [dataclasses.replace(w, start=w.start-off, end=w.end-off) for w in s.words]
+            out[i].append(dataclasses.replace(s, start=s.start-off, end=s.end-off, words=words))
+        return out
+
     def use_vad(self):
         self.transcribe_kargs["vad_filter"] = True
 
@@ -157,6 +436,195 @@ class FasterWhisperASR(ASRBase):
         self.transcribe_kargs["task"] = "translate"
 
 
+class MelFeatureCache:
+    """Log-mel features of one session's audio buffer, reused across the overlapping re-transcriptions of process_iter.
+
+    It computes the same features as faster-whisper's FeatureExtractor (400-sample windows, 160-sample hop, centered).
+    Frames are keyed by their absolute sample position since reset(). Only the frames whose window lies entirely in the buffer
+    are kept, so on the next call only the frames near the buffer edges and the frames of newly appended audio are computed.
+    The buffer may only grow at the end and be trimmed at the beginning (by trim()) between calls.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = 0  # absolute position of the first sample of the buffer
+        self.base = 0  # absolute position of the center of the first cached frame
+        self.frames = None  # cached log10 mel frames, shape (n_mels, n)
+        self.reused_frames = 0
+        self.computed_frames = 0
+
+    def trim(self, n):
+        """the first n samples of the buffer were removed"""
+        self.start += n
+        if self.frames is not None:
+            # evict the frames whose window now starts before the buffer
+            first = max(0, -((self.base - 200 - self.start) // 160))
+            self.frames = self.frames[:, first:]
+            self.base += first*160
+
+    def features(self, audio, extractor):
+        hop, n_fft = extractor.hop_length, extractor.n_fft
+        L = len(audio)
+        n = L//hop + 1  # the number of frames that FeatureExtractor returns
+        out = np.empty((extractor.mel_filters.shape[0], n), dtype=np.float32)
+
+        # frames [ka, kb) are taken from the cache
+        ka = kb = 0
+        if self.frames is not None and self.frames.shape[1] and (self.base - self.start) % hop == 0:
+            k0 = (self.base - self.start) // hop
+            ka = max(k0, 2)  # frames 0 and 1 are reflect padded at the beginning
+            kb = min(k0 + self.frames.shape[1], n)
+            if ka < kb:
+                out[:, ka:kb] = self.frames[:, ka-k0:kb-k0]
+            else:
+                ka = kb = 0
+
+        padded = np.pad(np.pad(audio.astype(np.float32, copy=False), (0, hop)), (n_fft//2, n_fft//2), mode="reflect")
+        window = np.hanning(n_fft + 1)[:-1].astype("float32")
+        for a, b in ((0, ka), (kb, n)):
+            if a < b:
+                out[:, a:b] = self._log_mel(padded, a, b, window, extractor)
+        self.reused_frames += kb - ka
+        self.computed_frames += n - (kb - ka)
+
+        # keep the frames whose window doesn't reach out of the audio
+        hi = (L - n_fft//2)//hop + 1
+        if hi > 2:
+            self.frames = out[:, 2:hi]
+            self.base = self.start + 2*hop
+        else:
+            self.frames = None
+
+        log_spec = np.maximum(out, out.max() - 8.0)
+        return (log_spec + 4.0) / 4.0
+
+    @staticmethod
+    def _log_mel(padded, a, b, window, extractor):
+        hop, n_fft = extractor.hop_length, extractor.n_fft
+        seg = padded[a*hop:(b-1)*hop+n_fft]
+        frames = np.lib.stride_tricks.as_strided(seg, (b-a, n_fft), (hop*seg.strides[0], seg.strides[0]))
+        stft = np.fft.rfft(frames * window, n=n_fft, axis=-1).astype("complex64")
+        magnitudes = np.abs(stft.T) ** 2
+        mel_spec = extractor.mel_filters @ magnitudes
+        return np.log10(np.clip(mel_spec, a_min=1e-10, a_max=None))
+
+
+class CachingFeatureExtractor:
+    """Replaces the feature extractor of a faster-whisper model. The features of the audio arrays registered by
+    FasterWhisperASR.transcribe are computed by their session's MelFeatureCache, all the others by the original extractor.
+    """
+
+    def __init__(self, extractor):
+        self.extractor = extractor
+        self.registered = {}
+
+    def __getattr__(self, name):
+        return getattr(self.extractor, name)
+
+    def register(self, audio, cache):
+        self.registered[id(audio)] = (audio, cache)
+
+    def unregister(self, audio):
+        self.registered.pop(id(audio), None)
+
+    def __call__(self, waveform, padding=160, chunk_length=None):
+        r = self.registered.get(id(waveform))
+        if r is None or r[0] is not waveform or padding != self.extractor.hop_length or len(waveform) < self.extractor.n_fft:
+            return self.extractor(waveform, padding=padding, chunk_length=chunk_length)
+        if chunk_length is not None:
+            self.extractor.n_samples = chunk_length * self.extractor.sampling_rate
+            self.extractor.nb_max_frames = self.extractor.n_samples // self.extractor.hop_length
+        return r[1].features(waveform, self.extractor)
+
+
+def collect_batch(requests, max_batch_size, max_wait):
+    """waits for a request in the queue, and returns it with the others that arrive within max_wait seconds, up to max_batch_size"""
+    batch = [requests.get()]
+    deadline = time.time() + max_wait
+    while len(batch) < max_batch_size:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(requests.get(timeout=timeout))
+        except queue.Empty:
+            break
+    return batch
+
+
+class BatchedASRScheduler:
+    """Shares one ASR object among many OnlineASRProcessor instances, e.g. server sessions running in separate threads.
+    It is used in place of the ASR object: OnlineASRProcessor(BatchedASRScheduler(asr), ...).
+
+    transcribe requests that arrive within max_wait seconds from the first pending one are collected, up to max_batch_size.
+    The requests with the same prompt are run as one asr.transcribe_batch call with that prompt. Each caller blocks until
+    its own result is ready. A request that is alone with its prompt, or whose audio is too long to be batched, is run by
+    asr.transcribe, so that no session loses its prompt.
+    """
+
+    MAX_BATCHED_AUDIO = 30*16000  # Whisper's window
+
+    def __init__(self, asr, max_batch_size=8, max_wait=0.05):
+        self.asr = asr
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.batched_requests = 0
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __getattr__(self, name):
+        # sep, ts_words, segments_end_ts etc. are used from the wrapped ASR object
+        if name == "asr":  # not set yet, e.g. in unpickling
+            raise AttributeError(name)
+        return getattr(self.asr, name)
+
+    def transcribe(self, audio, init_prompt="", **kw):
+        # the audio is not copied: the calling session is blocked, so it doesn't change its buffer until the result is ready
+        f = Future()
+        self.requests.put((audio, init_prompt, kw, f))
+        return f.result()
+
+    def _run(self):
+        while True:
+            self._process(collect_batch(self.requests, self.max_batch_size, self.max_wait))
+
+    def _process(self, batch):
+        groups = {}
+        for r in batch:
+            if 0 < len(r[0]) <= self.MAX_BATCHED_AUDIO:
+                groups.setdefault(r[1], []).append(r)
+        batched = set()
+        for init_prompt, group in groups.items():
+            if len(group) < 2:
+                continue
+            logger.debug(f"transcribing a batch of {len(group)} requests")
+            try:
+                results = self.asr.transcribe_batch([r[0] for r in group], init_prompt=init_prompt)
+            except Exception as e:
+                for r in group:
+                    r[-1].set_exception(e)
+            else:
+                for (_,_,_,f), r in zip(group, results):
+                    f.set_result(r)
+            self.batches += 1
+            self.batched_requests += len(group)
+            batched.update(id(r[-1]) for r in group)
+        for r in batch:
+            if id(r[-1]) in batched:
+                continue
+            audio, init_prompt, kw, f = r
+            try:
+                f.set_result(self.asr.transcribe(audio, init_prompt=init_prompt, **kw))
+            except Exception as e:
+                f.set_exception(e)
+
+
 class OpenaiApiASR(ASRBase):
     """Uses OpenAI's Whisper API for audio transcription."""
 
@@ -206,6 +674,7 @@ class OpenaiApiASR(ASRBase):
 
     def transcribe(self, audio_data, prompt=None, *args, **kwargs):
         # Write the audio data to a buffer
+        import soundfile as sf
         buffer = io.BytesIO()
         buffer.name = "temp.wav"
         sf.write(buffer, audio_data, samplerate=16000, format='WAV', subtype='PCM_16')
@@ -245,12 +714,203 @@ class OpenaiApiASR(ASRBase):
 
 
 
+class AudioRingBuffer:
+    """Fixed-capacity float32 audio store for the online processors.
+
+    Samples are written twice, into both halves of a 2*capacity array ("mirrored" ring),
+    so any window of at most `capacity` samples is always contiguous and `view()` never copies.
+    Dropping audio from the front (`consume`) is only a pointer move.
+    If more than `capacity` samples are held at once, the storage is reallocated (doubled) and a warning is logged.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self._data = np.zeros(2*self.capacity, dtype=np.float32)
+        self._start = 0  # position of the first sample, in [0, capacity)
+        self._len = 0
+        self.high_water_mark = 0  # the largest number of samples held at once
+
+    def __len__(self):
+        return self._len
+
+    def view(self):
+        """Contiguous read-only view of the held samples. It is valid until the next append."""
+        v = self._data[self._start:self._start+self._len]
+        v.flags.writeable = False
+        return v
+
+    def append(self, audio):
+        n = len(audio)
+        if n == 0:
+            return
+        if self._len + n > self.capacity:
+            self._grow(self._len + n)
+        self._write((self._start + self._len) % self.capacity, audio)
+        self._len += n
+        self.high_water_mark = max(self.high_water_mark, self._len)
+
+    def consume(self, n):
+        """drops n samples from the beginning"""
+        n = min(max(0, int(n)), self._len)
+        self._start = (self._start + n) % self.capacity
+        self._len -= n
+
+    def clear(self):
+        self._start = 0
+        self._len = 0
+
+    def _write(self, pos, audio):
+        cap = self.capacity
+        first = min(len(audio), cap - pos)
+        self._data[pos:pos+first] = audio[:first]
+        self._data[cap+pos:cap+pos+first] = audio[:first]
+        rest = len(audio) - first
+        if rest:
+            self._data[:rest] = audio[first:]
+            self._data[cap:cap+rest] = audio[first:]
+
+    def _grow(self, needed):
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        logger.warning(f"audio buffer capacity exceeded, growing from {self.capacity/16000:2.2f} to {capacity/16000:2.2f} seconds")
+        held = self.view().copy()
+        self.capacity = capacity
+        self._data = np.zeros(2*capacity, dtype=np.float32)
+        self._start = 0
+        self._len = 0
+        self._write(0, held)
+        self._len = len(held)
+
+
+class IngestQueue:
+    """Bounded queue of the received audio between the ingest (socket, microphone) and the processing of a streaming session,
+    with a policy that keeps the session near real time when the processing is slower than the audio arrives.
+
+    put(audio) is called by the ingest with every received chunk, get(min_samples) by the processing, both in the same event loop.
+    lag is the duration of the audio that waits in the queue beyond the min_samples that the processing asked for, it is checked
+    by get, i.e. when the processing comes back and its chunk is available. A session that keeps up has no lag, whatever its chunk size. Strategies:
+      - "coalesce": get returns all the queued audio at once, so that the backlog is processed by one iteration (one transcribe call)
+        instead of many.
+      - "skip": as coalesce, and while the session is falling behind, the non-speech audio at the front of the queue is dropped,
+        if the processor agrees: skip(n_samples) is called and returns whether the processor advanced its timeline over it.
+        is_speech(audio) classifies windows of skip_window seconds, by default by their RMS energy.
+    The session is falling behind when lag exceeds max_lag. Then on_falling_behind(lag) is called, once until the lag drops
+    under max_lag/2 again. The queue holds at most max_size seconds, the oldest audio is dropped when it is full.
+    """
+
+    MAX_SIZE = 30.0  # seconds
+
+    def __init__(self, strategy="coalesce", max_lag=2.0, max_size=MAX_SIZE, on_falling_behind=None, skip=None, is_speech=None, skip_window=0.1, sampling_rate=16000):
+        if strategy not in ("coalesce", "skip"):
+            raise ValueError(f"unknown backpressure strategy {strategy}")
+        self.strategy = strategy
+        self.max_lag = max_lag
+        self.on_falling_behind = on_falling_behind
+        self.skip = skip
+        self.is_speech = is_speech if is_speech is not None else self.energy_is_speech
+        self.skip_window = int(skip_window*sampling_rate)
+        self.sampling_rate = sampling_rate
+        self.audio = AudioRingBuffer(int(max_size*sampling_rate))
+        self.ready = asyncio.Event()
+        self.closed = False
+
+        self.falling_behind = False
+        self.falling_behind_events = 0
+        self.max_lag_seen = 0.0
+        self.last_lag = 0.0
+        self.dropped = 0.0  # seconds lost because the queue was full
+        self.skipped = 0.0  # seconds of non-speech skipped by the "skip" strategy
+
+    @staticmethod
+    def energy_is_speech(audio, rms_threshold=0.01):
+        return len(audio) > 0 and np.sqrt(np.mean(np.square(audio))) >= rms_threshold
+
+    @property
+    def lag(self):
+        return len(self.audio)/self.sampling_rate
+
+    def put(self, audio):
+        overflow = len(self.audio) + len(audio) - self.audio.capacity
+        if overflow > 0:
+            self.audio.consume(overflow)
+            self.dropped += overflow/self.sampling_rate
+            logger.warning(f"ingest queue is full, dropped {overflow/self.sampling_rate:2.2f} seconds of audio")
+        self.audio.append(audio[-self.audio.capacity:])
+        self.ready.set()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    async def get(self, min_samples=1):
+        """Waits until at least min_samples are queued, and returns all the queued audio (possibly less at close,
+        None if closed and empty). The returned array is valid until the next put."""
+        while len(self.audio) < max(1, min_samples) and not self.closed:
+            self.ready.clear()
+            await self.ready.wait()
+        self._check_lag(min_samples)
+        if self.strategy == "skip" and self.falling_behind and self.skip is not None:
+            self._skip_non_speech()
+        return self.drain()
+
+    def drain(self):
+        """returns all the queued audio without waiting, or None if it is empty. It is valid until the next put."""
+        if len(self.audio) == 0:
+            return None
+        audio = self.audio.view()
+        self.audio.consume(len(audio))
+        return audio
+
+    def _skip_non_speech(self):
+        w = self.skip_window
+        n = 0
+        view = self.audio.view()
+        while n + w <= len(view) and not self.is_speech(view[n:n+w]):
+            n += w
+        if n and self.skip(n):
+            self.audio.consume(n)
+            self.skipped += n/self.sampling_rate
+            logger.debug(f"skipped {n/self.sampling_rate:2.2f} seconds of non-speech backlog")
+
+    def _check_lag(self, min_samples=0):
+        # the chunk of the next iteration is not a backlog
+        lag = self.last_lag = max(0, len(self.audio) - min_samples)/self.sampling_rate
+        self.max_lag_seen = max(self.max_lag_seen, lag)
+        if not self.falling_behind and lag > self.max_lag:
+            self.falling_behind = True
+            self.falling_behind_events += 1
+            logger.warning(f"falling behind real time, {lag:2.2f} seconds of audio wait for processing")
+            if self.on_falling_behind is not None:
+                self.on_falling_behind(lag)
+        elif self.falling_behind and lag < self.max_lag/2:
+            self.falling_behind = False
+            logger.info(f"caught up with real time, lag {lag:2.2f} seconds")
+
+
+# n-gram keys for HypothesisBuffer: a polynomial hash over the UTF-8 bytes (base 256, modulo a Mersenne prime),
+# so that the key of "w1 w2" can be composed from the keys of "w1" and "w2" without joining the strings.
+_NGRAM_MOD = (1 << 61) - 1
+_SPACE_KEY = (ord(" "), 1)
+
+@lru_cache(2**16)
+def _word_key(word):
+    """returns (hash, length in bytes) of the word"""
+    b = word.encode("utf-8")
+    return int.from_bytes(b, "big") % _NGRAM_MOD, len(b)
+
+def _concat_keys(x, y):
+    """key of the concatenation of two strings with keys x and y"""
+    return (x[0] * pow(256, y[1], _NGRAM_MOD) + y[0]) % _NGRAM_MOD, x[1] + y[1]
+
+
 class HypothesisBuffer:
 
     def __init__(self, logfile=sys.stderr):
-        self.commited_in_buffer = []
-        self.buffer = []
-        self.new = []
+        self.commited_in_buffer = deque()
+        self.buffer = deque()
+        self.buffer_stability = deque()  # for each word in buffer: in how many consecutive inserts it appeared
+        self.new = deque()
 
         self.last_commited_time = 0
         self.last_commited_word = None
@@ -261,23 +921,33 @@ class HypothesisBuffer:
         # compare self.commited_in_buffer and new. It inserts only the words in new that extend the commited_in_buffer, it means they are roughly behind last_commited_time and new in content
         # the new tail is added to self.new
         
-        new = [(a+offset,b+offset,t) for a,b,t in new]
-        self.new = [(a,b,t) for a,b,t in new if a > self.last_commited_time-0.1]
+        self.new = deque((a+offset,b+offset,t) for a,b,t in new if a+offset > self.last_commited_time-0.1)
 
         if len(self.new) >= 1:
             a,b,t = self.new[0]
             if abs(a - self.last_commited_time) < 1:
                 if self.commited_in_buffer:
                     # it's going to search for 1, 2, ..., 5 consecutive words (n-grams) that are identical in commited and new. If they are, they're dropped.
+                    # The keys of the " "-joined n-grams are extended by one word in each step, the strings are compared only when the keys match.
                     cn = len(self.commited_in_buffer)
                     nn = len(self.new)
+                    c_key = tail_key = None
                     for i in range(1,min(min(cn,nn),5)+1):  # 5 is the maximum 
-                        c = " ".join([self.commited_in_buffer[-j][2] for j in range(1,i+1)][::-1])
-                        tail = " ".join(self.new[j-1][2] for j in range(1,i+1))
+                        c_word = _word_key(self.commited_in_buffer[-i][2])
+                        tail_word = _word_key(self.new[i-1][2])
+                        if i == 1:
+                            c_key, tail_key = c_word, tail_word
+                        else:
+                            c_key = _concat_keys(_concat_keys(c_word, _SPACE_KEY), c_key)
+                            tail_key = _concat_keys(_concat_keys(tail_key, _SPACE_KEY), tail_word)
+                        if c_key != tail_key:
+                            continue
+                        c = " ".join(self.commited_in_buffer[-j][2] for j in range(i,0,-1))
+                        tail = " ".join(self.new[j][2] for j in range(i))
                         if c == tail:
                             words = []
                             for j in range(i):
-                                words.append(repr(self.new.pop(0)))
+                                words.append(repr(self.new.popleft()))
                             words_msg = " ".join(words)
                             logger.debug(f"removing last {i} words: {words_msg}")
                             break
@@ -296,60 +966,448 @@ class HypothesisBuffer:
                 commit.append((na,nb,nt))
                 self.last_commited_word = nt
                 self.last_commited_time = nb
-                self.buffer.pop(0)
-                self.new.pop(0)
+                self.buffer.popleft()
+                self.buffer_stability.popleft()
+                self.new.popleft()
             else:
                 break
+        self.buffer_stability = self._stability(self.buffer, self.buffer_stability, self.new)
         self.buffer = self.new
-        self.new = []
+        self.new = deque()
         self.commited_in_buffer.extend(commit)
         return commit
 
     def pop_commited(self, time):
         while self.commited_in_buffer and self.commited_in_buffer[0][1] <= time:
-            self.commited_in_buffer.pop(0)
+            self.commited_in_buffer.popleft()
 
     def complete(self):
-        return self.buffer
+        return list(self.buffer)
+
+    def complete_with_stability(self):
+        """the uncommited words with their stability scores: [(beg,end,"word",stability), ...]"""
+        return [(a,b,t,k) for (a,b,t),k in zip(self.buffer, self.buffer_stability)]
+
+    def snapshot(self):
+        """the state as plain data, see OnlineASRProcessor.snapshot"""
+        return {
+            "commited_in_buffer": list(self.commited_in_buffer),
+            "buffer": list(self.buffer),
+            "buffer_stability": list(self.buffer_stability),
+            "last_commited_time": self.last_commited_time,
+            "last_commited_word": self.last_commited_word,
+        }
+
+    def restore(self, state):
+        self.commited_in_buffer = deque(state["commited_in_buffer"])
+        self.buffer = deque(state["buffer"])
+        self.buffer_stability = deque(state["buffer_stability"])
+        self.new = deque()
+        self.last_commited_time = state["last_commited_time"]
+        self.last_commited_word = state["last_commited_word"]
+
+    @staticmethod
+    def _stability(prev, prev_stability, new):
+        # a word of the new hypothesis survived if the previous one had the same word at about the same time (0.5 s)
+        stability = deque()
+        j = 0
+        for a,b,t in new:
+            while j < len(prev) and prev[j][0] <= a-0.5:
+                j += 1
+            # a changed or inserted word before it does not hide the same word
+            k = j
+            while k < len(prev) and prev[k][0] < a+0.5 and prev[k][2] != t:
+                k += 1
+            if k < len(prev) and prev[k][2] == t and abs(prev[k][0]-a) < 0.5:
+                stability.append(prev_stability[k]+1)
+                j = k+1
+            else:
+                stability.append(1)
+        return stability
+
+class AdaptiveChunkController:
+    """Chooses the chunk size, i.e. the duration of audio between two process_iter calls, from the measured transcribe time.
+
+    The latency of an emission is roughly the chunk size plus the transcribe time, so the chunk size is set to target_latency 
+    minus the (smoothed) transcribe time. It is never smaller than headroom * transcribe time, otherwise the processing can't keep up
+    with the real time and the latency grows without limit. It is kept within [min_size, max_size].
+    """
+
+    def __init__(self, target_latency, initial=1.0, min_size=0.1, max_size=5.0, headroom=1.2, smoothing=0.3):
+        self.target_latency = target_latency
+        self.min_size = min_size
+        self.max_size = max_size
+        self.headroom = headroom
+        self.smoothing = smoothing
+
+        self.chunk_size = initial
+        self.transcribe_time = None  # exponential moving average
+        self.rtf = None  # real-time factor of the last iteration
+        self.decisions = 0  # number of noticeable chunk size changes
+
+    def update(self, transcribe_time, audio_duration):
+        """transcribe_time: wall time of the last transcribe call, audio_duration: seconds of new audio processed in it.
+        Returns the new chunk size in seconds.
+        """
+        if self.transcribe_time is None:
+            self.transcribe_time = transcribe_time
+        else:
+            self.transcribe_time += self.smoothing*(transcribe_time - self.transcribe_time)
+        if audio_duration > 0:
+            self.rtf = transcribe_time/audio_duration
+
+        size = max(self.target_latency - self.transcribe_time, self.headroom*self.transcribe_time)
+        size = min(max(size, self.min_size), self.max_size)
+        if abs(size - self.chunk_size) > 0.05*self.chunk_size:
+            self.decisions += 1
+            rtf = f"{self.rtf:.2f}" if self.rtf is not None else "-"
+            logger.info(f"chunk size {self.chunk_size:.2f} -> {size:.2f} s (transcribe time {self.transcribe_time:.2f} s, RTF {rtf})")
+        self.chunk_size = size
+        return size
+
+
+class Endpointer:
+    """Decides when an utterance is complete from the end of speech detected by the VAC, instead of a fixed timeout.
+
+    After the end of speech, the utterance is complete when the trailing silence reaches a window that adapts to the speaker:
+    pause_words durations of a word at the speech rate of the utterance, so that the pauses of a slow speaker inside a sentence
+    don't end it. The window is longer by unstable_factor when the last hypothesis had not settled (some words appeared in
+    fewer than min_stability updates), and shorter by punct_factor when the text ends with a sentence-final punctuation.
+    It is kept within [min_silence, max_silence].
+    """
+
+    SENTENCE_END = (".", "?", "!")
+
+    def __init__(self, min_silence=0.4, max_silence=2.0, pause_words=2.5, default_rate=2.5, min_stability=2,
+                 unstable_factor=1.5, punct_factor=0.6):
+        self.min_silence = min_silence
+        self.max_silence = max_silence
+        self.pause_words = pause_words
+        self.default_rate = default_rate  # words per second, until the utterance is long enough to measure it
+        self.min_stability = min_stability
+        self.unstable_factor = unstable_factor
+        self.punct_factor = punct_factor
+        self.reset()
+
+    def reset(self):
+        """starts a new utterance"""
+        self.words = 0
+        self.beg = None
+        self.end = None
+        self.text = ""
+        self.stable = True
+
+    def commit(self, beg, end, text):
+        """a committed segment of the utterance, the output (beg, end, text) of process_iter"""
+        if self.beg is None:
+            self.beg = beg
+        self.end = end
+        self.words += len(text.split())
+        self.text = text
+
+    def hypothesis(self, words):
+        """the uncommitted words of the last update, see OnlineASRProcessor.partial. After finish, there are none,
+        then the stability of the previous hypothesis holds."""
+        if words:
+            self.stable = all(k >= self.min_stability for _, _, _, k in words)
+
+    def speech_rate(self):
+        """words per second of the utterance"""
+        if self.words < 3 or self.end - self.beg < 1.0:
+            return self.default_rate
+        return self.words/(self.end - self.beg)
+
+    def window(self):
+        """the trailing silence in seconds that ends the utterance"""
+        w = self.pause_words/self.speech_rate()
+        if not self.stable:
+            w *= self.unstable_factor
+        if self.text.rstrip().endswith(self.SENTENCE_END):
+            w *= self.punct_factor
+        return min(max(w, self.min_silence), self.max_silence)
+
+    def complete(self, trailing_silence):
+        """trailing_silence: seconds since the end of speech, see VACOnlineASRProcessor.trailing_silence, or None in speech"""
+        return trailing_silence is not None and self.words > 0 and trailing_silence >= self.window()
+
+
+class Histogram:
+    """Cumulative histogram with fixed bucket upper bounds, in the Prometheus style."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0]*(len(self.buckets)+1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """upper bound of the bucket that contains the q-quantile (the maximum for the +Inf bucket)"""
+        if self.count == 0:
+            return None
+        rank = q*self.count
+        c = 0
+        for b, n in zip(self.buckets, self.counts):
+            c += n
+            if c >= rank:
+                return min(b, self.max)
+        return self.max
+
+    def exposition(self, name, labels=""):
+        """the sample lines of the histogram in the Prometheus text format. labels: e.g. 'span="vad"' """
+        sep = "," if labels else ""
+        lines = []
+        c = 0
+        for b, n in zip(self.buckets, self.counts):
+            c += n
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{b}"}} {c}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        labels = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{labels} {self.sum}")
+        lines.append(f"{name}_count{labels} {self.count}")
+        return lines
+
+
+class ProcessingHook:
+    """Per-iteration instrumentation of OnlineASRProcessor and VACOnlineASRProcessor. This base class ignores everything.
+    The processors call it only if it's set, so there is no cost without it.
+    audio_time is the end of the received audio in the stream, in seconds.
+    """
+
+    def span(self, name, duration, audio_time):
+        """a processing step took duration seconds: "vad", "transcribe", "ts_words", "insert" or "flush" """
+        pass
+
+    def trim(self, seconds, audio_time):
+        """seconds of audio were trimmed from the beginning of the buffer"""
+        pass
+
+    def iteration(self, duration, audio_time, new_audio, buffer_length, output):
+        """process_iter took duration seconds, on new_audio seconds inserted since the previous one. buffer_length is in seconds,
+        output is the returned (beg, end, text) tuple.
+        """
+        pass
+
+
+class SpanHook(ProcessingHook):
+    """Passes the spans and trims to hook, but not the iterations. The hook of the OnlineASRProcessor inside
+    VACOnlineASRProcessor, which reports the iterations itself, with all the received audio and the VAD time."""
+
+    def __init__(self, hook):
+        self.hook = hook
+
+    def span(self, name, duration, audio_time):
+        self.hook.span(name, duration, audio_time)
+
+    def trim(self, seconds, audio_time):
+        self.hook.trim(seconds, audio_time)
+
+
+class LatencyStatsHook(ProcessingHook):
+    """Aggregates the spans into histograms, together with real-time factor (RTF) and emission latency.
+    The emission latency of a commited text is the audio received after its end plus the iteration time. 
+    With VAC, the audio and the time of the iterations include the non-voice and the VAD, so the RTF is that of the whole stream.
+    One object can be shared by many processors.
+    """
+
+    def __init__(self, buckets=Histogram.BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.rtf = Histogram((0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 5.0))
+        self.emission_latency = Histogram(buckets)
+        self.iterations = 0
+        self.audio_seconds = 0.0
+        self.processing_seconds = 0.0
+        self.trims = 0
+        self.trimmed_seconds = 0.0
+        self.buffer_length = 0.0
+        self.max_buffer_length = 0.0
+
+    def span(self, name, duration, audio_time):
+        with self.lock:
+            if name not in self.spans:
+                self.spans[name] = Histogram(self.buckets)
+            self.spans[name].observe(duration)
+
+    def trim(self, seconds, audio_time):
+        with self.lock:
+            self.trims += 1
+            self.trimmed_seconds += seconds
+
+    def iteration(self, duration, audio_time, new_audio, buffer_length, output):
+        with self.lock:
+            self.iterations += 1
+            self.audio_seconds += new_audio
+            self.processing_seconds += duration
+            if new_audio > 0:
+                self.rtf.observe(duration/new_audio)
+            if output[0] is not None:
+                self.emission_latency.observe(max(0.0, audio_time-output[1]) + duration)
+            self.buffer_length = buffer_length
+            self.max_buffer_length = max(self.max_buffer_length, buffer_length)
+
+    def summary(self):
+        """one line with the totals and the median and 95th percentile of each histogram"""
+        def q(h):
+            if h.count == 0:
+                return "-"
+            return f"p50 {h.quantile(0.5):.3f} p95 {h.quantile(0.95):.3f}"
+        with self.lock:
+            rtf = self.processing_seconds/self.audio_seconds if self.audio_seconds else 0
+            parts = [f"iterations {self.iterations}", f"audio {self.audio_seconds:.1f} s", f"RTF {rtf:.2f} ({q(self.rtf)})",
+                     f"emission latency {q(self.emission_latency)}", f"trims {self.trims}", f"max buffer {self.max_buffer_length:.1f} s"]
+            parts += [f"{name} {q(h)}" for name, h in self.spans.items()]
+        return ", ".join(parts)
+
+    def exposition(self, prefix="whisper"):
+        """the metrics in the Prometheus text format, as a list of lines"""
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.extend([f"# HELP {prefix}_{name} {help}", f"# TYPE {prefix}_{name} {kind}"])
+            lines.extend(samples)
+        with self.lock:
+            metric("iterations_total", "counter", "Processing iterations.", [f"{prefix}_iterations_total {self.iterations}"])
+            metric("audio_seconds_total", "counter", "Seconds of audio received by the processors, with VAC also the non-voice that is not transcribed.", [f"{prefix}_audio_seconds_total {self.audio_seconds}"])
+            metric("processing_seconds_total", "counter", "Seconds spent in the processing iterations, with VAC including the VAD.", [f"{prefix}_processing_seconds_total {self.processing_seconds}"])
+            rtf = self.processing_seconds/self.audio_seconds if self.audio_seconds else 0
+            metric("real_time_factor", "gauge", "Processing time divided by the audio duration, since the start.", [f"{prefix}_real_time_factor {rtf}"])
+            metric("iteration_rtf", "histogram", "Real-time factor of the iterations.", self.rtf.exposition(f"{prefix}_iteration_rtf"))
+            metric("emission_latency_seconds", "histogram", "Latency of the committed text.", self.emission_latency.exposition(f"{prefix}_emission_latency_seconds"))
+            metric("span_seconds", "histogram", "Duration of the processing steps.",
+                   [l for name, h in self.spans.items() for l in h.exposition(f"{prefix}_span_seconds", f'span="{name}"')])
+            metric("trimmed_seconds_total", "counter", "Seconds of audio trimmed from the buffers.", [f"{prefix}_trimmed_seconds_total {self.trimmed_seconds}"])
+            metric("buffer_seconds", "gauge", "Length of the audio buffer in the last iteration.", [f"{prefix}_buffer_seconds {self.buffer_length}"])
+        return lines
+
 
 class OnlineASRProcessor:
 
     SAMPLING_RATE = 16000
 
-    def __init__(self, asr, tokenizer=None, buffer_trimming=("segment", 15), logfile=sys.stderr):
+    TAIL_MAX_UNSTABLE = 2
+
+    def __init__(self, asr, tokenizer=None, buffer_trimming=("segment", 15), logfile=sys.stderr, buffer_capacity_sec=None, feature_cache=False, tail_decoding=False, chunk_controller=None, hook=None):
         """asr: WhisperASR object
         tokenizer: sentence tokenizer object for the target language. Must have a method *split* that behaves like the one of MosesTokenizer. It can be None, if "segment" buffer trimming option is used, then tokenizer is not used at all.
         ("segment", 15)
         buffer_trimming: a pair of (option, seconds), where option is either "sentence" or "segment", and seconds is a number. Buffer is trimmed if it is longer than "seconds" threshold. Default is the most recommended option.
         logfile: where to store the log. 
+        buffer_capacity_sec: preallocated size of the audio buffer in seconds. By default, 10 seconds above the trimming threshold.
+        feature_cache: reuse the log-mel features of the already transcribed audio in the next iterations. Only for FasterWhisperASR.
+        tail_decoding: transcribe only the audio from the last commited word, not the whole buffer. See tail_start.
+        chunk_controller: AdaptiveChunkController object that adjusts the chunk size to the measured transcribe time, or None.
+        hook: ProcessingHook object that receives the timing of each iteration, or None.
         """
         self.asr = asr
         self.tokenizer = tokenizer
         self.logfile = logfile
 
+        self.buffer_trimming_way, self.buffer_trimming_sec = buffer_trimming
+
+        if buffer_capacity_sec is None:
+            buffer_capacity_sec = max(self.buffer_trimming_sec, 30) + 10
+        self.audio_store = AudioRingBuffer(buffer_capacity_sec*self.SAMPLING_RATE)
+        self.mel_cache = MelFeatureCache() if feature_cache else None
+        self.tail_decoding = tail_decoding
+        self.chunk_controller = chunk_controller
+        self.hook = hook
+
         self.init()
 
-        self.buffer_trimming_way, self.buffer_trimming_sec = buffer_trimming
+    @property
+    def audio_buffer(self):
+        """contiguous view of the audio that is currently buffered"""
+        return self.audio_store.view()
 
     def init(self, offset=None):
         """run this when starting or restarting processing"""
-        self.audio_buffer = np.array([],dtype=np.float32)
+        self.audio_store.clear()
+        if self.mel_cache is not None:
+            self.mel_cache.reset()
         self.transcript_buffer = HypothesisBuffer(logfile=self.logfile)
         self.buffer_time_offset = 0
         if offset is not None:
             self.buffer_time_offset = offset
         self.transcript_buffer.last_commited_time = self.buffer_time_offset
         self.commited = []
+        self.tail_unstable_iters = 0
+        self.tail_iters = 0
+        self.full_iters = 0
+        self.new_samples = 0  # inserted since the last process_iter
+        self.last_partial = []
 
     def insert_audio_chunk(self, audio):
-        self.audio_buffer = np.append(self.audio_buffer, audio)
+        self.audio_store.append(audio)
+        self.new_samples += len(audio)
+
+    def partial(self):
+        """Returns the uncommited hypothesis of the last process_iter, as [(beg,end,"word",stability), ...], where stability
+        is the number of consecutive iterations in which the word appeared. It is a speculative low-latency transcript,
+        the words may still change. It is empty after finish.
+        """
+        return self.last_partial
 
-    def prompt(self):
+    def snapshot(self):
+        """Returns the state of the processing as a picklable dict: the audio buffer, the hypothesis buffer, the commited words
+        and the offsets. A processor with the same options continues from it after restore(state), without transcribing
+        the audio again, e.g. when a client reconnects or the session moves to another process.
+        The cached mel features are not in the snapshot, they are computed again in the next iteration.
+        """
+        state = {
+            "audio": self.audio_buffer.copy(),
+            "buffer_time_offset": self.buffer_time_offset,
+            "commited": list(self.commited),
+            "transcript_buffer": self.transcript_buffer.snapshot(),
+            "tail_unstable_iters": self.tail_unstable_iters,
+            "tail_iters": self.tail_iters,
+            "full_iters": self.full_iters,
+            "new_samples": self.new_samples,
+            "last_partial": list(self.last_partial),
+        }
+        if self.chunk_controller is not None:
+            c = self.chunk_controller
+            state["chunk_controller"] = (c.chunk_size, c.transcribe_time, c.rtf)
+        return state
+
+    def restore(self, state):
+        """continues from the state returned by snapshot"""
+        self.init(offset=state["buffer_time_offset"])
+        self.audio_store.append(state["audio"])
+        self.commited = list(state["commited"])
+        self.transcript_buffer.restore(state["transcript_buffer"])
+        self.tail_unstable_iters = state["tail_unstable_iters"]
+        self.tail_iters = state["tail_iters"]
+        self.full_iters = state["full_iters"]
+        self.new_samples = state["new_samples"]
+        self.last_partial = list(state["last_partial"])
+        if self.chunk_controller is not None and "chunk_controller" in state:
+            c = self.chunk_controller
+            c.chunk_size, c.transcribe_time, c.rtf = state["chunk_controller"]
+
+    def get_chunk_size(self, default):
+        """the chunk size in seconds chosen by the chunk controller, or default if there is none"""
+        if self.chunk_controller is None:
+            return default
+        return self.chunk_controller.chunk_size
+
+    def prompt(self, time=None):
         """Returns a tuple: (prompt, context), where "prompt" is a 200-character suffix of commited text that is inside of the scrolled away part of audio buffer. 
         "context" is the commited text that is inside the audio buffer. It is transcribed again and skipped. It is returned only for debugging and logging reasons.
+        time: where the transcribed audio begins. Default is the beginning of the audio buffer.
         """
+        if time is None:
+            time = self.buffer_time_offset
         k = max(0,len(self.commited)-1)
-        while k > 0 and self.commited[k-1][1] > self.buffer_time_offset:
+        while k > 0 and self.commited[k-1][1] > time:
             k -= 1
 
         p = self.commited[:k]
@@ -369,18 +1427,45 @@ class OnlineASRProcessor:
         The non-emty text is confirmed (committed) partial transcript.
         """
 
-        prompt, non_prompt = self.prompt()
+        tail = self.tail_start()
+        res_offset = tail/self.SAMPLING_RATE  # where the transcribed audio begins in the buffer
+        prompt, non_prompt = self.prompt(self.buffer_time_offset+res_offset)
         logger.debug(f"PROMPT: {prompt}")
         logger.debug(f"CONTEXT: {non_prompt}")
-        logger.debug(f"transcribing {len(self.audio_buffer)/self.SAMPLING_RATE:2.2f} seconds from {self.buffer_time_offset:2.2f}")
-        res = self.asr.transcribe(self.audio_buffer, init_prompt=prompt)
+        audio = self.audio_buffer[tail:]
+        logger.debug(f"transcribing {len(audio)/self.SAMPLING_RATE:2.2f} seconds from {self.buffer_time_offset+res_offset:2.2f}")
+        hook = self.hook
+        audio_time = self.buffer_time_offset + len(self.audio_store)/self.SAMPLING_RATE
+        new_audio = self.new_samples/self.SAMPLING_RATE
+        self.new_samples = 0
+        t = iter_start = time.perf_counter()
+        if self.mel_cache is not None and tail == 0:
+            res = self.asr.transcribe(audio, init_prompt=prompt, feature_cache=self.mel_cache)
+        else:
+            res = self.asr.transcribe(audio, init_prompt=prompt)
+        if self.chunk_controller is not None:
+            self.chunk_controller.update(time.perf_counter()-t, new_audio)
+        if hook is not None:
+            t = self._span("transcribe", t, audio_time)
 
         # transform to [(beg,end,"word1"), ...]
         tsw = self.asr.ts_words(res)
+        if hook is not None:
+            t = self._span("ts_words", t, audio_time)
 
-        self.transcript_buffer.insert(tsw, self.buffer_time_offset)
+        self.transcript_buffer.insert(tsw, self.buffer_time_offset+res_offset)
+        if hook is not None:
+            t = self._span("insert", t, audio_time)
         o = self.transcript_buffer.flush()
+        if hook is not None:
+            t = self._span("flush", t, audio_time)
         self.commited.extend(o)
+        self.last_partial = self.transcript_buffer.complete_with_stability()
+        if tail:
+            self.tail_iters += 1
+            self.tail_unstable_iters = 0 if o else self.tail_unstable_iters+1
+        else:
+            self.full_iters += 1
         completed = self.to_flush(o)
         logger.debug(f">>>>COMPLETE NOW: {completed}")
         the_rest = self.to_flush(self.transcript_buffer.complete())
@@ -399,7 +1484,12 @@ class OnlineASRProcessor:
             s = 30 # if the audio buffer is longer than 30s, trim it
         
         if len(self.audio_buffer)/self.SAMPLING_RATE > s:
-            self.chunk_completed_segment(res)
+            if tail:
+                # the tail usually has too few segments to chunk at, but everything before it is commited
+                logger.debug(f"--- tail chunked at {self.buffer_time_offset+res_offset:2.2f}")
+                self.chunk_at(self.buffer_time_offset+res_offset)
+            else:
+                self.chunk_completed_segment(res)
 
             # alternative: on any word
             #l = self.buffer_time_offset + len(self.audio_buffer)/self.SAMPLING_RATE - 10
@@ -412,7 +1502,33 @@ class OnlineASRProcessor:
             #self.chunk_at(t)
 
         logger.debug(f"len of buffer now: {len(self.audio_buffer)/self.SAMPLING_RATE:2.2f}")
-        return self.to_flush(o)
+        ret = self.to_flush(o)
+        if hook is not None:
+            hook.iteration(time.perf_counter()-iter_start, audio_time, new_audio, len(self.audio_store)/self.SAMPLING_RATE, ret)
+        return ret
+
+    def _span(self, name, t, audio_time):
+        """reports the span from t until now to the hook, returns now"""
+        now = time.perf_counter()
+        self.hook.span(name, now-t, audio_time)
+        return now
+
+    def tail_start(self):
+        """In tail decoding mode, returns the position in the audio buffer (in samples) where the last commited word begins.
+        Only the audio from there is transcribed; the earlier commited text is in the prompt. 
+        Returns 0 (the whole buffer is transcribed) if tail decoding is off, there is no commited word in the buffer,
+        or the stability check failed: the last TAIL_MAX_UNSTABLE tail decodings did not commit anything.
+        """
+        if not self.tail_decoding or not self.commited:
+            return 0
+        if self.tail_unstable_iters >= self.TAIL_MAX_UNSTABLE:
+            logger.debug(f"tail decoding is not stable, transcribing the whole buffer")
+            self.tail_unstable_iters = 0
+            return 0
+        beg = self.commited[-1][0] - self.buffer_time_offset
+        if beg <= 0:
+            return 0
+        return min(int(beg*self.SAMPLING_RATE), len(self.audio_store))
 
     def chunk_completed_sentence(self):
         if self.commited == []: return
@@ -460,7 +1576,12 @@ class OnlineASRProcessor:
         """
         self.transcript_buffer.pop_commited(time)
         cut_seconds = time - self.buffer_time_offset
-        self.audio_buffer = self.audio_buffer[int(cut_seconds*self.SAMPLING_RATE):]
+        cut = int(cut_seconds*self.SAMPLING_RATE)
+        if self.hook is not None:
+            self.hook.trim(cut/self.SAMPLING_RATE, time)
+        self.audio_store.consume(cut)
+        if self.mel_cache is not None:
+            self.mel_cache.trim(cut)
         self.buffer_time_offset = time
 
     def words_to_sentences(self, words):
@@ -495,6 +1616,7 @@ class OnlineASRProcessor:
         """
         o = self.transcript_buffer.complete()
         f = self.to_flush(o)
+        self.last_partial = []
         logger.debug(f"last, noncommited: {f}")
         self.buffer_time_offset += len(self.audio_buffer)/16000
         return f
@@ -524,19 +1646,29 @@ class VACOnlineASRProcessor(OnlineASRProcessor):
     When it detects end of speech (non-voice for 500ms), it makes OnlineASRProcessor to end the utterance immediately.
     '''
 
-    def __init__(self, online_chunk_size, *a, **kw):
+    def __init__(self, online_chunk_size, *a, vad_model=None, vad_gate=False, max_lag=0.0, **kw):
+        """vad_model: the Silero model of this processor, e.g. a stream of BatchedVAD. By default, a copy of the loaded one.
+        vad_gate: skip the VAD model on the clearly silent windows, see EnergyGate in silero_vad_iterator.
+        max_lag: seconds of audio that may be inserted at once on top of the chunk size, e.g. the backlog that an IngestQueue
+        coalesces while it is not falling behind. The audio store is sized for it.
+        """
         self.online_chunk_size = online_chunk_size
 
         self.online = OnlineASRProcessor(*a, **kw)
+        self.chunk_controller = self.online.chunk_controller
+        self.hook = self.online.hook
+        if self.hook is not None:
+            self.online.hook = SpanHook(self.hook)
+        # it holds at most 1 second of non-voice and the chunk received since the last call
+        chunk = online_chunk_size if self.chunk_controller is None else max(online_chunk_size, self.chunk_controller.max_size)
+        self.audio_store = AudioRingBuffer(int((1 + chunk + max_lag)*self.SAMPLING_RATE))
 
         # VAC:
-        import torch
-        model, _ = torch.hub.load(
-            repo_or_dir='snakers4/silero-vad',
-            model='silero_vad'
-        )
-        from services.whisper_streaming_repo.silero_vad_iterator import FixedVADIterator
-        self.vac = FixedVADIterator(model)  # we use the default options there: 500ms silence, 100ms padding, etc.  
+        try:
+            from services.whisper_streaming_repo.silero_vad_iterator import EnergyGate, FixedVADIterator
+        except ImportError:  # run from this directory, e.g. by whisper_online_server.py
+            from silero_vad_iterator import EnergyGate, FixedVADIterator
+        self.vac = FixedVADIterator(vad_model if vad_model is not None else load_vad_model(), gate=EnergyGate() if vad_gate else None)  # we use the default options there: 500ms silence, 100ms padding, etc.  
 
         self.logfile = self.online.logfile
         self.init()
@@ -549,22 +1681,33 @@ class VACOnlineASRProcessor(OnlineASRProcessor):
         self.is_currently_final = False
 
         self.status = None  # or "voice" or "nonvoice"
-        self.audio_buffer = np.array([],dtype=np.float32)
+        self.speech_end = None  # in seconds, the last end of speech detected by the VAD
+        self.audio_store.clear()
         self.buffer_offset = 0  # in frames
+        # received since the last iteration, for the hook
+        self.new_samples = 0
+        self.vad_time = 0.0
 
     def clear_buffer(self):
-        self.buffer_offset += len(self.audio_buffer)
-        self.audio_buffer = np.array([],dtype=np.float32)
+        self.buffer_offset += len(self.audio_store)
+        self.audio_store.clear()
 
 
     def insert_audio_chunk(self, audio):
-        res = self.vac(audio)
-        self.audio_buffer = np.append(self.audio_buffer, audio)
+        if self.hook is not None:
+            t = time.perf_counter()
+            res = self.vac(audio)
+            self.vad_time += self._span("vad", t, (self.buffer_offset+len(self.audio_store)+len(audio))/self.SAMPLING_RATE) - t
+            self.new_samples += len(audio)
+        else:
+            res = self.vac(audio)
+        self.audio_store.append(audio)
 
         if res is not None:
             frame = list(res.values())[0]-self.buffer_offset
             if 'start' in res and 'end' not in res:
                 self.status = 'voice'
+                self.speech_end = None
                 send_audio = self.audio_buffer[frame:]
                 self.online.init(offset=(frame+self.buffer_offset)/self.SAMPLING_RATE)
                 self.online.insert_audio_chunk(send_audio)
@@ -572,6 +1715,7 @@ class VACOnlineASRProcessor(OnlineASRProcessor):
                 self.clear_buffer()
             elif 'end' in res and 'start' not in res:
                 self.status = 'nonvoice'
+                self.speech_end = res['end']/self.SAMPLING_RATE
                 send_audio = self.audio_buffer[:frame]
                 self.online.insert_audio_chunk(send_audio)
                 self.current_online_chunk_buffer_size += len(send_audio)
@@ -581,6 +1725,7 @@ class VACOnlineASRProcessor(OnlineASRProcessor):
                 beg = res["start"]-self.buffer_offset
                 end = res["end"]-self.buffer_offset
                 self.status = 'nonvoice'
+                self.speech_end = res['end']/self.SAMPLING_RATE
                 send_audio = self.audio_buffer[beg:end]
                 self.online.init(offset=(beg+self.buffer_offset)/self.SAMPLING_RATE)
                 self.online.insert_audio_chunk(send_audio)
@@ -595,14 +1740,71 @@ class VACOnlineASRProcessor(OnlineASRProcessor):
             else:
                 # We keep 1 second because VAD may later find start of voice in it.
                 # But we trim it to prevent OOM. 
-                self.buffer_offset += max(0,len(self.audio_buffer)-self.SAMPLING_RATE)
-                self.audio_buffer = self.audio_buffer[-self.SAMPLING_RATE:]
+                drop = max(0,len(self.audio_store)-self.SAMPLING_RATE)
+                self.buffer_offset += drop
+                self.audio_store.consume(drop)
+
+
+    def trailing_silence(self):
+        """seconds of the received audio after the end of speech detected by the VAD, or None in speech or before it"""
+        if self.status != 'nonvoice' or self.speech_end is None:
+            return None
+        return (self.buffer_offset + len(self.audio_store))/self.SAMPLING_RATE - self.speech_end
+
+    def skip(self, n):
+        '''Advances the timeline by n samples of audio that is not processed, e.g. non-speech backlog dropped by IngestQueue.
+        It is possible only out of voice, otherwise it returns False.'''
+        if self.status == 'voice' or self.is_currently_final or self.vac.triggered:
+            return False
+        # the held non-voice audio and the VAD's unprocessed samples precede the gap, they are dropped as well
+        self.vac.current_sample += len(self.vac.buffer) + n
+        self.vac.buffer = self.vac.buffer[:0]
+        self.clear_buffer()
+        self.buffer_offset += n
+        self.new_samples += n  # received, and processed by dropping it
+        return True
+
+    def snapshot(self):
+        """the state of the wrapped processor, the held audio and the VAD, see OnlineASRProcessor.snapshot"""
+        return {
+            "online": self.online.snapshot(),
+            "audio": self.audio_buffer.copy(),
+            "buffer_offset": self.buffer_offset,
+            "status": self.status,
+            "speech_end": self.speech_end,
+            "is_currently_final": self.is_currently_final,
+            "current_online_chunk_buffer_size": self.current_online_chunk_buffer_size,
+            "vad": self.vac.snapshot(),
+        }
 
+    def restore(self, state):
+        self.init()
+        self.online.restore(state["online"])
+        self.audio_store.append(state["audio"])
+        self.buffer_offset = state["buffer_offset"]
+        self.status = state["status"]
+        self.speech_end = state.get("speech_end")
+        self.is_currently_final = state["is_currently_final"]
+        self.current_online_chunk_buffer_size = state["current_online_chunk_buffer_size"]
+        self.vac.restore(state["vad"])
 
     def process_iter(self):
+        """See OnlineASRProcessor.process_iter. The hook gets the iteration with all the audio received since the last one,
+        not only the voiced audio that is transcribed, and its duration includes the VAD of that audio."""
+        if self.hook is None:
+            return self._process_iter()
+        t = time.perf_counter()
+        ret = self._process_iter()
+        self.hook.iteration(time.perf_counter()-t + self.vad_time, (self.buffer_offset+len(self.audio_store))/self.SAMPLING_RATE,
+                            self.new_samples/self.SAMPLING_RATE, len(self.online.audio_store)/self.SAMPLING_RATE, ret)
+        self.new_samples = 0
+        self.vad_time = 0.0
+        return ret
+
+    def _process_iter(self):
         if self.is_currently_final:
             return self.finish()
-        elif self.current_online_chunk_buffer_size > self.SAMPLING_RATE*self.online_chunk_size:
+        elif self.current_online_chunk_buffer_size > self.SAMPLING_RATE*self.get_chunk_size(self.online_chunk_size):
             self.current_online_chunk_buffer_size = 0
             ret = self.online.process_iter()
             return ret
@@ -610,6 +1812,9 @@ class VACOnlineASRProcessor(OnlineASRProcessor):
             print("no online update, only VAD", self.status, file=self.logfile)
             return (None, None, "")
 
+    def partial(self):
+        return self.online.partial()
+
     def finish(self):
         ret = self.online.finish()
         self.current_online_chunk_buffer_size = 0
@@ -620,6 +1825,155 @@ class VACOnlineASRProcessor(OnlineASRProcessor):
 
 WHISPER_LANG_CODES = "af,am,ar,as,az,ba,be,bg,bn,bo,br,bs,ca,cs,cy,da,de,el,en,es,et,eu,fa,fi,fo,fr,gl,gu,ha,haw,he,hi,hr,ht,hu,hy,id,is,it,ja,jw,ka,kk,km,kn,ko,la,lb,ln,lo,lt,lv,mg,mi,mk,ml,mn,mr,ms,mt,my,ne,nl,nn,no,oc,pa,pl,ps,pt,ro,ru,sa,sd,si,sk,sl,sn,so,sq,sr,su,sv,sw,ta,te,tg,th,tk,tl,tr,tt,uk,ur,uz,vi,yi,yo,zh".split(",")
 
+_vad_models = {}
+_vad_model_lock = threading.Lock()
+
+def load_vad_model(backend="torch", model_path=None):
+    """Returns a Silero VAD model. It is loaded only once, and every call returns a copy of it, because the model holds
+    the recurrent state of one stream.
+    backend: "torch": by torch.hub, or from the local TorchScript file model_path (silero_vad.jit).
+        "onnx": OnnxSileroVAD from the local file model_path (silero_vad.onnx), without network access and without torch.
+    """
+    key = (backend, model_path)
+    with _vad_model_lock:
+        if key not in _vad_models:
+            _vad_models[key] = _load_vad_model(backend, model_path)
+    return copy.deepcopy(_vad_models[key])
+
+def _load_vad_model(backend, model_path):
+    if backend == "onnx":
+        if model_path is None:
+            raise ValueError("the onnx VAD backend needs the path of the silero_vad.onnx model")
+        try:
+            from services.whisper_streaming_repo.silero_vad_onnx import OnnxSileroVAD
+        except ImportError:  # run from this directory
+            from silero_vad_onnx import OnnxSileroVAD
+        return OnnxSileroVAD(model_path)
+    if backend != "torch":
+        raise ValueError(f"unknown VAD backend {backend}")
+    import torch
+    if model_path is not None:
+        return torch.jit.load(model_path).eval()
+    model, _ = torch.hub.load(
+        repo_or_dir='snakers4/silero-vad',
+        model='silero_vad'
+    )
+    return model
+
+class BatchedVAD:
+    """One Silero VAD model shared by the VAC of many sessions, e.g. server sessions running in separate threads.
+    stream() returns a BatchedVADStream, that FixedVADIterator uses in place of its own model: VACOnlineASRProcessor(..., vad_model=vad.stream()).
+    Every stream keeps its recurrent state, the shared model holds none between the calls.
+
+    The requests of the streams that arrive within max_wait seconds from the first pending one are evaluated together: the i-th
+    512-sample windows of all the requests are one batch of one model call, with the states of their streams stacked.
+    Each caller blocks until the speech probabilities of its windows are ready.
+    """
+
+    WINDOW = 512
+    # the recurrent state of the Silero models and its batch dimension: v5 has _state and _context, v4 _h and _c
+    STATE_DIMS = {"_state": 1, "_context": 0, "_h": 1, "_c": 1}
+
+    def __init__(self, model, max_batch_size=64, max_wait=0.005, sampling_rate=16000):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.sampling_rate = sampling_rate
+
+        # the operations on the inputs and states: numpy arrays for OnnxSileroVAD, tensors for the torch model
+        if getattr(model, "numpy", False):
+            self._cat = lambda xs, dim: np.concatenate(xs, axis=dim)
+            self._split = lambda x, dim: np.split(x, x.shape[dim], axis=dim)
+            self._as_input = lambda a: a
+            self._no_grad = contextlib.nullcontext
+        else:
+            import torch
+            self._cat = lambda xs, dim: torch.cat(xs, dim=dim)
+            self._split = lambda x, dim: x.split(1, dim=dim)
+            self._as_input = torch.from_numpy
+            self._no_grad = torch.no_grad
+
+        # the state of a new stream is zero, in the shapes that the model has after a window of one stream
+        with self._no_grad():
+            model.reset_states()
+            model(self._as_input(np.zeros((1, self.WINDOW), dtype=np.float32)), sampling_rate)
+        self.initial_state = {k: 0*getattr(model, k) for k in self.STATE_DIMS if hasattr(model, k)}
+
+        self.requests = queue.Queue()
+        self.calls = 0
+        self.windows = 0
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stream(self):
+        return BatchedVADStream(self)
+
+    def window_probs(self, stream, windows):
+        f = Future()
+        self.requests.put((stream, windows, f))
+        return f.result()
+
+    def _run(self):
+        while True:
+            self._process(collect_batch(self.requests, self.max_batch_size, self.max_wait))
+
+    def _process(self, batch):
+        probs = [np.empty(len(w), dtype=np.float32) for _, w, _ in batch]
+        try:
+            for i in range(max(len(w) for _, w, _ in batch)):
+                active = [j for j, (_, w, _) in enumerate(batch) if len(w) > i]
+                streams = [batch[j][0] for j in active]
+                for k, dim in self.STATE_DIMS.items():
+                    if k in self.initial_state:
+                        setattr(self.model, k, self._cat([(s._state or self.initial_state)[k] for s in streams], dim))
+                # the model doesn't reset the stacked states if it thinks it continues with the same batch
+                self.model._last_sr = self.sampling_rate
+                self.model._last_batch_size = len(active)
+                x = self._as_input(np.stack([batch[j][1][i] for j in active]))
+                with self._no_grad():
+                    out = self.model(x, self.sampling_rate)
+                for j, p in zip(active, out[:, 0].tolist()):
+                    probs[j][i] = p
+                parts = {k: self._split(getattr(self.model, k), dim) for k, dim in self.STATE_DIMS.items() if k in self.initial_state}
+                for n, s in enumerate(streams):
+                    s._state = {k: v[n] for k, v in parts.items()}
+                self.calls += 1
+                self.windows += len(active)
+        except Exception as e:
+            for _, _, f in batch:
+                f.set_exception(e)
+            return
+        for (_, _, f), p in zip(batch, probs):
+            f.set_result(p)
+
+
+class BatchedVADStream:
+    """The VAD model of one stream of BatchedVAD, for FixedVADIterator. _state is the recurrent state of the stream, None when it is new.
+    It has the name of the model's state, so that the VAD iterator's snapshot includes it."""
+
+    def __init__(self, vad):
+        self.vad = vad
+        self._state = None
+
+    def reset_states(self):
+        self._state = None
+
+    def window_probs(self, windows):
+        """speech probabilities of the consecutive 512-sample windows, an array of shape (n, 512)"""
+        return self.vad.window_probs(self, windows)
+
+_batched_vad = None
+_batched_vad_lock = threading.Lock()
+
+def get_batched_vad(max_wait=0.005, backend="torch", model_path=None):
+    """the BatchedVAD of this process, it is created on the first call. See load_vad_model for the backends."""
+    global _batched_vad
+    with _batched_vad_lock:
+        if _batched_vad is None:
+            _batched_vad = BatchedVAD(load_vad_model(backend, model_path), max_wait=max_wait)
+    return _batched_vad
+
 def create_tokenizer(lan):
     """returns an object that has split function that works like the one of MosesTokenizer"""
 
@@ -662,17 +2016,36 @@ def add_shared_args(parser):
     parser.add_argument('--lan', '--language', type=str, default='auto', help="Source language code, e.g. en,de,cs, or 'auto' for language detection.")
     parser.add_argument('--task', type=str, default='transcribe', choices=["transcribe","translate"],help="Transcribe or translate.")
     parser.add_argument('--backend', type=str, default="faster-whisper", choices=["faster-whisper", "whisper_timestamped", "openai-api"],help='Load only this backend for Whisper processing.')
-    parser.add_argument('--vac', action="store_true", default=False, help='Use VAC = voice activity controller. Recommended. Requires torch.')
+    parser.add_argument('--vac', action="store_true", default=False, help='Use VAC = voice activity controller. Recommended. Requires torch, or onnxruntime with --vac-backend onnx.')
     parser.add_argument('--vac-chunk-size', type=float, default=0.04, help='VAC sample size in seconds.')
+    parser.add_argument('--vac-backend', type=str, default="torch", choices=["torch", "onnx"], help='Runtime of the Silero VAD model of VAC. torch: downloaded by torch.hub unless --vac-model-path is given. onnx: the local --vac-model-path silero_vad.onnx on onnxruntime, without torch.')
+    parser.add_argument('--vac-model-path', type=str, default=None, help='Local Silero VAD model file: silero_vad.jit for the torch backend, silero_vad.onnx for the onnx backend.')
+    parser.add_argument('--vac-gate', action="store_true", default=False, help='Skip the VAD model on the windows that are clearly silent by their energy and zero-crossing rate, relative to the learned noise floor. Idle sessions then cost almost nothing.')
+    parser.add_argument('--vac-batched', action="store_true", default=False, help='Evaluate the VAD of all sessions by one shared Silero model in batched calls, each session keeps its own VAD state. For the server with many concurrent sessions.')
+    parser.add_argument('--vac-batch-max-wait', type=float, default=0.005, help='Maximum time in seconds that the VAD windows of a session wait for the windows of other sessions to be batched with.')
     parser.add_argument('--vad', action="store_true", default=False, help='Use VAD = voice activity detection, with the default parameters.')
     parser.add_argument('--buffer_trimming', type=str, default="segment", choices=["sentence", "segment"],help='Buffer trimming strategy -- trim completed sentences marked with punctuation mark and detected by sentence segmenter, or the completed segments returned by Whisper. Sentence segmenter must be installed for "sentence" option.')
     parser.add_argument('--buffer_trimming_sec', type=float, default=15, help='Buffer trimming length threshold in seconds. If buffer length is longer, trimming sentence/segment is triggered.')
+    parser.add_argument('--feature-cache', action="store_true", default=False, help='Reuse the log-mel features of the audio buffer across iterations, compute them only for the new audio. Only for faster-whisper backend.')
+    parser.add_argument('--tail-decoding', action="store_true", default=False, help='Transcribe only the audio from the last commited word, with the earlier commited text as prompt. It falls back to the whole buffer when no text is commited for several iterations.')
+    parser.add_argument('--target-latency', type=float, default=None, help='Target latency of emissions in seconds. If set, the chunk size is adapted to the measured transcribe time to keep this latency, starting from --min-chunk-size.')
+    parser.add_argument('--latency-stats', action="store_true", default=False, help='Collect the timing of every processing iteration into histograms and log their summary.')
+    parser.add_argument('--batch-size', type=int, default=1, help='Maximum number of transcribe requests of concurrent sessions that are run in one batched model call. 1 means no batching. Only the requests with the same prompt are batched, the others are transcribed one by one with their prompts. Only for faster-whisper backend.')
+    parser.add_argument('--batch-max-wait', type=float, default=0.05, help='Maximum time in seconds that a transcribe request waits for other requests to be batched with.')
+    parser.add_argument('--audio-cache-mb', type=float, default=256, help='Memory budget in MB for decoded audio files that need resampling. Least recently used files are evicted.')
+    parser.add_argument('--audio-sidecar-dir', type=str, default=None, help='Dir where the audio files are decoded to 16kHz float32 sidecar files once, to be memory-mapped instead of held in memory.')
     parser.add_argument("-l", "--log-level", dest="log_level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help="Set the log level", default='DEBUG')
 
 def asr_factory(args, logfile=sys.stderr):
     """
     Creates and configures an ASR and ASR Online instance based on the specified backend and arguments.
     """
+    return online_factory(args, load_asr(args), logfile=logfile)
+
+def load_asr(args):
+    """
+    Loads and configures the ASR object of the specified backend, without an online processor.
+    """
     backend = args.backend
     if backend == "openai-api":
         logger.debug("Using OpenAI API.")
@@ -696,9 +2069,81 @@ def asr_factory(args, logfile=sys.stderr):
         logger.info("Setting VAD filter")
         asr.use_vad()
 
-    language = args.lan
     if args.task == "translate":
         asr.set_translate_task()
+
+    if getattr(args, 'batch_size', 1) > 1:
+        if backend == "faster-whisper":
+            logger.info(f"Batching up to {args.batch_size} transcribe requests within {args.batch_max_wait} seconds")
+            asr = BatchedASRScheduler(asr, max_batch_size=args.batch_size, max_wait=args.batch_max_wait)
+        else:
+            logger.warning(f"Batching is not available for {backend} backend, ignoring --batch-size")
+
+    return asr
+
+def synthetic_speech(duration=1.0, sr=16000):
+    """A deterministic speech-like signal for warming up the ASR without an audio file: harmonics of a gliding pitch,
+    modulated at the syllable rate, with a little noise."""
+    t = np.arange(int(duration*sr))/sr
+    f0 = 120 + 30*np.sin(2*np.pi*0.7*t)
+    phase = 2*np.pi*np.cumsum(f0)/sr
+    voice = sum(np.sin(k*phase)/k for k in range(1, 8))
+    envelope = 0.5*(1 - np.cos(2*np.pi*4*t))
+    noise = np.random.default_rng(0).normal(0, 0.01, len(t))
+    return (0.1*voice*envelope + noise).astype(np.float32)
+
+def warmup(asr, warmup_file=None):
+    """Runs the first transcribe, which takes more time than the others, on 1 second of the file or of synthetic speech.
+    Returns the time it took."""
+    if warmup_file is not None and os.path.isfile(warmup_file):
+        a = load_audio_chunk(warmup_file,0,1)
+    else:
+        if warmup_file is not None:
+            logger.warning(f"The warm up file {warmup_file} is not available, warming up on synthetic audio.")
+        a = synthetic_speech()
+    t = time.time()
+    asr.transcribe(a)
+    return time.time() - t
+
+def load_models(args, warmup_file=None):
+    """
+    Loads the ASR by load_asr and, with --vac, the VAD model in parallel with it, and warms the ASR up.
+    The VAD is only preloaded for the sessions, if it fails, the sessions load it again (and fail if it still fails).
+    Returns the ASR object and the duration of the phases in seconds: {"asr": ..., "vad": ..., "warmup": ...}.
+    """
+    if getattr(args, 'model_dir', None) is not None and args.backend == "faster-whisper":
+        FasterWhisperASR.check_model_dir(args.model_dir)  # fail before anything is loaded
+    phases = {}
+    def timed(name, f, *a):
+        t = time.time()
+        r = f(*a)
+        phases[name] = time.time() - t
+        return r
+    with ThreadPoolExecutor(2) as ex:
+        vad_backend, vad_path = getattr(args, 'vac_backend', "torch"), getattr(args, 'vac_model_path', None)
+        if getattr(args, 'vac_batched', False):
+            load_vad = lambda: get_batched_vad(args.vac_batch_max_wait, vad_backend, vad_path)
+        else:
+            load_vad = lambda: load_vad_model(vad_backend, vad_path)
+        vad = ex.submit(timed, "vad", load_vad) if args.vac else None
+        asr = timed("asr", load_asr, args)
+        if vad is not None:
+            try:
+                vad.result()
+            except Exception:
+                logger.warning("Preloading the VAD model failed, the sessions will load it", exc_info=True)
+    phases["warmup"] = warmup(asr, warmup_file)
+    return asr, phases
+
+def online_factory(args, asr, logfile=sys.stderr, hook=None):
+    """
+    Creates an OnlineASRProcessor or VACOnlineASRProcessor for the given ASR object, configured by the arguments.
+    hook: a ProcessingHook, e.g. shared by many processors. By default, each processor has its own LatencyStatsHook if --latency-stats.
+    Returns the ASR object and the processor, like asr_factory.
+    """
+    backend = args.backend
+    language = args.lan
+    if args.task == "translate":
         tgt_language = "en"  # Whisper translates into English
     else:
         tgt_language = language  # Whisper transcribes in this language
@@ -709,15 +2154,120 @@ def asr_factory(args, logfile=sys.stderr):
     else:
         tokenizer = None
 
+    feature_cache = getattr(args, 'feature_cache', False)
+    tail_decoding = getattr(args, 'tail_decoding', False)
+    chunk_controller = None
+    if getattr(args, 'target_latency', None):
+        chunk_controller = AdaptiveChunkController(args.target_latency, initial=args.min_chunk_size)
+    if hook is None and getattr(args, 'latency_stats', False):
+        hook = LatencyStatsHook()
+    if feature_cache and backend != "faster-whisper":
+        logger.warning(f"Feature cache is not available for {backend} backend, ignoring --feature-cache")
+        feature_cache = False
+
     # Create the OnlineASRProcessor
     if args.vac:
-        
-        online = VACOnlineASRProcessor(args.min_chunk_size, asr,tokenizer,logfile=logfile,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec))
+        vad_backend, vad_path = getattr(args, 'vac_backend', "torch"), getattr(args, 'vac_model_path', None)
+        if getattr(args, 'vac_batched', False):
+            vad_model = get_batched_vad(args.vac_batch_max_wait, vad_backend, vad_path).stream()
+        else:
+            vad_model = load_vad_model(vad_backend, vad_path)
+        online = VACOnlineASRProcessor(args.min_chunk_size, asr,tokenizer,vad_model=vad_model,vad_gate=getattr(args, 'vac_gate', False),max_lag=getattr(args, 'max_lag', 0.0),logfile=logfile,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec),feature_cache=feature_cache,tail_decoding=tail_decoding,chunk_controller=chunk_controller,hook=hook)
     else:
-        online = OnlineASRProcessor(asr,tokenizer,logfile=logfile,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec))
+        online = OnlineASRProcessor(asr,tokenizer,logfile=logfile,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec),feature_cache=feature_cache,tail_decoding=tail_decoding,chunk_controller=chunk_controller,hook=hook)
 
     return asr, online
 
+def simulate(online, audio_path, min_chunk, mode="simultaneous", start_at=0.0, on_output=None, on_audio=None):
+    """Simulates live streaming of a 16kHz mono audio file into the online processor, and finishes it.
+    mode: "offline" (the whole file at once), "comp_unaware" (computationally unaware: the emission time is the end of the processed audio)
+        or "simultaneous" (the audio is inserted in real time, processing time counts)
+    on_output(o, now): called with each non-empty output and its emission time in seconds from the beginning of processing
+    on_audio(end): called after the audio until end seconds was inserted, before processing it
+    Returns: a tuple (list of (now, beg, end, text) of the non-empty outputs, total processing time in seconds)
+    """
+    duration = audio_duration(audio_path)
+    outputs = []
+    processing_time = 0.0
+
+    beg = start_at
+    start = time.time()-beg
+
+    def process(end, now=None):
+        nonlocal processing_time
+        if on_audio is not None:
+            on_audio(end)
+        t = time.time()
+        try:
+            o = online.process_iter()
+        except AssertionError as e:
+            logger.error(f"assertion error: {repr(e)}")
+            return
+        finally:
+            processing_time += time.time()-t
+        emit(o, now)
+
+    def emit(o, now=None):
+        if now is None:
+            now = time.time()-start
+        if o[0] is not None:
+            outputs.append((now,)+tuple(o))
+            if on_output is not None:
+                on_output(o, now)
+        else:
+            # No text, so no output
+            pass
+
+    if mode == "offline": ## offline mode processing (for testing/debugging)
+        a = load_audio(audio_path)
+        online.insert_audio_chunk(a)
+        process(duration)
+        now = None
+    elif mode == "comp_unaware":  # computational unaware mode 
+        end = beg + min_chunk
+        while True:
+            a = load_audio_chunk(audio_path,beg,end)
+            online.insert_audio_chunk(a)
+            process(end, now=end)
+
+            logger.debug(f"## last processed {end:.2f}s")
+
+            if end >= duration:
+                break
+            
+            beg = end
+            
+            if end + min_chunk > duration:
+                end = duration
+            else:
+                end += min_chunk
+        now = duration
+
+    else: # online = simultaneous mode
+        end = 0
+        while True:
+            if not isinstance(online, VACOnlineASRProcessor):
+                min_chunk = online.get_chunk_size(min_chunk)
+            now = time.time() - start
+            if now < end+min_chunk:
+                time.sleep(min_chunk+end-now)
+            end = time.time() - start
+            a = load_audio_chunk(audio_path,beg,end)
+            beg = end
+            online.insert_audio_chunk(a)
+
+            process(end)
+            now = time.time() - start
+            logger.debug(f"## last processed {end:.2f} s, now is {now:.2f}, the latency is {now-end:.2f}")
+
+            if end >= duration:
+                break
+        now = None
+
+    o = online.finish()
+    emit(o, now=now)
+    return outputs, processing_time
+
 def set_logging(args,logger,other="_server"):
     logging.basicConfig(#format='%(name)s 
             format='%(levelname)s\t%(message)s')
@@ -754,8 +2304,8 @@ if __name__ == "__main__":
 
     audio_path = args.audio_path
 
-    SAMPLING_RATE = 16000
-    duration = len(load_audio(audio_path))/SAMPLING_RATE
+    audio_cache.configure(args.audio_cache_mb, args.audio_sidecar_dir)
+    duration = audio_duration(audio_path)
     logger.info("Audio duration is: %2.2f seconds" % duration)
 
     asr, online = asr_factory(args, logfile=logfile)
@@ -764,91 +2314,29 @@ if __name__ == "__main__":
     else:
         min_chunk = args.min_chunk_size
 
-    # load the audio into the LRU cache before we start the timer
+    # read the audio file header (or decode it into the cache) before we start the timer
     a = load_audio_chunk(audio_path,0,1)
 
     # warm up the ASR because the very first transcribe takes much more time than the other
     asr.transcribe(a)
 
-    beg = args.start_at
-    start = time.time()-beg
-
-    def output_transcript(o, now=None):
+    def output_transcript(o, now):
         # output format in stdout is like:
         # 4186.3606 0 1720 Takhle to je
         # - the first three words are:
         #    - emission time from beginning of processing, in milliseconds
         #    - beg and end timestamp of the text segment, as estimated by Whisper model. The timestamps are not accurate, but they're useful anyway
         # - the next words: segment transcript
-        if now is None:
-            now = time.time()-start
-        if o[0] is not None:
-            print("%1.4f %1.0f %1.0f %s" % (now*1000, o[0]*1000,o[1]*1000,o[2]),file=logfile,flush=True)
-            print("%1.4f %1.0f %1.0f %s" % (now*1000, o[0]*1000,o[1]*1000,o[2]),flush=True)
-        else:
-            # No text, so no output
-            pass
-
-    if args.offline: ## offline mode processing (for testing/debugging)
-        a = load_audio(audio_path)
-        online.insert_audio_chunk(a)
-        try:
-            o = online.process_iter()
-        except AssertionError as e:
-            logger.error(f"assertion error: {repr(e)}")
-        else:
-            output_transcript(o)
-        now = None
-    elif args.comp_unaware:  # computational unaware mode 
-        end = beg + min_chunk
-        while True:
-            a = load_audio_chunk(audio_path,beg,end)
-            online.insert_audio_chunk(a)
-            try:
-                o = online.process_iter()
-            except AssertionError as e:
-                logger.error(f"assertion error: {repr(e)}")
-                pass
-            else:
-                output_transcript(o, now=end)
-
-            logger.debug(f"## last processed {end:.2f}s")
-
-            if end >= duration:
-                break
-            
-            beg = end
-            
-            if end + min_chunk > duration:
-                end = duration
-            else:
-                end += min_chunk
-        now = duration
+        print("%1.4f %1.0f %1.0f %s" % (now*1000, o[0]*1000,o[1]*1000,o[2]),file=logfile,flush=True)
+        print("%1.4f %1.0f %1.0f %s" % (now*1000, o[0]*1000,o[1]*1000,o[2]),flush=True)
 
-    else: # online = simultaneous mode
-        end = 0
-        while True:
-            now = time.time() - start
-            if now < end+min_chunk:
-                time.sleep(min_chunk+end-now)
-            end = time.time() - start
-            a = load_audio_chunk(audio_path,beg,end)
-            beg = end
-            online.insert_audio_chunk(a)
-
-            try:
-                o = online.process_iter()
-            except AssertionError as e:
-                logger.error(f"assertion error: {e}")
-                pass
-            else:
-                output_transcript(o)
-            now = time.time() - start
-            logger.debug(f"## last processed {end:.2f} s, now is {now:.2f}, the latency is {now-end:.2f}")
-
-            if end >= duration:
-                break
-        now = None
+    if args.offline:
+        mode = "offline"
+    elif args.comp_unaware:
+        mode = "comp_unaware"
+    else:
+        mode = "simultaneous"
+    simulate(online, audio_path, min_chunk, mode=mode, start_at=args.start_at, on_output=output_transcript)
 
-    o = online.finish()
-    output_transcript(o, now=now)
+    if online.hook is not None:
+        logger.info(f"latency stats: {online.hook.summary()}")
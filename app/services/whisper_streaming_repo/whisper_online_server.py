@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
+import time
+start_time = time.time()
 from whisper_online import *
+import_time = time.time() - start_time
 
 import sys
 import argparse
@@ -13,8 +16,24 @@ parser = argparse.ArgumentParser()
 # server options
 parser.add_argument("--host", type=str, default='localhost')
 parser.add_argument("--port", type=int, default=43007)
+parser.add_argument("--max-sessions", type=int, default=4, dest="max_sessions",
+        help="Maximum number of concurrently served clients. Further connections are refused until a session ends.")
+parser.add_argument("--inference-workers", type=int, default=None, dest="inference_workers",
+        help="Number of threads that run the processing iterations of the sessions on the shared model. Default is --batch-size, so that concurrent requests can be batched, or --max-sessions with --vac-batched, so that the VAD of all sessions can be batched.")
+parser.add_argument("--workers", type=int, default=0,
+        help="Number of ASR worker processes, each with its own model. The sessions are distributed among them. 0: the model is loaded in the server process.")
+parser.add_argument("--protocol", type=str, default="auto", choices=["auto", "line"],
+        help="auto: a client that starts with the magic bytes of frame_protocol uses the framed protocol, the others the line protocol. line: only the line protocol.")
+parser.add_argument("--backpressure", type=str, default="coalesce", choices=["coalesce", "skip"],
+        help="What a session does when its processing is slower than real time. coalesce: all the audio received meanwhile is processed in one iteration. skip: in addition, non-speech backlog is dropped while falling behind (requires --vac).")
+parser.add_argument("--max-lag", type=float, default=2.0, dest="max_lag",
+        help="Seconds of received unprocessed audio above which a session is falling behind.")
+parser.add_argument("--resume-timeout", type=float, default=30.0, dest="resume_timeout",
+        help="Seconds for which the state of a framed session whose connection dropped is kept, so that the client can reconnect and resume it. 0: disabled.")
+parser.add_argument("--metrics-port", type=int, default=None, dest="metrics_port",
+        help="Serve the metrics of the server in the Prometheus text format on this HTTP port of --host. Disabled by default.")
 parser.add_argument("--warmup-file", type=str, dest="warmup_file", 
-        help="The path to a speech audio wav file to warm up Whisper so that the very first chunk processing is fast. It can be e.g. https://github.com/ggerganov/whisper.cpp/raw/master/samples/jfk.wav .")
+        help="The path to a speech audio wav file to warm up Whisper so that the very first chunk processing is fast. It can be e.g. https://github.com/ggerganov/whisper.cpp/raw/master/samples/jfk.wav . Without it, Whisper is warmed up on built-in synthetic audio.")
 
 # options from whisper_online
 add_shared_args(parser)
@@ -28,95 +47,245 @@ SAMPLING_RATE = 16000
 
 size = args.model
 language = args.lan
-asr, online = asr_factory(args)
 min_chunk = args.min_chunk_size
 
-# warm up the ASR because the very first transcribe takes more time than the others. 
+from server_metrics import ServerMetrics
+metrics = ServerMetrics()
+# with the metrics endpoint, the iterations of all sessions are aggregated by one hook
+shared_hook = metrics.stats if args.metrics_port else None
+
+# load the ASR and VAD models in parallel, and warm up the ASR because the very first transcribe takes more time than the others.
 # Test results in https://github.com/ufal/whisper_streaming/pull/81
-msg = "Whisper is not warmed up. The first chunk processing may take longer."
-if args.warmup_file:
-    if os.path.isfile(args.warmup_file):
-        a = load_audio_chunk(args.warmup_file,0,1)
-        asr.transcribe(a)
-        logger.info("Whisper is warmed up.")
-    else:
-        logger.critical("The warm up file is not available. "+msg)
-        sys.exit(1)
+pool = None
+if args.workers:
+    # the worker processes load their models and warm up, the server process has no model
+    from worker_pool import WorkerPool
+    logging.getLogger("worker_pool").setLevel(args.log_level)
+    t = time.time()
+    pool = WorkerPool(args, args.workers)
+    phases = {"workers": time.time() - t}
+    metrics.model_load_seconds = phases["workers"]  # including the warmup of the workers
 else:
-    logger.warning(msg)
+    asr, phases = load_models(args, warmup_file=args.warmup_file)
+    metrics.model_load_seconds = phases["asr"]
+    metrics.warmup_seconds = phases["warmup"]
+    logger.info("Whisper is warmed up.")
+metrics.startup = dict(imports=import_time, **phases)
 
 
 ######### Server objects
 
 import line_packet
-import socket
+import frame_protocol
+import asyncio
+import secrets
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 class Connection:
-    '''it wraps conn object'''
+    '''it wraps the asyncio streams of one client connection, in the line or framed protocol'''
     PACKET_SIZE = 32000*5*60 # 5 minutes # was: 65536
 
-    def __init__(self, conn):
-        self.conn = conn
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
         self.last_line = ""
 
-        self.conn.setblocking(True)
+        self.framed = False
+        self.ended = False  # the client has sent END or closed its side
+        self.dropped = False  # the connection was closed or broken without END
+        self.pending = b""  # audio received during the negotiation
+        self.token = None  # of the session, for its resume. Only in the framed protocol.
+        self.resume = None  # the RESUME message of a reconnecting client
+
+    async def negotiate(self, protocol="auto"):
+        '''selects the framed protocol if the client starts with its magic bytes, the line protocol otherwise'''
+        if protocol == "line":
+            return
+        try:
+            start = await self.reader.readexactly(len(frame_protocol.MAGIC))
+        except asyncio.IncompleteReadError as e:
+            start = e.partial
+        if start == frame_protocol.MAGIC:
+            self.framed = True
+            hello = {"version": frame_protocol.VERSION, "sample_rate": SAMPLING_RATE}
+            if suspended is not None:
+                self.token = hello["session"] = suspended.new_token()
+            await self.send_frame(frame_protocol.encode_json(frame_protocol.HELLO, hello))
+            if self.token is not None:
+                # a reconnecting client resumes its session by the first frame
+                f = await self.read_frame()
+                if f is None or f[0] == frame_protocol.END:
+                    self.ended = True
+                elif f[0] == frame_protocol.RESUME:
+                    self.resume = frame_protocol.decode_json(f[1])
+                elif f[0] == frame_protocol.AUDIO:
+                    self.pending = f[1]
+        else:
+            self.pending = start
 
-    def send(self, line):
+    async def read_frame(self):
+        '''the next frame of the framed protocol. A frame over the size limit is answered by ERROR and the connection
+        is dropped, its session is not kept for a resume.'''
+        try:
+            return await frame_protocol.read_frame(self.reader)
+        except frame_protocol.FrameTooLarge as e:
+            logger.warning(f"closing the connection: {e}")
+            self.dropped = True
+            self.token = None
+            try:
+                await self.send_frame(frame_protocol.encode_json(frame_protocol.ERROR, {"error": str(e)}))
+            except ConnectionError:
+                pass
+            self.writer.close()
+            return None
+
+    async def send(self, line):
         '''it doesn't send the same line twice, because it was problematic in online-text-flow-events'''
         if line == self.last_line:
             return
-        line_packet.send_one_line(self.conn, line)
+        self.writer.write(line_packet.encode_one_line(line))
+        await self.writer.drain()
         self.last_line = line
 
-    def receive_lines(self):
-        in_line = line_packet.receive_lines(self.conn)
-        return in_line
+    async def send_frame(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
 
-    def non_blocking_receive_audio(self):
-        try:
-            r = self.conn.recv(self.PACKET_SIZE)
+    async def receive_audio(self):
+        if self.pending:
+            r, self.pending = self.pending, b""
             return r
+        if self.ended:
+            return None
+        if self.framed:
+            while True:
+                f = await self.read_frame()
+                if f is None or f[0] == frame_protocol.END:
+                    self.ended = True
+                    self.dropped = f is None
+                    return None
+                if f[0] == frame_protocol.AUDIO and f[1]:
+                    return f[1]
+                # other message types from the client are ignored
+        try:
+            return await self.reader.read(self.PACKET_SIZE)
         except ConnectionResetError:
+            self.dropped = True
             return None
 
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+class SuspendedSessions:
+    '''the states of the dropped framed sessions by their tokens, until they are resumed or expire after timeout seconds'''
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.sessions = {}  # token: (expiry time, state)
+
+    @staticmethod
+    def new_token():
+        return secrets.token_urlsafe(16)
 
-import io
-import soundfile
+    def put(self, token, state):
+        self.expire()
+        self.sessions[token] = (time.monotonic() + self.timeout, state)
+        metrics.sessions_suspended = len(self.sessions)
 
-# wraps socket and ASR object, and serves one client connection. 
-# next client should be served by a new instance of this object
+    def take(self, token):
+        '''returns the state and forgets it, or None if the session is unknown or expired'''
+        self.expire()
+        entry = self.sessions.pop(token, None)
+        metrics.sessions_suspended = len(self.sessions)
+        return None if entry is None else entry[1]
+
+    def expire(self):
+        now = time.monotonic()
+        for token in [t for t, (expiry, _) in self.sessions.items() if expiry < now]:
+            del self.sessions[token]
+            logger.info(f"suspended session {token} expired")
+
+suspended = SuspendedSessions(args.resume_timeout) if args.resume_timeout > 0 else None
+
+
+# wraps the connection and its own online ASR processor, and serves one client connection.
+# every client is served by a new instance of this object, concurrently with the others.
+# The processing iterations run in the inference executor, shared by all sessions: at most its number of workers
+# use the model at the same time, and every session waits for its iteration, so at most one request per session is queued.
 class ServerProcessor:
 
-    def __init__(self, c, online_asr_proc, min_chunk):
+    RESEND = 100  # the last committed results that are kept for sending them again to a resumed client
+
+    def __init__(self, c, online_asr_proc, min_chunk, executor, resumed=None):
         self.connection = c
         self.online_asr_proc = online_asr_proc
         self.min_chunk = min_chunk
+        self.executor = executor
 
         self.last_end = None
+        self.last_partial = ""
 
         self.is_first = True
-
-    def receive_audio_chunk(self):
+        self.pcm = PCMReceiver()
+        self.received = 0  # samples, since the start of the session
+        self.sent = deque(maxlen=self.RESEND)  # committed (beg, end, text) in the framed protocol
+
+        # the suspended state of the session that this connection resumes, or None
+        self.resumed = resumed
+        if resumed is not None:
+            self.last_end = resumed["last_end"]
+            self.received = resumed["position"]
+            self.sent.extend(resumed["sent"])
+            self.is_first = False
+
+        skip = getattr(online_asr_proc, "skip", None)
+        if args.backpressure == "skip" and skip is None:
+            logger.warning("skipping the backlog requires VAC, the backlog is coalesced")
+        self.queue = IngestQueue(args.backpressure if skip is not None else "coalesce", max_lag=args.max_lag,
+                                 on_falling_behind=self.falling_behind, skip=skip)
+
+    async def receive_loop(self):
+        # the ingest: the audio is put to the queue as soon as it is received, also while an iteration is processed,
+        # so that the queue knows the lag
+        try:
+            while True:
+                raw_bytes = await self.connection.receive_audio()
+                if not raw_bytes:
+                    break
+#                print("received audio:",len(raw_bytes), "bytes", raw_bytes[:10])
+                metrics.bytes_in += len(raw_bytes)
+                self.pcm.add(raw_bytes)
+                audio = self.pcm.take()
+                self.received += len(audio)
+                self.queue.put(audio)
+        finally:
+            self.queue.close()
+
+    async def receive_audio_chunk(self):
         # receive all audio that is available by this time
-        # blocks operation if less than self.min_chunk seconds is available
-        # unblocks if connection is closed or a chunk is available
-        out = []
-        minlimit = self.min_chunk*SAMPLING_RATE
-        while sum(len(x) for x in out) < minlimit:
-            raw_bytes = self.connection.non_blocking_receive_audio()
-            if not raw_bytes:
-                break
-#            print("received audio:",len(raw_bytes), "bytes", raw_bytes[:10])
-            sf = soundfile.SoundFile(io.BytesIO(raw_bytes), channels=1,endian="LITTLE",samplerate=SAMPLING_RATE, subtype="PCM_16",format="RAW")
-            audio, _ = librosa.load(sf,sr=SAMPLING_RATE,dtype=np.float32)
-            out.append(audio)
-        if not out:
+        # waits if less than self.min_chunk seconds is available
+        # returns if connection is closed or a chunk is available
+        # The returned audio is valid until more audio is received.
+        minlimit = int(self.online_asr_proc.get_chunk_size(self.min_chunk)*SAMPLING_RATE)
+        a = await self.queue.get(minlimit)
+        if a is None:
             return None
-        conc = np.concatenate(out)
-        if self.is_first and len(conc) < minlimit:
+        metrics.lag.observe(self.queue.last_lag)
+        if self.is_first and len(a) < minlimit and not self.connection.dropped:
             return None
         self.is_first = False
-        return np.concatenate(out)
+        return a
+
+    def falling_behind(self, lag):
+        metrics.falling_behind += 1
+        if self.connection.framed:
+            self.connection.writer.write(frame_protocol.encode_json(frame_protocol.EVENT, {"event": "falling_behind", "lag": round(lag, 3)}))
 
     def format_output_transcript(self,o):
         # output format in stdout is like:
@@ -131,54 +300,203 @@ class ServerProcessor:
         # Usually it differs negligibly, by appx 20 ms.
 
         if o[0] is not None:
-            beg, end = o[0]*1000,o[1]*1000
-            if self.last_end is not None:
-                beg = max(beg, self.last_end)
-
-            self.last_end = end
+            beg, end = self.output_interval(o)
             print("%1.0f %1.0f %s" % (beg,end,o[2]),flush=True,file=sys.stderr)
             return "%1.0f %1.0f %s" % (beg,end,o[2])
         else:
             logger.debug("No text in this segment")
             return None
 
-    def send_result(self, o):
+    def output_interval(self, o):
+        beg, end = o[0]*1000,o[1]*1000
+        if self.last_end is not None:
+            beg = max(beg, self.last_end)
+        self.last_end = end
+        return beg, end
+
+    async def send_result(self, o):
+        if self.connection.framed:
+            if o[0] is not None:
+                beg, end = self.output_interval(o)
+                print("%1.0f %1.0f %s" % (beg,end,o[2]),flush=True,file=sys.stderr)
+                self.sent.append((beg, end, o[2]))
+                await self.connection.send_frame(frame_protocol.encode_result(beg, end, o[2], committed=True))
+                metrics.results_out += 1
+            return
         msg = self.format_output_transcript(o)
         if msg is not None:
-            self.connection.send(msg)
+            await self.connection.send(msg)
+            metrics.results_out += 1
 
-    def process(self):
+    async def send_partial(self):
+        # the framed protocol carries also the speculative transcript of the uncommitted words, when it changes
+        beg, end, text = self.online_asr_proc.to_flush(self.online_asr_proc.partial())
+        if text == self.last_partial:
+            return
+        self.last_partial = text
+        last_end = self.last_end or 0
+        if beg is None:
+            beg = end = last_end
+        else:
+            beg, end = max(beg*1000, last_end), max(end*1000, last_end)
+        await self.connection.send_frame(frame_protocol.encode_result(beg, end, text, committed=False))
+        metrics.partials_out += 1
+
+    async def process(self):
         # handle one client connection
-        self.online_asr_proc.init()
+        loop = asyncio.get_running_loop()
+        if self.resumed is not None:
+            await self.resume(loop)
+        else:
+            self.online_asr_proc.init()
+        ingest = asyncio.create_task(self.receive_loop())
+        try:
+            await self.process_chunks(loop)
+        finally:
+            ingest.cancel()
+        if self.connection.dropped:
+            if self.connection.token is not None:
+                await self.suspend(loop)
+            return
+        # the client has finished sending, the rest of the transcript is sent if it still listens
+        o = await loop.run_in_executor(self.executor, self.online_asr_proc.finish)
+        try:
+            await self.send_result(o)
+        except ConnectionError:
+            pass
+
+    async def process_chunks(self, loop):
         while True:
-            a = self.receive_audio_chunk()
+            a = await self.receive_audio_chunk()
             if a is None:
                 break
-            self.online_asr_proc.insert_audio_chunk(a)
-            o = online.process_iter()
+            a = a.copy()  # it is inserted in the inference thread, while more audio is received
+            if self.connection.dropped:
+                # the rest is processed if the session is resumed
+                await loop.run_in_executor(self.executor, self.online_asr_proc.insert_audio_chunk, a)
+                break
+            metrics.inference_queue_depth += 1
+            try:
+                o = await loop.run_in_executor(self.executor, self.iteration, a)
+            finally:
+                metrics.inference_queue_depth -= 1
             try:
-                self.send_result(o)
-            except BrokenPipeError:
+                await self.send_result(o)
+                if self.connection.framed:
+                    await self.send_partial()
+            except ConnectionError:
                 logger.info("broken pipe -- connection closed?")
-                break
-
-#        o = online.finish()  # this should be working
-#        self.send_result(o)
+                self.connection.dropped = True
+                return
+
+    def iteration(self, audio):
+        # in an inference thread, so that the VAD of the sessions runs there as well, batched by --vac-batched
+        self.online_asr_proc.insert_audio_chunk(audio)
+        return self.online_asr_proc.process_iter()
+
+    async def suspend(self, loop):
+        # the state of the dropped session is kept for its resume instead of finishing it, including the received audio
+        # that is not processed yet. The results sent since the drop may be lost, they are kept for sending them again.
+        backlog = self.queue.drain()
+        def snapshot():
+            if backlog is not None:
+                self.online_asr_proc.insert_audio_chunk(backlog)
+            return self.online_asr_proc.snapshot()
+        state = await loop.run_in_executor(self.executor, snapshot)
+        suspended.put(self.connection.token, {"state": state, "position": self.received, "last_end": self.last_end, "sent": list(self.sent)})
+        logger.info(f"session {self.connection.token} suspended at {self.received/SAMPLING_RATE:2.2f} seconds")
+
+    async def resume(self, loop):
+        await loop.run_in_executor(self.executor, self.online_asr_proc.restore, self.resumed["state"])
+        c = self.connection
+        await c.send_frame(frame_protocol.encode_json(frame_protocol.EVENT,
+            {"event": "resumed", "session": c.token, "position": round(self.received*1000/SAMPLING_RATE)}))
+        last_end = c.resume.get("last_end")
+        if last_end is not None:
+            for beg, end, text in self.sent:
+                if end > last_end:
+                    await c.send_frame(frame_protocol.encode_result(beg, end, text, committed=True))
+        metrics.sessions_resumed += 1
+        logger.info(f"session {c.token} resumed at {self.received/SAMPLING_RATE:2.2f} seconds")
 
 
 
 # server loop
 
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-    s.bind((args.host, args.port))
-    s.listen(1)
+# with worker processes, the threads only wait for the workers' results, so every session has one. With --vac-batched,
+# the VAD requests of the sessions are batched only if they run at the same time, in their own threads.
+if args.inference_workers:
+    inference_workers = args.inference_workers
+elif pool is not None or args.vac_batched:
+    inference_workers = args.max_sessions
+else:
+    inference_workers = args.batch_size
+if args.vac_batched and inference_workers < 2:
+    logger.warning("--vac-batched with one inference thread: the VAD requests of the sessions are never batched")
+inference = ThreadPoolExecutor(max_workers=inference_workers, thread_name_prefix="inference")
+
+async def handle_client(reader, writer):
+    addr = writer.get_extra_info('peername')
+    connection = Connection(reader, writer)
+    if metrics.sessions_active >= args.max_sessions:
+        logger.warning(f'Refusing client on {addr}, {metrics.sessions_active} sessions are active')
+        metrics.sessions_refused += 1
+        await connection.close()
+        return
+    metrics.sessions_active += 1
+    metrics.sessions_total += 1
+    logger.info(f'Connected to client on {addr}, {metrics.sessions_active} sessions are active')
+    online = None
+    try:
+        await connection.negotiate(args.protocol)
+        if connection.dropped:
+            return
+        resumed = None
+        if connection.resume is not None:
+            token = connection.resume.get("session")
+            resumed = suspended.take(token)
+            if resumed is None:
+                await connection.send_frame(frame_protocol.encode_json(frame_protocol.ERROR, {"error": "unknown or expired session"}))
+                return
+            connection.token = token
+        # every session has its own processor state, the model is shared. The VAC model is loaded out of the event loop.
+        if pool is not None:
+            online = await asyncio.get_running_loop().run_in_executor(None, lambda: pool.open_session(hook=shared_hook))
+        else:
+            _, online = await asyncio.get_running_loop().run_in_executor(None, lambda: online_factory(args, asr, hook=shared_hook))
+        proc = ServerProcessor(connection, online, args.min_chunk_size, inference, resumed=resumed)
+        await proc.process()
+    except Exception as e:
+        logger.exception(f'Session of client on {addr} failed')
+        if connection.framed:
+            try:
+                await connection.send_frame(frame_protocol.encode_json(frame_protocol.ERROR, {"error": str(e)}))
+            except ConnectionError:
+                pass
+    finally:
+        metrics.sessions_active -= 1
+        if pool is not None and online is not None:
+            online.close()
+        await connection.close()
+        logger.info(f'Connection to client on {addr} closed, {metrics.sessions_active} sessions are active')
+        if online is not None and online.hook is not None and online.hook is not shared_hook:
+            logger.info(f"latency stats of {addr}: {online.hook.summary()}")
+
+async def serve():
+    if args.metrics_port:
+        logging.getLogger("server_metrics").setLevel(args.log_level)
+        await metrics.serve(args.host, args.metrics_port)
+    server = await asyncio.start_server(handle_client, args.host, args.port)
+    metrics.startup["total"] = time.time() - start_time
+    logger.info(f"Started in {metrics.startup['total']:.2f} seconds: "
+                + ", ".join(f"{k} {v:.2f}" for k, v in metrics.startup.items() if k != "total")
+                + (" (vad in parallel with asr)" if "vad" in metrics.startup else ""))
     logger.info('Listening on'+str((args.host, args.port)))
-    while True:
-        conn, addr = s.accept()
-        logger.info('Connected to client on {}'.format(addr))
-        connection = Connection(conn)
-        proc = ServerProcessor(connection, online, args.min_chunk_size)
-        proc.process()
-        conn.close()
-        logger.info('Connection to client closed')
-logger.info('Connection closed, terminating.')
+    async with server:
+        await server.serve_forever()
+
+try:
+    asyncio.run(serve())
+except KeyboardInterrupt:
+    pass
+logger.info('Server stopped, terminating.')
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""Multi-process ASR workers for whisper_online_server.
+
+The server process owns the sockets, and each of N worker processes owns its own ASR model and the online processors
+of the sessions pinned to it, so that the sessions use more cores than one process with one model can.
+A new session is pinned to the worker with the fewest sessions, so the load is rebalanced as the sessions end.
+
+The audio goes to the worker through a SharedAudioRing of the session, only the positions are sent over the pipe.
+The server uses a RemoteOnlineProcessor of the session in place of the online processor.
+The snapshot of a session can be restored on any worker, so a resumed session goes to the least loaded one.
+"""
+from whisper_online import *
+
+import os
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+
+logger = logging.getLogger(__name__)
+
+
+class SharedAudioRing:
+    """float32 ring buffer in shared memory, written by the server process and read by a worker process.
+    Positions are absolute sample counts, the ring holds the last `capacity` samples.
+    The server writes the audio of one iteration, or the backlog of IngestQueue for a snapshot, and waits for the call
+    that reads it. RemoteOnlineProcessor checks that the unread audio fits in the ring, write() doesn't.
+    """
+
+    def __init__(self, capacity, name=None):
+        self.capacity = int(capacity)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=4*self.capacity)
+        else:
+            # the forked workers share the server's resource tracker, so the attached memory stays registered once,
+            # and it is unregistered when the creator unlinks it
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.data = np.ndarray((self.capacity,), dtype=np.float32, buffer=self.shm.buf)
+        self.pos = 0  # the next write position
+
+    def write(self, audio):
+        """returns the position of the written audio"""
+        n = len(audio)
+        if n > self.capacity:
+            raise ValueError(f"audio chunk of {n} samples exceeds the shared ring of {self.capacity} samples")
+        start = self.pos
+        p = start % self.capacity
+        first = min(n, self.capacity - p)
+        self.data[p:p+first] = audio[:first]
+        self.data[:n-first] = audio[first:]
+        self.pos += n
+        return start
+
+    def read(self, start, n):
+        p = start % self.capacity
+        if p + n <= self.capacity:
+            return self.data[p:p+n]
+        return np.concatenate([self.data[p:], self.data[:p+n-self.capacity]])
+
+    def close(self, unlink=False):
+        del self.data  # the buffer can't be closed while it is exported
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def worker_main(args, conn, index):
+    """The loop of a worker process. Requests are (command, session id, ...), every one except "close" is answered
+    by ("result", session id, ...) or ("error", session id, message)."""
+    logger.info(f"worker {index}: loading the model")
+    asr, phases = load_models(args, warmup_file=getattr(args, "warmup_file", None))
+    logger.info(f"worker {index}: ready, " + ", ".join(f"{k} {v:.2f} s" for k, v in phases.items()))
+    conn.send(("ready", index))
+
+    sessions = {}
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+        cmd, sid = msg[0], msg[1]
+        try:
+            if cmd == "open":
+                _, online = online_factory(args, asr)
+                sessions[sid] = (online, SharedAudioRing(msg[3], name=msg[2]))
+                conn.send(("result", sid, online.asr.sep))
+            elif cmd == "process":
+                online, ring = sessions[sid]
+                start, n = msg[2], msg[3]
+                t = time.perf_counter()
+                if n:
+                    online.insert_audio_chunk(ring.read(start, n))
+                o = online.process_iter()
+                duration = time.perf_counter() - t
+                buffer_length = len(getattr(online, "online", online).audio_buffer)/16000
+                conn.send(("result", sid, o, online.partial(), online.get_chunk_size(args.min_chunk_size), duration, buffer_length))
+            elif cmd == "finish":
+                online, _ = sessions[sid]
+                conn.send(("result", sid, online.finish(), [], None))
+            elif cmd == "snapshot":
+                online, ring = sessions[sid]
+                start, n = msg[2], msg[3]
+                if n:
+                    online.insert_audio_chunk(ring.read(start, n))
+                conn.send(("result", sid, online.snapshot()))
+            elif cmd == "restore":
+                online, _ = sessions[sid]
+                online.restore(msg[2])
+                conn.send(("result", sid))
+            elif cmd == "close":
+                online, ring = sessions.pop(sid)
+                ring.close()
+                if online.hook is not None:
+                    logger.info(f"worker {index}: latency stats of session {sid}: {online.hook.summary()}")
+        except Exception as e:
+            logger.exception(f"worker {index}: {cmd} of session {sid} failed")
+            if cmd != "close":
+                conn.send(("error", sid, repr(e)))
+    for online, ring in sessions.values():
+        ring.close()
+
+
+class Worker:
+    """the server's end of one worker process"""
+
+    POLL = 1.0  # seconds between the checks that the process of a waited-for worker is running
+
+    def __init__(self, index, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.sessions = 0
+        self.alive = True
+        self.pending = {}  # session id: Future of its request
+        # it serializes the sends, and a request is registered and sent under it, so that it is either failed by _exited
+        # or it sees that the worker is not alive
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._receive, daemon=True)
+
+    def send(self, *msg):
+        with self.lock:
+            self.conn.send(msg)
+
+    def call(self, cmd, sid, *a):
+        """sends the request and waits for its result. A session has at most one pending request.
+        It raises RuntimeError if the worker exits before the result comes."""
+        f = Future()
+        with self.lock:
+            if not self.alive:
+                raise RuntimeError(f"worker {self.index} is not running")
+            self.pending[sid] = f
+            try:
+                self.conn.send((cmd, sid) + a)
+            except OSError as e:
+                del self.pending[sid]
+                raise RuntimeError(f"worker {self.index} is not running") from e
+        while True:
+            try:
+                return f.result(timeout=self.POLL)
+            except TimeoutError:
+                # the pipe of a dead worker may not reach EOF, the other forked workers hold its end too
+                if not self.process.is_alive():
+                    self._exited()
+
+    def _receive(self):
+        while True:
+            try:
+                msg = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            f = self.pending.pop(msg[1], None)
+            if f is None:
+                continue
+            if msg[0] == "error":
+                f.set_exception(RuntimeError(msg[2]))
+            else:
+                f.set_result(msg[2:])
+        self._exited()
+
+    def _exited(self):
+        with self.lock:
+            if self.alive:
+                logger.error(f"worker {self.index} exited")
+            self.alive = False
+            pending, self.pending = self.pending, {}
+        for f in pending.values():
+            f.set_exception(RuntimeError(f"worker {self.index} exited"))
+
+
+class WorkerPool:
+    """Starts n worker processes, each of them loads the ASR model by args. They load in parallel, the constructor
+    returns when all are ready. It must be created before the server starts threads, because the workers are forked."""
+
+    RING_SEC = IngestQueue.MAX_SIZE + 10  # the longest chunk is the backlog that IngestQueue holds
+
+    def __init__(self, args, n):
+        ctx = multiprocessing.get_context("fork")
+        self.workers = []
+        for i in range(n):
+            conn, child_conn = ctx.Pipe()
+            p = ctx.Process(target=worker_main, args=(args, child_conn, i), name=f"asr-worker-{i}", daemon=True)
+            p.start()
+            child_conn.close()
+            self.workers.append(Worker(i, p, conn))
+        for w in self.workers:
+            msg = w.conn.recv()
+            assert msg == ("ready", w.index), msg
+            w.thread.start()
+        logger.info(f"{n} ASR workers are ready")
+        self.session_ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def open_session(self, hook=None):
+        """returns a RemoteOnlineProcessor of a new session on the least loaded worker"""
+        with self.lock:
+            workers = [w for w in self.workers if w.alive]
+            if not workers:
+                raise RuntimeError("no ASR worker is running")
+            w = min(workers, key=lambda w: w.sessions)
+            w.sessions += 1
+        try:
+            return RemoteOnlineProcessor(self, w, next(self.session_ids), int(self.RING_SEC*16000), hook=hook)
+        except Exception:
+            self.session_closed(w)
+            raise
+
+    def session_closed(self, worker):
+        with self.lock:
+            worker.sessions -= 1
+
+
+class RemoteOnlineProcessor:
+    """Online processor of a session that runs in a worker process. It has the interface of OnlineASRProcessor that
+    the server uses. process_iter and finish block until the worker's result comes, like a local iteration does.
+    hook: gets the iterations as measured by the worker. The spans and the per-session stats of --latency-stats are in the worker."""
+
+    def __init__(self, pool, worker, sid, capacity, hook=None):
+        self.pool = pool
+        self.worker = worker
+        self.sid = sid
+        self.hook = hook
+        self.ring = SharedAudioRing(capacity)
+        self.inserted = None  # (position, length) of the audio inserted since the last iteration
+        self.last_partial = []
+        self.chunk_size = None
+        try:
+            (self.sep,) = worker.call("open", sid, self.ring.name, self.ring.capacity)
+        except Exception:
+            self.ring.close(unlink=True)
+            raise
+        logger.info(f"session {sid} runs on worker {worker.index}")
+
+    def init(self):
+        pass  # the worker's processor of a new session is initialized
+
+    def insert_audio_chunk(self, audio):
+        unread = len(audio) + (self.inserted[1] if self.inserted is not None else 0)
+        if unread > self.ring.capacity:
+            # the worker has not read the audio inserted since the last iteration, it would be overwritten
+            raise ValueError(f"{unread} samples of unread audio exceed the shared ring of {self.ring.capacity} samples")
+        start = self.ring.write(audio)
+        if self.inserted is None:
+            self.inserted = (start, len(audio))
+        else:
+            self.inserted = (self.inserted[0], self.inserted[1] + len(audio))
+
+    def process_iter(self):
+        start, n = self.inserted if self.inserted is not None else (self.ring.pos, 0)
+        self.inserted = None
+        o, self.last_partial, self.chunk_size, duration, buffer_length = self.worker.call("process", self.sid, start, n)
+        if self.hook is not None:
+            self.hook.iteration(duration, self.ring.pos/16000, n/16000, buffer_length, o)
+        return o
+
+    def finish(self):
+        o, self.last_partial, _ = self.worker.call("finish", self.sid)
+        return o
+
+    def partial(self):
+        return self.last_partial
+
+    def snapshot(self):
+        """the state of the worker's processor, including the audio inserted since the last iteration"""
+        start, n = self.inserted if self.inserted is not None else (self.ring.pos, 0)
+        self.inserted = None
+        (state,) = self.worker.call("snapshot", self.sid, start, n)
+        return state
+
+    def restore(self, state):
+        self.worker.call("restore", self.sid, state)
+
+    def get_chunk_size(self, default):
+        return self.chunk_size if self.chunk_size is not None else default
+
+    def to_flush(self, sents, sep=None, offset=0):
+        if sep is None:
+            sep = self.sep
+        t = sep.join(s[2] for s in sents)
+        if len(sents) == 0:
+            return (None, None, t)
+        return (offset + sents[0][0], offset + sents[-1][1], t)
+
+    def close(self):
+        if self.worker.alive:
+            try:
+                self.worker.send("close", self.sid)
+            except (OSError, ValueError):
+                pass
+        self.ring.close(unlink=True)
+        self.pool.session_closed(self.worker)